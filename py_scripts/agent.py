@@ -0,0 +1,201 @@
+# local vault agent for Password Manager, keeps an unlocked vault in memory
+# behind a unix domain socket (like ssh-agent) so one-off lookups don't pay
+# for python startup, key reads and decryption every time
+#
+# protocol is one JSON operation per line (see `Vault.apply`) answered with
+# one JSON result per line, plus `{"op": "stop"}` to shut the agent down
+#
+# only stdlib imports here, the client side has to start fast
+
+import json
+import os
+import socket
+import sys
+
+# seconds without a request before the agent locks itself (saves and exits)
+IDLE_TIMEOUT = 900
+
+# seconds a connected client gets to send its request
+CLIENT_TIMEOUT = 5
+
+def socket_path() -> str:
+    """
+    location of the agent socket, PW_MGR_AGENT_SOCK overrides the default
+    per-user runtime directory
+
+    Returns
+    -------
+    str
+        path to the unix socket
+    """
+    if os.environ.get("PW_MGR_AGENT_SOCK"):
+        return os.environ["PW_MGR_AGENT_SOCK"]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        base = os.path.join(runtime_dir, "pw_mgr")
+    else:
+        import tempfile
+        base = os.path.join(tempfile.gettempdir(), f"pw_mgr-{os.getuid()}")
+    return os.path.join(base, "agent.sock")
+
+def _secure_dir(path: str) -> None:
+    # socket directory must be ours and closed to everybody else, otherwise
+    # another user could swap the socket out from under us
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077 or os.path.islink(path):
+        raise PermissionError(f"agent directory `{path}` must be owned by you with mode 0700")
+
+def _same_user(conn: socket.socket) -> bool:
+    # linux can tell us who is on the other end, elsewhere the 0700
+    # directory is the only gate
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    import struct
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid == os.getuid()
+
+def request(
+        op: dict,
+        sock_path: str | None = None
+    ) -> dict | None:
+    """
+    send one operation to a running agent
+
+    Parameters
+    ----------
+    op : dict
+        operation, see `Vault.apply`
+    sock_path : str | None, optional
+        agent socket, by default `socket_path()`
+
+    Returns
+    -------
+    dict | None
+        result from the agent, None if no agent is running
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    sock_path = sock_path or socket_path()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(sock_path)
+            conn.sendall(json.dumps(op).encode("utf-8") + b"\n")
+            with conn.makefile("rb") as stream:
+                line = stream.readline()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    return json.loads(line) if line else None
+
+def listen(sock_path: str | None = None) -> socket.socket:
+    """
+    create the agent socket, readable/writable by the owner only
+
+    Parameters
+    ----------
+    sock_path : str | None, optional
+        agent socket, by default `socket_path()`
+
+    Returns
+    -------
+    socket.socket
+        listening socket
+    """
+    sock_path = sock_path or socket_path()
+    _secure_dir(os.path.dirname(sock_path))
+    if request({"op": "ping"}, sock_path) is not None:
+        raise RuntimeError(f"an agent is already listening on `{sock_path}`")
+    if os.path.exists(sock_path):
+        os.remove(sock_path) # left over from an agent that died
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # socket is created owner read/write only
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(sock_path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    return server
+
+def serve(
+        vault,
+        server: socket.socket,
+        idle_timeout: float = IDLE_TIMEOUT
+    ) -> None:
+    """
+    answer requests against an unlocked vault until stopped or idle
+
+    writes go through the vault's journal as they arrive, and the vault is
+    compacted and closed when the agent exits
+
+    Parameters
+    ----------
+    vault : Vault
+        unlocked vault
+    server : socket.socket
+        socket from `listen`
+    idle_timeout : float, optional
+        seconds without a request before exiting, by default IDLE_TIMEOUT
+    """
+    sock_path = server.getsockname()
+    server.settimeout(idle_timeout)
+    running = True
+    try:
+        while running:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            with conn:
+                if not _same_user(conn):
+                    continue
+                conn.settimeout(CLIENT_TIMEOUT)
+                try:
+                    with conn.makefile("rwb") as stream:
+                        for line in stream:
+                            op = json.loads(line)
+                            if not isinstance(op, dict):
+                                # valid json but not an operation, answer and keep serving
+                                result = {"ok": False, "error": f"operation must be an object, not {type(op).__name__}"}
+                            elif op.get('op') == "stop":
+                                running = False
+                                result = {"ok": True}
+                            elif op.get('op') == "ping":
+                                result = {"ok": True}
+                            else:
+                                result = vault.apply(op)
+                            stream.write(json.dumps(result).encode("utf-8") + b"\n")
+                            stream.flush()
+                            if not running:
+                                break
+                except (OSError, ValueError):
+                    # dropped/slow client or garbage on the socket, keep serving
+                    pass
+    finally:
+        server.close()
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+        vault.save()
+        vault.close()
+
+def daemonize() -> bool:
+    """
+    fork the agent into the background, where forking isn't supported the
+    agent just runs in the foreground
+
+    Returns
+    -------
+    bool
+        True in the process that should serve, False in the parent
+    """
+    if not hasattr(os, "fork"):
+        return True
+    if os.fork():
+        return False
+    os.setsid()
+    with open(os.devnull, "r+b") as null:
+        for stream in (sys.stdin, sys.stdout, sys.stderr):
+            os.dup2(null.fileno(), stream.fileno())
+    return True
@@ -0,0 +1,119 @@
+# password reuse/strength audit for Password Manager
+#
+# one pass over the vault (decrypted in parallel chunks on big vaults, see
+# parallel.py). reuse is found by grouping credentials on a keyed hash of the
+# password instead of comparing passwords pairwise, the key is random and
+# only lives for one audit so the hashes mean nothing outside it. strength is
+# an entropy estimate in bits. the report only ever holds titles, hash
+# groups and bit counts, never a password
+
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import string
+import time
+from collections import Counter
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from breach import BreachFilter
+    from vault import Vault
+
+# passwords estimated below this many bits are reported as weak
+WEAK_BITS = 50
+
+# size of the characters a password draws from, by class. every ascii
+# character is mapped to its class letter (anything not a letter or digit
+# is a symbol), non-ascii characters count as "other"
+_CLASS_SIZES = {"l" : 26, "u" : 26, "d" : 10, "s" : 33}
+_OTHER_SIZE = 100
+_CLASSES = str.maketrans({chr(code) : "s" for code in range(128)} | {
+    char : kind
+    for kind, chars in (("l", string.ascii_lowercase), ("u", string.ascii_uppercase), ("d", string.digits))
+    for char in chars
+})
+
+def entropy_bits(password: str) -> float:
+    """
+    rough strength estimate of a password in bits
+
+    length times the bits per character of the character classes used
+    (lowercase, uppercase, digits, symbols, other), scaled down by how far
+    the Shannon entropy of the characters falls short of all of them being
+    different, which marks down repeats like `aaaaaaaa` or `abababab`
+
+    Parameters
+    ----------
+    password : str
+        password to score
+
+    Returns
+    -------
+    float
+        estimated entropy in bits
+    """
+    length = len(password)
+    if not length:
+        return 0.0
+    pool = sum(_CLASS_SIZES.get(kind, 0) for kind in set(password.translate(_CLASSES)))
+    if not password.isascii():
+        pool += _OTHER_SIZE
+    bits = length * math.log2(pool)
+    if len(set(password)) < length:
+        # only repeated characters take away from the maximum, log2(length)
+        repeats = sum(count * math.log2(count) for count in Counter(password).values() if count > 1)
+        bits *= 1 - repeats / (length * math.log2(length))
+    return bits
+
+def audit_vault(
+        vault: Vault,
+        breached: BreachFilter | None = None,
+        weak_bits: float = WEAK_BITS
+    ) -> dict:
+    """
+    find reused, weak and (with a breach filter) leaked passwords in one pass
+
+    Parameters
+    ----------
+    vault : Vault
+        opened vault
+    breached : BreachFilter | None, optional
+        leaked password filter to check against, by default None
+    weak_bits : float, optional
+        estimated bits below which a password is weak, by default WEAK_BITS
+
+    Returns
+    -------
+    dict
+        `checked` count, `reused` groups of titles (biggest first), `weak`
+        (title, bits) pairs (weakest first), `breached` titles and `seconds`
+    """
+    key = os.urandom(32)
+    start = time.perf_counter()
+    first = {}
+    reused = {}
+    weak = []
+    leaked = []
+    checked = 0
+    for title, creds in vault.items():
+        checked += 1
+        password = creds['password']
+        digest = hashlib.blake2b(password.encode("utf-8"), key=key, digest_size=16).digest()
+        if digest in first:
+            reused.setdefault(digest, [first[digest]]).append(title)
+        else:
+            first[digest] = title
+        bits = entropy_bits(password)
+        if bits < weak_bits:
+            weak.append((title, round(bits, 1)))
+        if breached is not None and password in breached:
+            leaked.append(title)
+    return {
+        "checked" : checked,
+        "reused" : sorted(reused.values(), key=len, reverse=True),
+        "weak" : sorted(weak, key=lambda item: item[1]),
+        "breached" : leaked,
+        "seconds" : time.perf_counter() - start
+    }
@@ -0,0 +1,448 @@
+# benchmark suite for Password Manager vault load/save and operation latency
+#
+# usage (from py_scripts or the app directory):
+#
+#   python benchmark.py                          all default sizes
+#   python benchmark.py --sizes 100 10000 -o bench.json
+#   python benchmark.py --scaling 200000         shard/worker scaling only
+#   python benchmark.py --codecs 100000          compression codecs only
+#   python benchmark.py --memory 1000000         bytes per credential only
+#
+# every vault size runs in its own subprocess so peak memory is per size,
+# results are printed (or written) as one JSON document for tracking
+# regressions between releases. clipboard and pwinput are stubbed so this
+# runs headless
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from datetime import datetime, timezone
+
+DEFAULT_SIZES = [100, 1_000, 10_000, 100_000, 1_000_000]
+
+# timed repetitions of each single operation
+OP_REPEATS = 200
+
+# shard counts tried by --scaling, each against 1, 2, 4, ... workers up to the core count
+SCALING_SHARDS = [1, 2, 4, 8, 16]
+
+# fraction of records changed before the "save_dirty" measurement
+SCALING_DIRTY = 0.1
+
+def stub_interactive() -> None:
+    """
+    replace pyperclip and pwinput with no-op modules so the menu code runs
+    without a clipboard or a terminal
+    """
+    clipboard = types.ModuleType("pyperclip")
+    clipboard.copy = lambda text: None
+    sys.modules['pyperclip'] = clipboard
+    prompt = types.ModuleType("pwinput")
+    prompt.pwinput = lambda prompt="", mask="*": input(prompt)
+    sys.modules['pwinput'] = prompt
+
+def synthetic_data(
+        size: int,
+        seed: int = 0
+    ) -> dict:
+    """
+    vault dictionary with `size` made up credentials
+
+    Parameters
+    ----------
+    size : int
+        number of credentials
+    seed : int, optional
+        random seed, by default 0
+
+    Returns
+    -------
+    dict
+        vault data including the USER entry
+    """
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + "!#$*&@%_"
+    data = {"USER" : {"root" : "Bench_pw1"}}
+    for i in range(size):
+        data[f"site{i:07d}.example.com"] = {
+            "username" : f"user{i}@example.com",
+            "password" : "".join(rng.choices(alphabet, k=16))
+        }
+    return data
+
+def stats(samples: list[float]) -> dict:
+    """
+    mean/p50/p99/max of latency samples, in microseconds
+    """
+    from timing import percentile
+
+    ordered = sorted(samples)
+    return {
+        "mean_us" : sum(ordered) / len(ordered) * 1e6,
+        "p50_us" : percentile(ordered, 0.50) * 1e6,
+        "p99_us" : percentile(ordered, 0.99) * 1e6,
+        "max_us" : ordered[-1] * 1e6
+    }
+
+def run_menu(
+        vault,
+        inputs: list[str]
+    ) -> float:
+    """
+    drive `handle_client` with scripted input, output is discarded
+
+    Returns
+    -------
+    float
+        seconds taken
+    """
+    import builtins
+    from passmgmt import handle_client
+    feed = iter(inputs + ["x"])
+    real_input = builtins.input
+    builtins.input = lambda prompt="": next(feed)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            handle_client(vault)
+            return time.perf_counter() - start
+    finally:
+        builtins.input = real_input
+
+def bench_size(
+        size: int,
+        workdir: str
+    ) -> dict:
+    """
+    measure one vault size, meant to run in a fresh process
+
+    Parameters
+    ----------
+    size : int
+        number of credentials
+    workdir : str
+        scratch directory for vault files
+
+    Returns
+    -------
+    dict
+        timings for this size
+    """
+    stub_interactive()
+    from bulkio import peak_memory_mb
+    from cryptography.fernet import Fernet
+    from passmgmt import dump_json, read_json
+    from vault import Vault
+    from vaultfile import LazyVault, create_vault
+
+    fernet = Fernet(Fernet.generate_key())
+    data = synthetic_data(size)
+    result = {"size" : size}
+    vault_path = os.path.join(workdir, f"bench_{size}.vault")
+    legacy_path = os.path.join(workdir, f"bench_{size}.json")
+
+    # serialize + encrypt + write
+    start = time.perf_counter()
+    create_vault(vault_path, data, fernet)
+    result['save_full_s'] = time.perf_counter() - start
+    result['vault_bytes'] = os.path.getsize(vault_path)
+
+    start = time.perf_counter()
+    dump_json(legacy_path, data, True, fernet)
+    result['legacy_save_s'] = time.perf_counter() - start
+    result['legacy_bytes'] = os.path.getsize(legacy_path)
+
+    # decrypt + parse
+    start = time.perf_counter()
+    read_json(legacy_path, True, fernet)
+    result['legacy_load_s'] = time.perf_counter() - start
+    del data
+
+    start = time.perf_counter()
+    lazy = LazyVault(vault_path, fernet)
+    result['open_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    for title in lazy:
+        lazy.peek(title)
+    result['load_all_s'] = time.perf_counter() - start
+    lazy.close()
+
+    # per operation latency through the menu, each op gets its own session
+    vault = Vault.open(vault_path, fernet)
+    titles = vault.list()
+    rng = random.Random(size)
+    samples = {"add" : [], "copy" : [], "edit" : [], "remove" : [], "list" : []}
+    for i in range(OP_REPEATS):
+        title = rng.choice(titles)
+        new_title = f"bench-new-{i}"
+        samples['add'].append(run_menu(vault, ["a", new_title, "user", "pw", ""]))
+        samples['copy'].append(run_menu(vault, ["c", title]))
+        samples['edit'].append(run_menu(vault, ["e", new_title, "user2", "pw2", ""]))
+        samples['remove'].append(run_menu(vault, ["r", new_title, "y"]))
+    # listing pages through every title, so fewer repetitions
+    for _ in range(max(1, OP_REPEATS // 20)):
+        samples['list'].append(run_menu(vault, ["v"] + [""] * (len(titles) // 25 + 1)))
+    result['ops'] = {name : stats(times) for name, times in samples.items()}
+
+    # compaction after a session that touched a handful of records
+    start = time.perf_counter()
+    vault.save()
+    result['save_compact_s'] = time.perf_counter() - start
+    vault.close()
+
+    result['peak_memory_mb'] = peak_memory_mb()
+    return result
+
+def bench_scaling(
+        size: int,
+        workdir: str
+    ) -> list[dict]:
+    """
+    measure how sharding and the encryption process pool scale across cores
+
+    Parameters
+    ----------
+    size : int
+        number of credentials
+    workdir : str
+        scratch directory for vault files
+
+    Returns
+    -------
+    list[dict]
+        timings per (shards, workers) combination
+    """
+    import parallel
+    from cryptography.fernet import Fernet
+    from vault import Vault
+    from vaultfile import create_vault
+
+    fernet = Fernet(Fernet.generate_key())
+    data = synthetic_data(size)
+    titles = [title for title in data if title != "USER"]
+    changed = random.Random(size).sample(titles, int(len(titles) * SCALING_DIRTY))
+    cores = os.cpu_count() or 1
+    worker_counts = sorted({1, cores} | {2 ** i for i in range(1, cores.bit_length()) if 2 ** i <= cores})
+
+    results = []
+    for shards in SCALING_SHARDS:
+        for workers in worker_counts:
+            parallel.WORKERS = workers
+            vault_path = os.path.join(workdir, f"scaling_{shards}_{workers}.vault")
+            result = {"shards" : shards, "workers" : workers}
+
+            start = time.perf_counter()
+            create_vault(vault_path, data, fernet)
+            result['save_full_s'] = time.perf_counter() - start
+
+            # splitting copies ciphertext, opening only reads each shard's header and trailer
+            start = time.perf_counter()
+            Vault.open(vault_path, fernet, shards=shards).close()
+            result['reshard_s'] = time.perf_counter() - start
+            start = time.perf_counter()
+            vault = Vault.open(vault_path, fernet, shards=shards)
+            result['open_s'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in vault.items():
+                pass
+            result['load_all_s'] = time.perf_counter() - start
+
+            with vault.batch():
+                for title in changed:
+                    vault.edit(title, "changed", "changed")
+                start = time.perf_counter()
+            result['save_dirty_s'] = time.perf_counter() - start
+
+            # one change only rewrites the shard it landed in
+            vault.edit(changed[0], "again", "again")
+            start = time.perf_counter()
+            vault.save()
+            result['save_one_s'] = time.perf_counter() - start
+            vault.close()
+            results.append(result)
+            print(f"  {shards} shards, {workers} workers done", file=sys.stderr)
+    return results
+
+def bench_codecs(
+        size: int,
+        workdir: str
+    ) -> list[dict]:
+    """
+    compare vault size and write/read time for every available codec
+
+    Parameters
+    ----------
+    size : int
+        number of credentials
+    workdir : str
+        scratch directory for vault files
+
+    Returns
+    -------
+    list[dict]
+        size and timings per codec
+    """
+    from codec import available
+    from cryptography.fernet import Fernet
+    from passmgmt import dump_json, read_json
+    from vault import Vault
+    from vaultfile import create_vault
+
+    fernet = Fernet(Fernet.generate_key())
+    data = synthetic_data(size)
+    results = []
+    for name in available():
+        result = {"codec" : name}
+        vault_path = os.path.join(workdir, f"codec_{name}.vault")
+        start = time.perf_counter()
+        create_vault(vault_path, data, fernet, name)
+        result['write_s'] = time.perf_counter() - start
+        result['vault_bytes'] = os.path.getsize(vault_path)
+
+        start = time.perf_counter()
+        vault = Vault.open(vault_path, fernet, codec=name)
+        for _ in vault.items():
+            pass
+        result['read_s'] = time.perf_counter() - start
+        vault.close()
+
+        # single token format, the whole vault compressed in one go
+        legacy_path = os.path.join(workdir, f"codec_{name}.json")
+        start = time.perf_counter()
+        dump_json(legacy_path, data, True, fernet, name)
+        result['legacy_write_s'] = time.perf_counter() - start
+        result['legacy_bytes'] = os.path.getsize(legacy_path)
+        start = time.perf_counter()
+        read_json(legacy_path, True, fernet)
+        result['legacy_read_s'] = time.perf_counter() - start
+        results.append(result)
+        print(f"  {name} done", file=sys.stderr)
+    return results
+
+def bench_memory(
+        size: int,
+        workdir: str
+    ) -> dict:
+    """
+    bytes held per credential, the decrypted dict-of-dicts vault the app
+    used to keep against Credential objects and an opened LazyVault
+
+    Parameters
+    ----------
+    size : int
+        number of credentials
+    workdir : str
+        scratch directory for vault files
+
+    Returns
+    -------
+    dict
+        bytes per credential for each representation
+    """
+    from credential import Credential
+    from cryptography.fernet import Fernet
+    from vaultfile import LazyVault, create_vault
+
+    fernet = Fernet(Fernet.generate_key())
+    as_json = json.dumps(synthetic_data(size))
+    vault_path = os.path.join(workdir, "memory.vault")
+    create_vault(vault_path, json.loads(as_json), fernet)
+    result = {"size" : size}
+
+    def per_entry(build) -> float:
+        # memory still allocated by what `build` returns, divided per credential
+        tracemalloc.start()
+        kept = build()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+        return round(used / size, 1)
+
+    result['dict_bytes'] = per_entry(lambda: json.loads(as_json))
+    result['credential_bytes'] = per_entry(
+        lambda: {title : Credential.wrap(value) for title, value in json.loads(as_json).items()}
+    )
+    del as_json
+
+    result['lazy_open_bytes'] = per_entry(lambda: LazyVault(vault_path, fernet))
+
+    def load_all() -> LazyVault:
+        lazy = LazyVault(vault_path, fernet)
+        for title in lazy:
+            lazy[title]
+        return lazy
+    result['lazy_loaded_bytes'] = per_entry(load_all)
+    return result
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="benchmark vault load/save and operation latency")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="vault sizes to test")
+    parser.add_argument("-o", "--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--scaling", type=int, metavar="SIZE", help="only measure shard/worker scaling for a vault of SIZE")
+    parser.add_argument("--codecs", type=int, metavar="SIZE", help="only compare compression codecs for a vault of SIZE")
+    parser.add_argument("--memory", type=int, metavar="SIZE", help="only measure bytes held per credential for a vault of SIZE")
+    parser.add_argument("--one", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # child process, measure a single size and hand the result back
+    if args.one is not None:
+        print(json.dumps(bench_size(args.one, args.workdir)))
+        return 0
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    report = {
+        "timestamp" : datetime.now(timezone.utc).isoformat(),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "cpu_count" : os.cpu_count(),
+        "results" : []
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.scaling is not None:
+            print(f"measuring shard/worker scaling for {args.scaling} credentials", file=sys.stderr)
+            report['scaling'] = bench_scaling(args.scaling, workdir)
+            args.sizes = []
+        if args.codecs is not None:
+            print(f"comparing codecs for {args.codecs} credentials", file=sys.stderr)
+            report['codecs'] = bench_codecs(args.codecs, workdir)
+            args.sizes = []
+        if args.memory is not None:
+            print(f"measuring memory for {args.memory} credentials", file=sys.stderr)
+            report['memory'] = bench_memory(args.memory, workdir)
+            args.sizes = []
+        for size in args.sizes:
+            print(f"benchmarking {size} credentials", file=sys.stderr)
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--one", str(size), "--workdir", workdir],
+                cwd=here,
+                capture_output=True,
+                text=True
+            )
+            if proc.returncode != 0:
+                print(proc.stderr, file=sys.stderr)
+                return proc.returncode
+            report['results'].append(json.loads(proc.stdout))
+
+    as_json = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(as_json)
+    else:
+        print(as_json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
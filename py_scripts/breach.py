@@ -0,0 +1,204 @@
+# offline breached-password check for Password Manager
+#
+# a leaked password hash list (a Have I Been Pwned style SHA-1 dump, one
+# `HASH[:count]` per line, tens of GB) is compiled once into a Bloom filter:
+#
+#   PMBLOOM {"version": 1, "bits": m, "hashes": k, "count": n} <padding>\n   4096 byte plaintext header
+#   <m / 8 bytes of filter bits>
+#
+# the file is memory-mapped, so a lookup touches `k` bytes (a few page faults
+# on a cold cache) instead of scanning the list. SHA-1 output is uniformly
+# distributed already, so the bit positions come straight from the digest by
+# double hashing. a Bloom filter never misses a listed password but flags
+# about FP_RATE of unlisted ones, so a hit is reported as "appears in", not
+# "is" breached. nothing is sent anywhere
+
+import hashlib
+import json
+import math
+import mmap
+import os
+
+MAGIC = b"PMBLOOM "
+VERSION = 1
+
+# header is padded to a page so the filter bits start page aligned
+HEADER_LEN = 4096
+
+# chance an unlisted password is flagged anyway, ~14.4 bits per listed hash
+FP_RATE = 0.001
+
+# shortest line a dump can hold (40 hex digits and a newline), used to size
+# the filter from the file size when the hash count isn't given
+MIN_LINE = 41
+
+_MASK_64 = (1 << 64) - 1
+
+def password_hash(password: str) -> bytes:
+    """
+    SHA-1 digest of a password, the hash the leaked lists use
+    """
+    return hashlib.sha1(password.encode("utf-8")).digest()
+
+def _positions(
+        digest: bytes,
+        bits: int,
+        hashes: int
+    ) -> list[int]:
+    first = int.from_bytes(digest[:8], "big")
+    step = int.from_bytes(digest[8:16], "big") | 1
+    return [(first + i * step) % bits for i in range(hashes)]
+
+class BreachFilter:
+    """
+    read-only, memory-mapped view of a compiled breach filter
+
+    Parameters
+    ----------
+    filepath : str
+        location of filter file
+    """
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        with open(filepath, "rb") as file:
+            header = file.read(HEADER_LEN)
+            assert header.startswith(MAGIC), f"`{filepath}` is not a breach filter"
+            self.header = json.loads(header[len(MAGIC):].rstrip(b" \n"))
+            assert self.header['version'] <= VERSION, f"`{filepath}` was written by a newer version of Password Manager"
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.bits = self.header['bits']
+        self.hashes = self.header['hashes']
+
+    def __len__(self) -> int:
+        return self.header['count']
+
+    def contains_hash(self, digest: bytes) -> bool:
+        """
+        check a SHA-1 digest against the filter
+
+        Parameters
+        ----------
+        digest : bytes
+            20 byte SHA-1 digest
+
+        Returns
+        -------
+        bool
+            True if the hash is (probably) in the leaked list
+        """
+        bitmap = self._map
+        for position in _positions(digest, self.bits, self.hashes):
+            if not bitmap[HEADER_LEN + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __contains__(self, password: str) -> bool:
+        return self.contains_hash(password_hash(password))
+
+    def close(self) -> None:
+        self._map.close()
+
+def open_filter(filepath: str | None) -> BreachFilter | None:
+    """
+    open the breach filter named in meta.json, if there is one
+
+    Parameters
+    ----------
+    filepath : str | None
+        location of filter file, empty/None if none was compiled
+
+    Returns
+    -------
+    BreachFilter | None
+        opened filter, None if not set up or missing
+    """
+    if not filepath:
+        return None
+    try:
+        return BreachFilter(filepath)
+    except (OSError, AssertionError, ValueError) as err:
+        print(f"breached-password check off, unable to open `{filepath}`: {err}")
+        return None
+
+def compile_filter(
+        source: str,
+        filepath: str,
+        fp_rate: float = FP_RATE,
+        expected: int | None = None,
+        progress_every: int = 10_000_000
+    ) -> dict:
+    """
+    compile a leaked SHA-1 hash list into a Bloom filter file in one pass
+
+    the bits are set straight in a memory-mapped file (the page cache holds
+    them, not the python heap) written next to `filepath` and renamed over
+    it once complete
+
+    Parameters
+    ----------
+    source : str
+        hash list, one hex SHA-1 per line with an optional `:count`
+    filepath : str
+        location of filter file
+    fp_rate : float, optional
+        false positive rate to size the filter for, by default FP_RATE
+    expected : int | None, optional
+        number of hashes in the list, by default estimated from its size
+    progress_every : int, optional
+        hashes between progress lines, by default 10 million
+
+    Returns
+    -------
+    dict
+        hashes added, lines skipped, filter size and time taken
+    """
+    import time
+
+    expected = expected or max(1, os.path.getsize(source) // MIN_LINE)
+    bits = math.ceil(-expected * math.log(fp_rate) / math.log(2) ** 2)
+    bits += -bits % 8
+    hashes = max(1, round(bits / expected * math.log(2)))
+
+    start = time.perf_counter()
+    count = skipped = 0
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "w+b") as out:
+        # sparse on most filesystems, pages are only allocated as bits get set
+        out.truncate(HEADER_LEN + bits // 8)
+        bitmap = mmap.mmap(out.fileno(), 0)
+        with open(source, "rb") as hashes_file:
+            for line in hashes_file:
+                # hundreds of millions of lines, so `_positions` is inlined
+                # and the digest is parsed straight into an int
+                line = line[:40]
+                try:
+                    value = int(line, 16)
+                except ValueError:
+                    skipped += 1
+                    continue
+                if len(line) != 40:
+                    skipped += 1
+                    continue
+                position = value >> 96
+                step = (value >> 32) & _MASK_64 | 1
+                for _ in range(hashes):
+                    bit = position % bits
+                    bitmap[HEADER_LEN + (bit >> 3)] |= 1 << (bit & 7)
+                    position += step
+                count += 1
+                if count % progress_every == 0:
+                    print(f"  {count:,} hashes added ({count / (time.perf_counter() - start):,.0f}/s)")
+
+        header_info = {"version": VERSION, "bits": bits, "hashes": hashes, "count": count}
+        header = MAGIC + json.dumps(header_info).encode("utf-8")
+        bitmap[:HEADER_LEN] = header.ljust(HEADER_LEN - 1, b" ") + b"\n"
+        bitmap.flush()
+        bitmap.close()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, filepath)
+    return {
+        "hashes" : count,
+        "skipped" : skipped,
+        "bytes" : HEADER_LEN + bits // 8,
+        "seconds" : time.perf_counter() - start
+    }
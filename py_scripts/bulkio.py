@@ -0,0 +1,260 @@
+# streaming bulk import/export of credentials (CSV or JSON Lines)
+#
+# records move through in fixed size chunks, imports are encrypted chunk by
+# chunk (on the process pool, see parallel.py) straight into the new vault
+# file and exports decrypt chunk by chunk, so neither the source text nor the
+# full decrypted vault sit in memory
+
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from collections.abc import Iterable, Iterator
+from vault import RESERVED_TITLE, Vault
+from vaultfile import encrypt_records
+
+# records encrypted/written per chunk
+CHUNK_SIZE = 1000
+
+# columns used for CSV files
+FIELDS = ["title", "username", "password"]
+
+# skipped rows listed individually in the report, the rest are only counted
+MAX_PROBLEMS = 100
+
+def peak_memory_mb() -> float | None:
+    """
+    peak resident memory of this process
+
+    Returns
+    -------
+    float | None
+        peak memory in MB, None where it can't be measured (windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB, macOS reports bytes
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+def guess_format(filepath: str) -> str:
+    """
+    pick `csv` or `jsonl` from a file extension
+
+    Parameters
+    ----------
+    filepath : str
+        location of file
+
+    Returns
+    -------
+    str
+        `csv` or `jsonl`
+    """
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext == ".csv":
+        return "csv"
+    elif ext in {".jsonl", ".ndjson", ".json"}:
+        return "jsonl"
+    raise ValueError(f"can't tell the format of `{filepath}`, use .csv or .jsonl")
+
+def read_rows(
+        filepath: str,
+        fmt: str
+    ) -> Iterator[tuple[int, dict | None]]:
+    """
+    stream rows from a CSV (with a title,username,password header) or
+    JSON Lines file
+
+    Parameters
+    ----------
+    filepath : str
+        location of source file
+    fmt : str
+        `csv` or `jsonl`
+
+    Returns
+    -------
+    Iterator[tuple[int, dict | None]]
+        line number and row, one at a time, the row is None for a JSON Lines
+        line that isn't valid JSON
+    """
+    with open(filepath, "r", newline="", encoding="utf-8") as file:
+        if fmt == "csv":
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_num, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_num, json.loads(line)
+                except json.JSONDecodeError:
+                    yield line_num, None
+
+def chunked(
+        rows: Iterable,
+        size: int
+    ) -> Iterator[list]:
+    """
+    group an iterable into lists of at most `size` items
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def import_file(
+        vault: Vault,
+        filepath: str,
+        fmt: str | None = None,
+        chunk_size: int = CHUNK_SIZE
+    ) -> dict:
+    """
+    add every credential in a CSV/JSON Lines file to the vault
+
+    rows with a missing/reserved title, missing or non-string fields or a
+    title that is already taken (in the vault or earlier in the file) are
+    skipped and reported by line number, secrets are never echoed back
+
+    Parameters
+    ----------
+    vault : Vault
+        vault to import into
+    filepath : str
+        location of source file
+    fmt : str | None, optional
+        `csv` or `jsonl`, by default guessed from the extension
+    chunk_size : int, optional
+        records encrypted per chunk, by default CHUNK_SIZE
+
+    Returns
+    -------
+    dict
+        counts of imported/skipped records, problems, seconds, records/s
+        and peak memory
+    """
+    fmt = fmt or guess_format(filepath)
+    seen = set()
+    stats = {"imported" : 0, "skipped" : 0, "problems" : []}
+
+    def valid_rows() -> Iterator[dict]:
+        # line numbers count the csv header as line 1
+        for line_num, row in read_rows(filepath, fmt):
+            title = row.get('title') if isinstance(row, dict) else None
+            problem = None
+            if row is None:
+                problem = "not valid JSON"
+            elif not isinstance(row, dict):
+                problem = "not a JSON object"
+            elif not title:
+                problem = "missing title"
+            elif not isinstance(title, str):
+                problem = "title is not a string"
+            elif title == RESERVED_TITLE:
+                problem = f"`{RESERVED_TITLE}` is an invalid title"
+            elif title in seen:
+                problem = f"duplicate title `{title}`"
+            elif row.get('username') is None or row.get('password') is None:
+                problem = f"missing username/password for `{title}`"
+            elif not isinstance(row['username'], str) or not isinstance(row['password'], str):
+                # json lines can hold any value, csv fields are always strings
+                problem = f"username/password for `{title}` is not a string"
+            if problem:
+                stats['skipped'] += 1
+                if len(stats['problems']) < MAX_PROBLEMS:
+                    stats['problems'].append(f"line {line_num}: {problem}")
+                continue
+            seen.add(title)
+            yield row
+
+    def tokens() -> Iterator[tuple[str, bytes, int]]:
+        records = (
+            (row['title'], {"username" : row['username'], "password" : row['password']})
+            for row in valid_rows()
+        )
+        # encryption runs a few chunks ahead of the writer, tee holds the gap
+        titles, to_encrypt = itertools.tee(records)
+        for (title, _), token in zip(titles, encrypt_records(to_encrypt, vault.data.fernet, vault.data.codec, chunk_size)):
+            stats['imported'] += 1
+            yield title, token, 1
+
+    start = time.perf_counter()
+    # hold the writer lock so no other process adds a title between the
+    # duplicate check and the save
+    with vault.data.locked(exclusive=True):
+        seen.update(vault.data)
+        vault.data.save(tokens())
+    stats['seconds'] = time.perf_counter() - start
+    stats['records_per_s'] = stats['imported'] / stats['seconds'] if stats['seconds'] else 0.0
+    stats['peak_memory_mb'] = peak_memory_mb()
+    return stats
+
+def export_file(
+        vault: Vault,
+        filepath: str,
+        fmt: str | None = None,
+        chunk_size: int = CHUNK_SIZE,
+        overwrite: bool = False
+    ) -> dict:
+    """
+    write every credential in the vault to a plaintext CSV/JSON Lines file
+
+    Parameters
+    ----------
+    vault : Vault
+        vault to export from
+    filepath : str
+        location of output file
+    fmt : str | None, optional
+        `csv` or `jsonl`, by default guessed from the extension
+    chunk_size : int, optional
+        records written per chunk, by default CHUNK_SIZE
+    overwrite : bool, optional
+        replace the file if it exists, by default False
+
+    Returns
+    -------
+    dict
+        count of exported records, seconds, records/s and peak memory
+
+    Raises
+    ------
+    FileExistsError
+        if the file exists and `overwrite` isn't set
+    """
+    fmt = fmt or guess_format(filepath)
+    stats = {"exported" : 0}
+    start = time.perf_counter()
+    if overwrite and os.path.exists(filepath):
+        # removed rather than truncated, so the new file gets its own mode
+        os.remove(filepath)
+    # plaintext passwords, readable by the owner only from the start
+    fd = os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    with os.fdopen(fd, "w", newline="", encoding="utf-8") as file:
+        if fmt == "csv":
+            writer = csv.DictWriter(file, FIELDS)
+            writer.writeheader()
+        for chunk in chunked(vault.items(), chunk_size):
+            rows = [
+                {"title" : title, "username" : creds['username'], "password" : creds['password']}
+                for title, creds in chunk
+            ]
+            if fmt == "csv":
+                writer.writerows(rows)
+            else:
+                file.writelines(json.dumps(row) + "\n" for row in rows)
+            stats['exported'] += len(rows)
+    stats['seconds'] = time.perf_counter() - start
+    stats['records_per_s'] = stats['exported'] / stats['seconds'] if stats['seconds'] else 0.0
+    stats['peak_memory_mb'] = peak_memory_mb()
+    return stats
@@ -0,0 +1,72 @@
+# cold start budget for the one-shot commands in main.py
+#
+# run from the app (or py_scripts) directory: `python check_startup.py`
+# exits non-zero if importing main.py takes longer than the budget or pulls
+# in any of the heavy modules the one-shot path is supposed to defer
+
+import os
+import subprocess
+import sys
+
+# cumulative import time allowed for `import main`, in milliseconds (measured
+# around 33 ms for the deferred-import layout, with cryptography it was ~70 ms)
+IMPORT_BUDGET_MS = 40.0
+
+# modules that must not be imported until a command actually needs them
+DEFERRED = ["cryptography", "pwinput", "pyperclip", "vault", "vaultfile", "codec", "credential", "bulkio", "history"]
+
+# runs per measurement, the fastest one is kept to filter out noise
+RUNS = 5
+
+def measure_import() -> tuple[float, set[str]]:
+    """
+    import main.py in a fresh interpreter with `-X importtime`
+
+    Returns
+    -------
+    tuple[float, set[str]]
+        cumulative import time of main in ms, top-level modules imported
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=here,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    main_ms = None
+    modules = set()
+    # lines look like `import time:  self [us] | cumulative | imported package`
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        modules.add(name.split(".")[0])
+        if name == "main":
+            main_ms = int(cumulative) / 1000
+    return main_ms, modules
+
+def main() -> int:
+    timings = []
+    for _ in range(RUNS):
+        main_ms, modules = measure_import()
+        timings.append(main_ms)
+    best = min(timings)
+    loaded = sorted(set(DEFERRED) & modules)
+
+    print(f"import main: {best:.1f} ms (budget {IMPORT_BUDGET_MS:.1f} ms, best of {RUNS})")
+    failed = False
+    if best > IMPORT_BUDGET_MS:
+        print("FAIL: cold start is over budget")
+        failed = True
+    if loaded:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(loaded)}")
+        failed = True
+    if not failed:
+        print("ok")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# compression applied before encryption in Password Manager vaults
+#
+# compressed plaintext starts with a one byte tag naming the codec, plain
+# JSON always starts with `[` or `{` so untagged data is uncompressed. every
+# record carries its own tag, records copied over as ciphertext during a
+# compaction stay readable whatever codec the vault is set to now
+#
+#   \x01   zlib, raw deflate primed with RECORD_DICT
+#   \x02   lzma, raw LZMA2 stream
+#   \x03   zstd, primed with RECORD_DICT (needs the optional zstandard package)
+
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# codec used for new vault files and records
+DEFAULT_CODEC = "zlib"
+
+_TAGS = {"zlib" : b"\x01", "lzma" : b"\x02", "zstd" : b"\x03"}
+_NAMES = {tag[0] : name for name, tag in _TAGS.items()}
+
+# fragments found in almost every record, so even a ~100 byte record has
+# something to back-reference. part of the on-disk format, never change it
+RECORD_DICT = (
+    b'https://www..org.net.io@outlook.com@hotmail.com@yahoo.com@icloud.com'
+    b'@gmail.comloginaccount.com", {"username": "", "password": ""}]["'
+)
+
+# raw streams carry no settings, so these are part of the format too. a small
+# window keeps setting up the encoder for every ~100 byte record cheap
+_LZMA_FILTERS = [{"id" : lzma.FILTER_LZMA2, "preset" : 6, "dict_size" : 2 ** 16}]
+
+_zstd_cache = None
+
+def _zstd_dict():
+    global _zstd_cache
+    if _zstd_cache is None:
+        _zstd_cache = zstandard.ZstdCompressionDict(RECORD_DICT, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    return _zstd_cache
+
+def available() -> list[str]:
+    """
+    codecs usable on this machine
+
+    Returns
+    -------
+    list[str]
+        codec names, `none` first
+    """
+    return ["none", "zlib", "lzma"] + (["zstd"] if zstandard is not None else [])
+
+def check(codec: str) -> str:
+    """
+    make sure a codec can be used for writing
+
+    Parameters
+    ----------
+    codec : str
+        codec name
+
+    Returns
+    -------
+    str
+        the codec name
+
+    Raises
+    ------
+    ValueError
+        if the codec is unknown or its package isn't installed
+    """
+    if codec not in available():
+        raise ValueError(f"unknown or unavailable codec `{codec}`, choose from {', '.join(available())}")
+    return codec
+
+def pack(
+        data: bytes,
+        codec: str
+    ) -> bytes:
+    """
+    compress plaintext and tag it with the codec used
+
+    Parameters
+    ----------
+    data : bytes
+        plaintext
+    codec : str
+        codec name, `none` leaves the data as is
+
+    Returns
+    -------
+    bytes
+        tagged compressed data
+    """
+    if codec == "none":
+        return data
+    if codec == "zlib":
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=RECORD_DICT)
+        packed = compressor.compress(data) + compressor.flush()
+    elif codec == "lzma":
+        packed = lzma.compress(data, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+    else:
+        check(codec)
+        packed = zstandard.ZstdCompressor(dict_data=_zstd_dict()).compress(data)
+    return _TAGS[codec] + packed
+
+def unpack(data: bytes) -> bytes:
+    """
+    undo `pack`, whichever codec (if any) was used
+
+    Parameters
+    ----------
+    data : bytes
+        tagged compressed data or plain JSON
+
+    Returns
+    -------
+    bytes
+        plaintext
+
+    Raises
+    ------
+    ValueError
+        if the data was compressed with a codec that isn't available
+    """
+    codec = _NAMES.get(data[:1][0]) if data else None
+    if codec is None:
+        return data
+    if codec == "zlib":
+        decompressor = zlib.decompressobj(-15, zdict=RECORD_DICT)
+        return decompressor.decompress(data[1:]) + decompressor.flush()
+    if codec == "lzma":
+        return lzma.decompress(data[1:], format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+    if zstandard is None:
+        raise ValueError("data is zstd compressed, install the zstandard package to read it")
+    return zstandard.ZstdDecompressor(dict_data=_zstd_dict()).decompress(data[1:])
@@ -0,0 +1,115 @@
+# compact in-memory credentials for Password Manager
+#
+# a username/password pair is kept in one mutable bytearray instead of a
+# dict of two str, so it costs a fraction of the memory and the secret can be
+# overwritten once it's no longer needed. wiping is best effort: the str
+# values handed out by `username`/`password` (to print or copy them) and
+# whatever the JSON parser allocated while decrypting are ordinary immutable
+# objects python frees (but doesn't zero) on its own schedule
+
+from __future__ import annotations
+
+FIELDS = ("username", "password")
+
+class Credential:
+    """
+    username and password stored in a single zeroable buffer
+
+    works wherever the old `{"username": ..., "password": ...}` dictionaries
+    were read (`creds['password']`, `{**creds}`), `to_dict` converts back for
+    JSON
+
+    Parameters
+    ----------
+    username : str
+        username for the credentials
+    password : str
+        password for the credentials
+    """
+    __slots__ = ("_buffer", "_split")
+
+    def __init__(
+            self,
+            username: str,
+            password: str
+        ) -> None:
+        self._buffer = bytearray(username, "utf-8")
+        self._split = len(self._buffer)
+        self._buffer += password.encode("utf-8")
+
+    @classmethod
+    def wrap(cls, value: dict) -> Credential | dict:
+        """
+        turn a decrypted `{"username": ..., "password": ...}` dictionary into
+        a Credential, anything else (the `USER` entry) is returned as is
+
+        Parameters
+        ----------
+        value : dict
+            decrypted record data
+
+        Returns
+        -------
+        Credential | dict
+            compact credentials, or the value unchanged
+        """
+        if isinstance(value, dict) and value.keys() == set(FIELDS):
+            return cls(value['username'], value['password'])
+        return value
+
+    @property
+    def username(self) -> str:
+        return self._buffer[:self._split].decode("utf-8")
+
+    @property
+    def password(self) -> str:
+        return self._buffer[self._split:].decode("utf-8")
+
+    def wipe(self) -> None:
+        """
+        overwrite the username and password with zeros and drop them
+        """
+        self._buffer[:] = bytes(len(self._buffer))
+        self._buffer.clear()
+        self._split = 0
+
+    def to_dict(self) -> dict:
+        return {"username" : self.username, "password" : self.password}
+
+    def keys(self) -> tuple[str, str]:
+        return FIELDS
+
+    def __getitem__(self, field: str) -> str:
+        if field == "username":
+            return self.username
+        if field == "password":
+            return self.password
+        raise KeyError(field)
+
+    def get(self, field: str, default: str | None = None) -> str | None:
+        return self[field] if field in FIELDS else default
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __len__(self) -> int:
+        return len(FIELDS)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Credential):
+            return self._split == other._split and self._buffer == other._buffer
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        # never show the password, e.g. in a traceback
+        return f"Credential(username={self.username!r}, password=<hidden>)"
+
+def to_json(value: object) -> dict:
+    """
+    `default` hook for `json.dumps`, serializes Credentials as dictionaries
+    """
+    if isinstance(value, Credential):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,305 @@
+# encrypted save history for Password Manager
+#
+# every time a vault file is rewritten (saved/compacted) the records that
+# changed go into a numbered snapshot in `<vault>.history/`, so any earlier
+# state of the vault can be rebuilt. most snapshots are deltas holding just
+# the records changed and the titles removed since the one before, every
+# CHECKPOINT_EVERY-th is a checkpoint holding every record. rebuilding a
+# state reads the checkpoint at or before it and the deltas in between, at
+# most CHECKPOINT_EVERY files however long the history gets. layout of a
+# snapshot file:
+#
+#   PMSNAP {"version": 1, "number": 7, "kind": "delta", "time": ..., "changed": 2, "removed": 1}\n   plaintext header
+#   <Fernet token>\n                  encrypted manifest {"titles": [[title, version], ...], "removed": [title, ...]}
+#   <Fernet token>\n                  record token of each title in the manifest, in order
+#   ...
+#
+# record tokens are copied from the vault file as they are, nothing is
+# decrypted or re-encrypted to take a snapshot. files are named
+# `<number>.<kind>.snap`, written aside and renamed into place. the last
+# HISTORY_KEEP snapshots (plus any younger than HISTORY_DAYS days, if set)
+# are kept, older ones are deleted a whole checkpoint chain at a time so
+# every kept snapshot can still be rebuilt. with HISTORY_KEEP below
+# CHECKPOINT_EVERY a checkpoint is taken every HISTORY_KEEP snapshots
+# instead, so no more than 2 * HISTORY_KEEP - 1 (plus the HISTORY_DAYS ones)
+# are left on disk
+
+import json
+import os
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from cryptography.fernet import Fernet, MultiFernet
+from vaultfile import rotate_records
+
+MAGIC = b"PMSNAP "
+VERSION = 1
+SUFFIX = ".snap"
+
+# snapshots kept by default, see `History`
+HISTORY_KEEP = 50
+
+# snapshots from one checkpoint to the next
+CHECKPOINT_EVERY = 20
+
+class History:
+    """
+    snapshot history of one vault (all of its shards)
+
+    Parameters
+    ----------
+    dirpath : str
+        directory the snapshots are kept in, created on the first snapshot
+    fernet : Fernet
+        Fernet encryption object of the vault
+    keep : int, optional
+        number of most recent snapshots kept, by default HISTORY_KEEP
+    days : float, optional
+        snapshots younger than this many days are kept too, by default 0 (off)
+    checkpoint_every : int, optional
+        snapshots from one checkpoint to the next, by default CHECKPOINT_EVERY,
+        lowered to `keep` if that's smaller
+    """
+    def __init__(
+            self,
+            dirpath: str,
+            fernet: Fernet,
+            keep: int = HISTORY_KEEP,
+            days: float = 0,
+            checkpoint_every: int = CHECKPOINT_EVERY
+        ) -> None:
+        self.dirpath = dirpath
+        self.fernet = fernet
+        self.keep = max(1, keep)
+        self.days = days
+        self.checkpoint_every = max(1, checkpoint_every)
+        # every record as stored, for checkpoints, set by `open_store`
+        self.source: Callable[[], Iterable[tuple[str, bytes, int]]] | None = None
+        # shards compact in parallel threads, their changes are gathered here
+        # while a `batch` is open and written as one snapshot
+        self._lock = threading.Lock()
+        self._pending = None
+
+    def _files(self) -> list[tuple[int, str, str]]:
+        # (number, kind, path) of every snapshot, oldest first
+        try:
+            names = os.listdir(self.dirpath)
+        except FileNotFoundError:
+            return []
+        files = []
+        for name in names:
+            number, _, kind = name.removesuffix(SUFFIX).partition(".")
+            if name.endswith(SUFFIX) and number.isdigit():
+                files.append((int(number), kind, os.path.join(self.dirpath, name)))
+        return sorted(files)
+
+    def _header(self, path: str) -> dict:
+        with open(path, "rb") as file:
+            line = file.readline()
+        assert line.startswith(MAGIC), f"`{path}` is not a vault snapshot"
+        header = json.loads(line[len(MAGIC):])
+        assert header['version'] <= VERSION, f"`{path}` was written by a newer version of Password Manager"
+        return header
+
+    def __len__(self) -> int:
+        return len(self._files())
+
+    def snapshots(self) -> list[dict]:
+        """
+        headers of the kept snapshots, oldest first
+
+        Returns
+        -------
+        list[dict]
+            `number`, `kind` (full/delta), `time` (epoch seconds), `changed`
+            and `removed` record counts and file size in `bytes`
+        """
+        return [
+            self._header(path) | {"bytes" : os.path.getsize(path)}
+            for _, _, path in self._files()
+        ]
+
+    def start(self) -> None:
+        """
+        take a checkpoint of the vault as it is if there are no snapshots
+        yet, so the state from before the first save can be restored, must
+        be called with the vault lock held
+        """
+        if not self._files():
+            self._write([], [])
+
+    @contextmanager
+    def batch(self) -> Iterator["History"]:
+        """
+        gather every snapshot recorded in a `with` block (one per shard
+        compacted) into a single one, written when the block ends
+        """
+        with self._lock:
+            self._pending = ([], [])
+        try:
+            yield self
+        finally:
+            with self._lock:
+                records, removed = self._pending
+                self._pending = None
+            if records or removed:
+                self._write(records, removed)
+
+    def record(
+            self,
+            records: list[tuple[str, bytes, int]],
+            removed: Iterable[str]
+        ) -> None:
+        """
+        take a snapshot of a save, must be called with the vault lock held
+        and the new vault file in place
+
+        Parameters
+        ----------
+        records : list[tuple[str, bytes, int]]
+            (title, encrypted record token, record version) of every record
+            added or changed
+        removed : Iterable[str]
+            titles removed (a title removed and added back is in both)
+        """
+        removed = list(removed)
+        with self._lock:
+            if self._pending is not None:
+                self._pending[0].extend(records)
+                self._pending[1].extend(removed)
+                return
+        if records or removed:
+            self._write(records, removed)
+
+    def _write(
+            self,
+            records: list[tuple[str, bytes, int]],
+            removed: list[str]
+        ) -> None:
+        files = self._files()
+        number = files[-1][0] + 1 if files else 1
+        last_full = next((file[0] for file in reversed(files) if file[1] == "full"), None)
+        kind = "delta"
+        # with fewer snapshots kept than a checkpoint chain is long, pruning
+        # could never drop a whole chain, so checkpoints come every `keep`
+        if last_full is None or number - last_full >= min(self.checkpoint_every, self.keep):
+            kind = "full"
+            records = list(self.source())
+            removed = []
+
+        manifest = {"titles" : [[title, version] for title, _, version in records], "removed" : removed}
+        header = {
+            "version" : VERSION,
+            "number" : number,
+            "kind" : kind,
+            "time" : round(time.time(), 3),
+            "changed" : len(records),
+            "removed" : len(removed)
+        }
+        os.makedirs(self.dirpath, exist_ok=True)
+        path = os.path.join(self.dirpath, f"{number:08d}.{kind}{SUFFIX}")
+        lines = (token for _, token, _ in records)
+        self._write_file(path, header, self.fernet.encrypt(json.dumps(manifest).encode("utf-8")), lines)
+        self._prune(files + [(number, kind, path)])
+
+    def _write_file(
+            self,
+            path: str,
+            header: dict,
+            manifest: bytes,
+            tokens: Iterable[bytes]
+        ) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(MAGIC + json.dumps(header).encode("utf-8") + b"\n")
+            file.write(manifest + b"\n")
+            for token in tokens:
+                file.write(token + b"\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    def _prune(self, files: list[tuple[int, str, str]]) -> None:
+        # oldest snapshot that has to stay, then everything before the
+        # checkpoint it's rebuilt from can go
+        oldest = max(0, len(files) - self.keep)
+        if self.days:
+            cutoff = time.time() - self.days * 86400
+            for position in range(oldest):
+                if self._header(files[position][2])['time'] >= cutoff:
+                    oldest = position
+                    break
+        start = next((position for position in range(oldest, -1, -1) if files[position][1] == "full"), 0)
+        for _, _, path in files[:start]:
+            os.remove(path)
+
+    def _read(self, path: str) -> tuple[dict, dict, Iterator[bytes]]:
+        # header, manifest and the record tokens (read lazily) of a snapshot
+        file = open(path, "rb")
+        header = json.loads(file.readline()[len(MAGIC):])
+        manifest = json.loads(self.fernet.decrypt(file.readline().rstrip(b"\n")))
+
+        def tokens() -> Iterator[bytes]:
+            with file:
+                for line in file:
+                    yield line.rstrip(b"\n")
+
+        return header, manifest, tokens()
+
+    def state(self, number: int) -> dict[str, tuple[bytes, int]]:
+        """
+        rebuild the vault as it was when a snapshot was taken, reading its
+        checkpoint and the deltas after it
+
+        Parameters
+        ----------
+        number : int
+            snapshot number
+
+        Returns
+        -------
+        dict[str, tuple[bytes, int]]
+            title -> (encrypted record token, record version), in vault order
+
+        Raises
+        ------
+        KeyError
+            if there is no such snapshot (never taken or pruned)
+        """
+        files = self._files()
+        position = next((position for position, file in enumerate(files) if file[0] == number), None)
+        if position is None:
+            raise KeyError(number)
+        start = next((start for start in range(position, -1, -1) if files[start][1] == "full"), None)
+        if start is None:
+            raise KeyError(number)
+
+        state = {}
+        for _, kind, path in files[start:position + 1]:
+            _, manifest, tokens = self._read(path)
+            if kind == "full":
+                state.clear()
+            for title in manifest['removed']:
+                state.pop(title, None)
+            for (title, version), token in zip(manifest['titles'], tokens):
+                state[title] = (token, version)
+        return state
+
+    def rotate(self) -> int:
+        """
+        re-encrypt every snapshot under the first key of the MultiFernet
+        the history was opened with
+
+        Returns
+        -------
+        int
+            number of snapshots re-encrypted
+        """
+        assert isinstance(self.fernet, MultiFernet), "history can only be rotated with a MultiFernet"
+        files = self._files()
+        for _, _, path in files:
+            header, manifest, tokens = self._read(path)
+            manifest = self.fernet.encrypt(json.dumps(manifest).encode("utf-8"))
+            self._write_file(path, header, manifest, rotate_records(tokens, self.fernet))
+        return len(files)
@@ -1,9 +1,27 @@
 # This file is the engine for installing all required files to run the Password Manager App
+#
+# works on Windows, Linux and macOS:
+#
+#   python py_scripts/install.py [app_dir] [--wheelhouse DIR] [--offline]
+#
+# running it again on an installed app directory upgrades it in place and
+# only redoes what changed. app files are copied when their hash differs
+# from the one recorded in the app's install.json, the venv is only rebuilt
+# for a different python and packages are only installed when
+# requirements.txt changed. packages always install from a local wheelhouse
+# (shared by every install on the machine), pip only goes to the network to
+# add wheels the wheelhouse is missing, so repeat installs work offline
 
+import argparse
+import hashlib
+import json
 import os
 import shutil
 import subprocess
+import sys
 import time
+from collections.abc import Iterator
+from contextlib import contextmanager
 
 # all files required to run app
 APP_FILES = [
@@ -11,24 +29,259 @@ APP_FILES = [
     "py_scripts/main.py",
     "json_files/mgr.json",
     "py_scripts/passmgmt.py",
+    "py_scripts/codec.py",
+    "py_scripts/credential.py",
+    "py_scripts/parallel.py",
+    "py_scripts/vaultfile.py",
+    "py_scripts/shards.py",
+    "py_scripts/journal.py",
+    "py_scripts/locking.py",
+    "py_scripts/vault.py",
+    "py_scripts/kdf.py",
+    "py_scripts/titleindex.py",
+    "py_scripts/timing.py",
+    "py_scripts/bulkio.py",
+    "py_scripts/breach.py",
+    "py_scripts/audit.py",
+    "py_scripts/sync.py",
+    "py_scripts/history.py",
+    "py_scripts/agent.py",
     "requirements.txt",
     "py_scripts/make_shortcut.py"
 ]
 
-# windows .bat script to launch app once installed 
+# app files the app changes itself after the first run, an upgrade leaves them be
+USER_FILES = ["mgr.json"]
+
+# what was installed (file hashes, python, requirements hash), kept in the app directory
+STAMP_FILE = "install.json"
+
+WINDOWS = os.name == "nt"
+
+# repo the installer runs from, app files are copied out of it
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# wheels of the required packages, shared by every install on the machine
+WHEELHOUSE = os.path.join(
+    os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "pw_mgr",
+    "wheelhouse"
+)
+
+# windows .bat script to launch app once installed
 STARTUP_SCRIPT = r"""
 @echo off
 app_venv\Scripts\python main.py
 """
 
-def main():
-    print("Welcome to the Password Manager setup wizard\n")
+# linux/macOS equivalent, arguments are passed on to main.py (e.g. `copy <title>`)
+STARTUP_SH = """#!/bin/sh
+cd "$(dirname "$0")" && exec app_venv/bin/python main.py "$@"
+"""
+
+def file_hash(filepath: str) -> str:
+    """
+    sha256 hex digest of a file's contents
+    """
+    with open(filepath, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def venv_python(app_dir: str) -> str:
+    """
+    python executable of the app's venv
+    """
+    if WINDOWS:
+        return os.path.join(app_dir, "app_venv", "Scripts", "python.exe")
+    return os.path.join(app_dir, "app_venv", "bin", "python")
+
+def is_install(app_dir: str) -> bool:
+    """
+    check if a directory already holds an install of the app (to upgrade)
+    """
+    return any(os.path.isfile(os.path.join(app_dir, name)) for name in (STAMP_FILE, "main.py"))
+
+def read_stamp(app_dir: str) -> dict:
+    try:
+        with open(os.path.join(app_dir, STAMP_FILE), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"files" : {}}
+
+def write_stamp(
+        app_dir: str,
+        stamp: dict
+    ) -> None:
+    # written after every step, so a failed install redoes only what's left
+    tmp_path = os.path.join(app_dir, STAMP_FILE + ".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(stamp, file, indent=4)
+    os.replace(tmp_path, os.path.join(app_dir, STAMP_FILE))
+
+@contextmanager
+def step(
+        name: str,
+        report: list
+    ) -> Iterator[None]:
+    """
+    time one install step, (name, seconds) is added to `report`
+    """
+    print(f"\n{name}")
+    start = time.perf_counter()
+    yield
+    report.append((name, time.perf_counter() - start))
+
+def copy_files(
+        app_dir: str,
+        stamp: dict
+    ) -> int:
+    """
+    copy the app files that are missing or changed since the last install
+
+    Parameters
+    ----------
+    app_dir : str
+        app directory
+    stamp : dict
+        install state, updated with the new file hashes
+
+    Returns
+    -------
+    int
+        number of files copied
+    """
+    copied = 0
+    for file in APP_FILES:
+        file_only = file.split("/")[-1]
+        end_path = os.path.join(app_dir, file_only)
+        if os.path.exists(end_path) and file_only in USER_FILES:
+            continue
+        digest = file_hash(os.path.join(REPO_DIR, file))
+        if os.path.exists(end_path) and stamp['files'].get(file_only) == digest:
+            continue
+        shutil.copy(os.path.join(REPO_DIR, file), end_path)
+        stamp['files'][file_only] = digest
+        copied += 1
+    return copied
+
+def make_venv(
+        app_dir: str,
+        stamp: dict
+    ) -> bool:
+    """
+    build the app's venv, unless there is one for this python already
+
+    Returns
+    -------
+    bool
+        True if the venv was (re)built
+    """
+    if os.path.isfile(venv_python(app_dir)) and stamp.get('python') == sys.version:
+        return False
+    subprocess.check_call([sys.executable, "-m", "venv", "--clear", os.path.join(app_dir, "app_venv")])
+    stamp['python'] = sys.version
+    # a new venv has no packages
+    stamp.pop('requirements', None)
+    return True
+
+def install_packages(
+        app_dir: str,
+        stamp: dict,
+        wheelhouse: str,
+        offline: bool = False
+    ) -> bool:
+    """
+    install the required packages into the venv from the wheelhouse, adding
+    any wheels it's missing first (the only step that needs the network)
 
+    Parameters
+    ----------
+    app_dir : str
+        app directory
+    stamp : dict
+        install state
+    wheelhouse : str
+        local wheel cache
+    offline : bool, optional
+        fail instead of downloading missing wheels, by default False
+
+    Returns
+    -------
+    bool
+        True if packages were installed, False if requirements.txt is unchanged
+    """
+    requirements = os.path.join(app_dir, "requirements.txt")
+    digest = file_hash(requirements)
+    if stamp.get('requirements') == digest:
+        return False
+
+    os.makedirs(wheelhouse, exist_ok=True)
+    pip = [venv_python(app_dir), "-m", "pip", "-q", "--disable-pip-version-check"]
+    install = pip + ["install", "--no-index", "--find-links", wheelhouse, "-r", requirements]
+    if subprocess.call(install, stderr=subprocess.DEVNULL) != 0:
+        if offline:
+            raise RuntimeError(f"wheelhouse `{wheelhouse}` is missing packages and --offline was given")
+        print(f"adding missing wheels to `{wheelhouse}`")
+        subprocess.check_call(pip + ["wheel", "--find-links", wheelhouse, "--wheel-dir", wheelhouse, "-r", requirements])
+        subprocess.check_call(install)
+    stamp['requirements'] = digest
+    return True
+
+def write_launcher(app_dir: str) -> str:
+    """
+    write the script that starts the app, returns its path
+    """
+    name, script = ("startup.bat", STARTUP_SCRIPT) if WINDOWS else ("pw_mgr.sh", STARTUP_SH)
+    launcher = os.path.join(app_dir, name)
+    with open(launcher, "w") as file:
+        file.write(script)
+    if not WINDOWS:
+        os.chmod(launcher, 0o755)
+    return launcher
+
+def make_shortcut(app_dir: str) -> str:
+    """
+    make a desktop shortcut to startup.bat (windows only)
+    """
+    while True:
+        # file title
+        shortcut_title = input("\nwhat would you like to name the shortcut to start the app?  ")
+
+        # depending on version of windows, might have OneDrive folder
+        onedrive = os.path.isdir(os.path.join(os.path.expanduser("~"), "OneDrive"))
+        desktop_path = "Desktop" if not onedrive else r"OneDrive\Desktop"
+
+        # make path
+        shortcut_path = os.path.join(
+            os.path.expanduser("~"),
+            desktop_path,
+            f"{shortcut_title}.lnk"
+        )
+
+        # don't let user try and make a new file with a taken name
+        if os.path.isfile(shortcut_path):
+            print(f"file already located at {shortcut_path}, choose a different name")
+        else:
+            # build shortcut to launch startup.bat on click
+            subprocess.check_call(
+                [
+                    venv_python(app_dir),
+                    os.path.join(app_dir, "make_shortcut.py"),
+                    shortcut_path,
+                    app_dir
+                ]
+            )
+            return shortcut_path
+
+def ask_app_dir() -> str:
+    """
+    ask where to put the app, an existing install is offered for upgrade
+    """
     # app files will be stored in user's personal folder
-    prefix = rf"C:\Users\{os.getlogin()}"
+    prefix = os.path.expanduser("~")
     dir_input = input(f"""
     Where would you like to store the app's files? (enter `d` for default)
-    (default is `.pw_mgr` and parent directory will be `{prefix}`)  
+    (default is `.pw_mgr` and parent directory will be `{prefix}`)
+    an existing install is upgraded in place
     """)
 
     # validate input directory name is workable
@@ -37,83 +290,91 @@ def main():
             app_dir = os.path.join(prefix, ".pw_mgr")
         else:
             app_dir = os.path.join(prefix, dir_input)
+        if os.path.isdir(app_dir) and is_install(app_dir):
+            return app_dir
         if os.path.isdir(app_dir):
             dir_input = input(f"directory `{app_dir}` already exists, please choose another name:  ")
         else:
             try:
                 os.mkdir(app_dir)
-                break
-            except:
+                return app_dir
+            except OSError:
                 dir_input = input(f"""
                 `{app_dir}` not a valid directory path
                 enter a new path or `d` for the default  """)
 
-    # copy files over into new directory
-    print("\nbuilding app directory")
-    for file in APP_FILES:
-        file_only = file.split("/")[-1]
-        end_path = os.path.join(app_dir, file_only)
-        shutil.copy(file, end_path)
+def main():
+    parser = argparse.ArgumentParser(description="install or upgrade Password Manager")
+    parser.add_argument("app_dir", nargs="?", help="app directory, asked for if not given (an existing install is upgraded)")
+    parser.add_argument("--wheelhouse", default=WHEELHOUSE, help=f"local wheel cache, by default `{WHEELHOUSE}`")
+    parser.add_argument("--offline", action="store_true", help="only install from the wheelhouse, never download")
+    args = parser.parse_args()
 
-    # do the installs 
-    os.chdir(app_dir)
-    print("\ninstalling packages")
+    print("Welcome to the Password Manager setup wizard\n")
+    if args.app_dir is None:
+        app_dir = ask_app_dir()
+    else:
+        app_dir = os.path.abspath(os.path.expanduser(args.app_dir))
+        if os.path.isdir(app_dir) and os.listdir(app_dir) and not is_install(app_dir):
+            print(f"`{app_dir}` isn't empty and doesn't hold an install of the app, choose another directory")
+            sys.exit(1)
+        os.makedirs(app_dir, exist_ok=True)
+
+    stamp = read_stamp(app_dir)
+    upgrade = bool(stamp['files']) or is_install(app_dir)
+    print(f"{'upgrading' if upgrade else 'installing'} in `{app_dir}`")
+    report = []
+    start = time.perf_counter()
 
     # error check for running subprocess
     try:
-        # make python venv for the app
-        subprocess.check_call("python -m venv app_venv", shell=True)
-
-        # use pip to install required libraries into new venv
-        pip_exe = r"app_venv\Scripts\pip"
-        subprocess.check_call([pip_exe, "-q", "install", "-r", "requirements.txt"])
-
-        # make .bat file to run app
-        with open("startup.bat", "w") as file:
-            file.write(STARTUP_SCRIPT)
-
-        # make desktop shortcut
-        while True:
-            # file title
-            shortcut_title = input("\nwhat would you like to name the shortcut to start the app?  ")
-
-            # depending on version of windows, might have OneDrive folder
-            onedrive = os.path.isdir(rf"C:\Users\{os.getlogin()}\OneDrive")
-            desktop_path = "Desktop" if not onedrive else r"OneDrive\Desktop"
-
-            # make path
-            shortcut_path = os.path.join(
-                rf"C:\Users\{os.getlogin()}",
-                desktop_path,
-                f"{shortcut_title}.lnk"
-            )
-            
-            # don't let user try and make a new file with a taken name
-            if os.path.isfile(shortcut_path):
-                print(f"file already located at {shortcut_path}, choose a different name")
-            else:
-                # build shortcut to launch startup.bat on click
-                subprocess.check_call(
-                    [
-                        "app_venv/Scripts/python", 
-                        "make_shortcut.py", 
-                        shortcut_path, 
-                        app_dir
-                    ]
-                )
-                break
-
-        print(f"\nshortcut saved at {shortcut_path}")
+        with step("copying app files", report):
+            copied = copy_files(app_dir, stamp)
+            write_stamp(app_dir, stamp)
+            print(f"  {copied} of {len(APP_FILES)} changed")
+
+        with step("building venv", report):
+            built = make_venv(app_dir, stamp)
+            write_stamp(app_dir, stamp)
+            print("  built" if built else "  up to date")
+
+        with step("installing packages", report):
+            installed = install_packages(app_dir, stamp, args.wheelhouse, args.offline)
+            write_stamp(app_dir, stamp)
+            print(f"  installed from `{args.wheelhouse}`" if installed else "  requirements.txt unchanged, skipped")
+
+        with step("writing launcher", report):
+            launcher = write_launcher(app_dir)
+            print(f"  {launcher}")
+
+        # desktop shortcut, only made once
+        if WINDOWS and 'shortcut' not in stamp:
+            with step("making shortcut", report):
+                stamp['shortcut'] = make_shortcut(app_dir)
+                write_stamp(app_dir, stamp)
+                print(f"\nshortcut saved at {stamp['shortcut']}")
+    except (OSError, RuntimeError, subprocess.CalledProcessError) as err:
+        print(f"\nexperienced error attempting to build app environment: {err}")
+        if WINDOWS:
+            print("ensure you are running this install from a User account with")
+            print("admin privileges and that your anti-virus software permits")
+            print("subprocess calls from within python scripts")
+        print("run the install again to pick up where it stopped")
+        if WINDOWS:
+            time.sleep(20)
         print("exiting...")
+        sys.exit(1)
+
+    print(f"\n{'step':<24}{'seconds':>8}")
+    for name, seconds in report:
+        print(f"{name:<24}{seconds:>8.2f}")
+    print(f"{'total':<24}{time.perf_counter() - start:>8.2f}")
+    if not WINDOWS:
+        print(f"\nstart the app with `{launcher}`")
+    print("exiting...")
+    if WINDOWS:
         time.sleep(5)
-    except:
-        print("\nexperienced error attempting to build app environment")
-        print("ensure you are running this install from a User account with")
-        print("admin privileges and that your anti-virus software permits")
-        print("subprocess calls from within python scripts")
-        time.sleep(20)
-        print("exiting...")
     return
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,121 @@
+# append-only change journal for Password Manager vaults
+#
+# every add/edit/remove is written as one encrypted line the moment it
+# happens, so a session that dies before exit can be recovered by
+# replaying the journal on top of the last compacted vault file. several
+# processes share one journal, each remembers how far into it it has read
+# and picks up the others' entries on its next sync
+
+import json
+import os
+import timing
+from collections.abc import Iterator
+from credential import to_json
+from cryptography.fernet import Fernet, InvalidToken
+
+# number of journal entries before they get folded back into the vault
+COMPACT_AFTER = 256
+
+class Journal:
+    """
+    encrypted append-only journal stored next to a vault file
+
+    Parameters
+    ----------
+    filepath : str
+        location of journal file
+    fernet : Fernet
+        Fernet encryption object
+    """
+    def __init__(
+            self,
+            filepath: str,
+            fernet: Fernet
+        ) -> None:
+        self.filepath = filepath
+        self.fernet = fernet
+        self.count = 0
+        self.offset = 0
+
+    def replay(self) -> Iterator[tuple[str, str, dict | None, int]]:
+        """
+        read back every complete entry written since the last replay
+
+        a crash mid-append can leave a partial last line, that entry was
+        never acknowledged so reading stops there (the next append cuts it off)
+
+        Returns
+        -------
+        Iterator[tuple[str, str, dict | None, int]]
+            (operation, title, credential data, record version) per entry
+        """
+        if not os.path.isfile(self.filepath):
+            return
+        with open(self.filepath, "rb") as file:
+            file.seek(self.offset)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(self.fernet.decrypt(line.rstrip(b"\n")).decode("utf-8"))
+                except InvalidToken:
+                    break
+                self.offset += len(line)
+                self.count += 1
+                # entries from before record versions have no 4th field
+                yield entry[0], entry[1], entry[2], entry[3] if len(entry) > 3 else 1
+
+    def append(
+            self,
+            op: str,
+            title: str,
+            value: dict | None = None,
+            version: int = 1
+        ) -> None:
+        """
+        durably write one change to the journal, the caller must hold the
+        vault's exclusive lock and have replayed the journal first
+
+        Parameters
+        ----------
+        op : str
+            `set` or `del`
+        title : str
+            title of the credential
+        value : dict | None, optional
+            credential data for `set`, by default None
+        version : int, optional
+            record version after the change, by default 1
+        """
+        token = self.fernet.encrypt(json.dumps([op, title, value, version], default=to_json).encode("utf-8"))
+        # opened per append so no process keeps a handle that would stop
+        # another one from removing the journal after compacting
+        with timing.span("journal_append"), open(self.filepath, "ab") as file:
+            # drop a torn tail left by a crashed writer
+            if file.tell() != self.offset:
+                file.truncate(self.offset)
+            file.write(token + b"\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.offset += len(token) + 1
+        self.count += 1
+
+    def reset(self) -> None:
+        """
+        forget how far the journal has been read, used after another
+        process compacted it away
+        """
+        self.offset = 0
+        self.count = 0
+
+    def clear(self) -> None:
+        """
+        drop all entries, called once they are compacted into the vault
+        """
+        if os.path.isfile(self.filepath):
+            os.remove(self.filepath)
+        self.reset()
+
+    def close(self) -> None:
+        # nothing is held open between appends
+        pass
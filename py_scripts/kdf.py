@@ -0,0 +1,167 @@
+# master password key derivation for Password Manager
+#
+# the vault's Fernet key is random and stored wrapped (encrypted) under a key
+# derived from the master password with scrypt (PBKDF2 where the linked
+# OpenSSL has no scrypt). derivation cost is calibrated to the machine so an
+# unlock takes about TARGET_MS, and is raised again when hardware gets faster
+
+import base64
+import hashlib
+import os
+import time
+from cryptography.fernet import Fernet, InvalidToken
+
+# how long deriving the key on unlock should take, in milliseconds
+TARGET_MS = 250
+
+# scrypt memory grows with n, past this n the cost is raised through p instead
+MAX_SCRYPT_N = 2 ** 17
+SCRYPT_R = 8
+
+# derivations faster than this fraction of the target get recalibrated
+REHASH_BELOW = 0.5
+
+def derive_key(
+        password: str,
+        params: dict
+    ) -> bytes:
+    """
+    derive a Fernet key from the master password
+
+    Parameters
+    ----------
+    password : str
+        master password
+    params : dict
+        KDF parameters from `calibrate`
+
+    Returns
+    -------
+    bytes
+        URL-safe base64-encoded 32-byte key
+    """
+    salt = base64.b64decode(params['salt'])
+    if params['algorithm'] == "scrypt":
+        raw = hashlib.scrypt(
+            password.encode("utf-8"),
+            salt=salt,
+            n=params['n'],
+            r=params['r'],
+            p=params['p'],
+            maxmem=256 * params['r'] * params['n'] + 2 ** 20,
+            dklen=32
+        )
+    else:
+        raw = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, params['iterations'], 32)
+    return base64.urlsafe_b64encode(raw)
+
+def _time_derive(params: dict) -> float:
+    start = time.perf_counter()
+    derive_key("calibration", params)
+    return time.perf_counter() - start
+
+def calibrate(target_ms: float = TARGET_MS) -> dict:
+    """
+    pick KDF parameters that take about `target_ms` on this machine
+
+    Parameters
+    ----------
+    target_ms : float, optional
+        wanted derivation time in milliseconds, by default TARGET_MS
+
+    Returns
+    -------
+    dict
+        KDF parameters, with a fresh salt
+    """
+    target = target_ms / 1000
+    salt = base64.b64encode(os.urandom(16)).decode("ascii")
+    if hasattr(hashlib, "scrypt"):
+        params = {"algorithm" : "scrypt", "n" : 2 ** 14, "r" : SCRYPT_R, "p" : 1, "salt" : salt}
+        elapsed = _time_derive(params)
+        # double memory cost while we can, then add parallel passes
+        while elapsed < target and params['n'] < MAX_SCRYPT_N:
+            params['n'] *= 2
+            elapsed = _time_derive(params)
+        if elapsed < target:
+            params['p'] = max(1, round(target / elapsed))
+    else:
+        params = {"algorithm" : "pbkdf2", "iterations" : 100_000, "salt" : salt}
+        elapsed = _time_derive(params)
+        params['iterations'] = max(100_000, int(params['iterations'] * target / elapsed))
+    params['target_ms'] = target_ms
+    return params
+
+def wrap_key(
+        data_key: bytes,
+        password: str,
+        params: dict
+    ) -> bytes:
+    """
+    encrypt the vault key under the master password
+
+    Parameters
+    ----------
+    data_key : bytes
+        vault Fernet key
+    password : str
+        master password
+    params : dict
+        KDF parameters
+
+    Returns
+    -------
+    bytes
+        wrapped key, safe to write to disk
+    """
+    return Fernet(derive_key(password, params)).encrypt(data_key)
+
+def unwrap_key(
+        wrapped: bytes,
+        password: str,
+        params: dict
+    ) -> bytes | None:
+    """
+    recover the vault key with the master password
+
+    Parameters
+    ----------
+    wrapped : bytes
+        wrapped key from the key file
+    password : str
+        master password
+    params : dict
+        KDF parameters
+
+    Returns
+    -------
+    bytes | None
+        vault Fernet key, None if the password is wrong
+    """
+    try:
+        return Fernet(derive_key(password, params)).decrypt(wrapped.strip())
+    except InvalidToken:
+        return None
+
+def needs_rehash(
+        params: dict,
+        elapsed: float
+    ) -> bool:
+    """
+    whether an unlock was fast enough that the cost should be raised
+
+    Parameters
+    ----------
+    params : dict
+        KDF parameters used
+    elapsed : float
+        seconds the unlock took
+
+    Returns
+    -------
+    bool
+        True if the parameters should be recalibrated
+    """
+    if params['algorithm'] == "pbkdf2" and hasattr(hashlib, "scrypt"):
+        return True
+    return elapsed < REHASH_BELOW * params.get('target_ms', TARGET_MS) / 1000
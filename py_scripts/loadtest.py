@@ -0,0 +1,435 @@
+# load test for Password Manager with many concurrent scripted clients
+#
+# usage (from py_scripts or the app directory):
+#
+#   python loadtest.py                                    1 to 64 clients, 100 ops each
+#   python loadtest.py --clients 1,8,32 --ops 500 --records 10000 --shards 4
+#   python loadtest.py --mix get=90,add=4,edit=4,remove=1,list=1 --json load.json
+#
+# every client is a process running a whole interactive session through
+# `main.main()` (unlock, the passmgmt.py menu, the save on quit) against a
+# synthetic app directory, with `input`, `pwinput` and the clipboard replaced
+# by a script that answers each prompt for a random mix of operations:
+#
+#   get      `c` on a base credential or one of the client's own, the copied
+#            password must be the expected one
+#   add      `a` a new credential owned by the client
+#   edit     `e` one of the client's own credentials (an add if it has none)
+#   remove   `r` one of the client's own credentials (an add if it has none)
+#   list     `v` every title, all pages
+#
+# clients are let go together once all of them are unlocked. latency is the
+# time from picking an operation at the menu to the menu coming back (the
+# prompts in between are answered straight away). afterwards every client's
+# own credentials must be in the vault as it last left them, anything else
+# is counted as a lost update (and exits 1, like errors do). peak memory is
+# each client process's max RSS
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+OPS = ("get", "add", "edit", "remove", "list")
+ACTIONS = {"get" : "c", "add" : "a", "edit" : "e", "remove" : "r", "list" : "v"}
+DEFAULT_MIX = "get=70,add=10,edit=10,remove=5,list=5"
+DEFAULT_CLIENTS = "1,2,4,8,16,32,64"
+PASSWORD = "Load_test_pw1"
+
+# menu output that means an operation didn't do what it was asked
+ERROR_MARKERS = ("not found", "already in database", "not removed", "invalid")
+
+# printed when an edit lost a race with another session and is retried
+CONFLICT_MARKER = "changed by another session"
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """
+    `get=70,add=10,...` -> operation weights, unknown operations are an error
+    """
+    weights = {}
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPS:
+            raise argparse.ArgumentTypeError(f"unknown operation `{op}`, pick from {', '.join(OPS)}")
+        weights[op] = float(weight)
+    return weights
+
+class Script:
+    """
+    answers the menu's prompts for one client and times its operations
+
+    Parameters
+    ----------
+    client_id : int
+        number of the client, its own titles are `c<client_id>-<n>`
+    ops : int
+        operations to run before quitting
+    weights : dict[str, float]
+        operation -> weight
+    records : int
+        base credentials in the vault, `site<i>` with password `p<i>`
+    barrier : multiprocessing.Barrier
+        waited on once unlocked, so every client starts together
+    """
+    def __init__(
+            self,
+            client_id: int,
+            ops: int,
+            weights: dict[str, float],
+            records: int,
+            barrier
+        ) -> None:
+        self.client_id = client_id
+        self.remaining = ops
+        self.weights = weights
+        self.records = records
+        self.barrier = barrier
+        self.rng = random.Random(client_id)
+        # own title -> password it should have
+        self.own = {}
+        self.added = 0
+        self.op = None
+        self.op_text = []
+        self.out = []
+        self.clipboard = None
+        self.latencies = {op : [] for op in OPS}
+        self.errors = 0
+        self.conflicts = 0
+        self.started = 0.0
+        self.op_start = 0.0
+        self.op_seconds = 0.0
+        self.quit_at = 0.0
+
+    # stands in for sys.stdout, the menu's output is only checked for errors
+    def write(self, text: str) -> int:
+        self.out.append(text)
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    def copy(self, text: str) -> None:
+        self.clipboard = text
+
+    def _pick(self) -> tuple[str, str, str | None]:
+        # (operation, title, password expected/written)
+        op = self.rng.choices(list(self.weights), list(self.weights.values()))[0]
+        if op in ("edit", "remove") and not self.own:
+            op = "add"
+        if op == "add":
+            self.added += 1
+            title = f"c{self.client_id}-{self.added}"
+            return op, title, f"a{self.client_id}-{self.added}"
+        if op == "get":
+            if self.own and self.rng.random() < 0.5:
+                title = self.rng.choice(list(self.own))
+                return op, title, self.own[title]
+            number = self.rng.randrange(self.records)
+            return op, f"site{number}", f"p{number}"
+        if op == "list":
+            return op, "", None
+        title = self.rng.choice(list(self.own))
+        return op, title, f"e{self.client_id}-{self.remaining}"
+
+    def _finish(self) -> None:
+        # the menu is back, the last operation is done
+        seconds = time.perf_counter() - self.op_start
+        op, title, password = self.op
+        self.latencies[op].append(seconds)
+        text = "".join(self.op_text)
+        self.conflicts += text.count(CONFLICT_MARKER)
+        if any(marker in text for marker in ERROR_MARKERS):
+            self.errors += 1
+        elif op == "get" and self.clipboard != password:
+            self.errors += 1
+        elif op in ("add", "edit"):
+            self.own[title] = password
+        elif op == "remove":
+            del self.own[title]
+        self.op = None
+        self.clipboard = None
+
+    def answer(
+            self,
+            prompt: str = "",
+            mask: str = "*"
+        ) -> str:
+        self.op_text.extend(self.out)
+        self.out.clear()
+        if prompt.startswith("password"):
+            return PASSWORD
+        if "mask all passwords" in prompt:
+            # unlocked, wait for the others
+            self.barrier.wait()
+            self.started = time.perf_counter()
+            return ""
+        # asked inside an operation (checked first, the retry prompt also
+        # mentions "another action")
+        if "retry" in prompt:
+            return "n"
+        if "are you sure" in prompt:
+            return "y"
+        if "more titles" in prompt:
+            return ""
+        if "option" in prompt or "another action" in prompt:
+            if self.op is not None:
+                self._finish()
+            if self.remaining == 0:
+                self.op_seconds = time.perf_counter() - self.started
+                self.quit_at = time.perf_counter()
+                return "x"
+            self.remaining -= 1
+            self.op = self._pick()
+            self.op_text = []
+            self.op_start = time.perf_counter()
+            return ACTIONS[self.op[0]]
+        if self.op is None:
+            raise RuntimeError(f"unexpected prompt outside an operation: {prompt!r}")
+        op, title, password = self.op
+        if "title" in prompt:
+            return title
+        if "username" in prompt:
+            return f"user{self.client_id}"
+        if "password" in prompt:
+            return password
+        raise RuntimeError(f"unexpected prompt: {prompt!r}")
+
+def client(
+        app_dir: str,
+        client_id: int,
+        ops: int,
+        weights: dict[str, float],
+        records: int,
+        barrier,
+        results
+    ) -> None:
+    """
+    run one scripted session through `main.main()` and put its results on
+    the `results` queue
+    """
+    import builtins
+    import pwinput
+    import pyperclip
+    from bulkio import peak_memory_mb
+
+    os.chdir(app_dir)
+    script = Script(client_id, ops, weights, records, barrier)
+    builtins.input = script.answer
+    pwinput.pwinput = script.answer
+    pyperclip.copy = script.copy
+    stdout = sys.stdout
+    sys.stdout = script
+    start = time.perf_counter()
+    failure = None
+    try:
+        import main
+        main.main()
+    except BaseException as err:
+        failure = f"{type(err).__name__}: {err}"
+        if script.started == 0.0:
+            # never got to the barrier, don't leave the others waiting
+            barrier.abort()
+    finally:
+        sys.stdout = stdout
+    results.put({
+        "client" : client_id,
+        "failure" : failure,
+        "latencies" : script.latencies,
+        "errors" : script.errors,
+        "conflicts" : script.conflicts,
+        "own" : script.own,
+        "added" : script.added,
+        "unlock_s" : script.started - start if script.started else None,
+        "op_s" : script.op_seconds,
+        "save_s" : time.perf_counter() - script.quit_at if script.quit_at else None,
+        "peak_mb" : peak_memory_mb()
+    })
+
+def build_app(
+        app_dir: str,
+        records: int,
+        shards: int,
+        compact_after: int
+    ) -> bytes:
+    """
+    synthetic app directory (meta.json, key wrapped under PASSWORD, vault
+    with `records` base credentials), returns the vault key
+    """
+    from cryptography.fernet import Fernet
+    from kdf import calibrate, wrap_key
+    from vault import Vault
+    from vaultfile import create_vault
+
+    os.makedirs(os.path.join(app_dir, "stuff"))
+    key = Fernet.generate_key()
+    # cheapest KDF the calibration allows, so 64 unlocks don't swamp the run
+    # (a target this low is never re-tuned either, so no client spends its
+    # unlock rewrapping the key under meta.json.lock)
+    params = calibrate(1)
+    key_path = os.path.join("stuff", "key.key")
+    with open(os.path.join(app_dir, key_path), "wb") as file:
+        file.write(wrap_key(key, PASSWORD, params))
+    here = os.path.dirname(os.path.abspath(__file__))
+    config_path = os.path.join(here, "config.json")
+    if not os.path.isfile(config_path):
+        config_path = os.path.join(here, "..", "json_files", "config.json")
+    with open(config_path, "r") as file:
+        meta = json.load(file)
+    meta.update({
+        "KEY_LOCATION" : key_path,
+        "KDF" : params,
+        "DATA_LOCATION" : os.path.join(".", "data.vault"),
+        "JOURNAL_LIMIT" : compact_after,
+        "SHARDS" : shards,
+        "BREACH_FILTER" : ""
+    })
+    with open(os.path.join(app_dir, "meta.json"), "w") as file:
+        json.dump(meta, file, indent=4)
+    with open(os.path.join(app_dir, "mgr.json"), "w") as file:
+        json.dump({"INITIAL" : "False"}, file)
+
+    vault_path = os.path.join(app_dir, "data.vault")
+    data = {"USER" : {"root" : PASSWORD}}
+    data.update({f"site{i}" : {"username" : f"u{i}", "password" : f"p{i}"} for i in range(records)})
+    create_vault(vault_path, data, Fernet(key), meta['CODEC'])
+    # split into shards up front so the clients don't race to do it
+    Vault.open(vault_path, Fernet(key), compact_after, shards).close()
+    return key
+
+def check_vault(
+        app_dir: str,
+        key: bytes,
+        shards: int,
+        results: list[dict]
+    ) -> int:
+    """
+    count clients' credentials that aren't in the vault as they left them
+    """
+    from cryptography.fernet import Fernet
+    from vault import Vault
+
+    vault = Vault.open(os.path.join(app_dir, "data.vault"), Fernet(key), shards=shards)
+    lost = 0
+    try:
+        titles = set(vault.list())
+        for result in results:
+            prefix = f"c{result['client']}-"
+            for title, password in result['own'].items():
+                lost += title not in titles or vault.get(title)['password'] != password
+            # removed ones that came back
+            lost += sum(title.startswith(prefix) and title not in result['own'] for title in titles)
+    finally:
+        vault.close()
+    return lost
+
+def run_level(
+        template: str,
+        workdir: str,
+        key: bytes,
+        clients: int,
+        args: argparse.Namespace,
+        weights: dict[str, float]
+    ) -> dict:
+    """
+    run `clients` sessions at once against a fresh copy of the synthetic app
+    """
+    from timing import percentile
+
+    app_dir = os.path.join(workdir, f"app-{clients}")
+    shutil.copytree(template, app_dir)
+    barrier = multiprocessing.Barrier(clients)
+    queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=client, args=(app_dir, client_id, args.ops, weights, args.records, barrier, queue))
+        for client_id in range(clients)
+    ]
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    failures = [f"client {result['client']}: {result['failure']}" for result in results if result['failure']]
+    latencies = {op : sorted(seconds for result in results for seconds in result['latencies'][op]) for op in OPS}
+    every = sorted(seconds for times in latencies.values() for seconds in times)
+    elapsed = max(result['op_s'] for result in results) or float("nan")
+    peaks = [result['peak_mb'] for result in results if result['peak_mb'] is not None]
+    unlocks = sorted(result['unlock_s'] for result in results if result['unlock_s'])
+    summary = {
+        "clients" : clients,
+        "ops" : len(every),
+        "seconds" : elapsed,
+        "ops_per_s" : len(every) / elapsed,
+        "p50_ms" : percentile(every, 0.50) * 1000 if every else 0.0,
+        "p95_ms" : percentile(every, 0.95) * 1000 if every else 0.0,
+        "p99_ms" : percentile(every, 0.99) * 1000 if every else 0.0,
+        "max_ms" : every[-1] * 1000 if every else 0.0,
+        "by_op" : {
+            op : {"count" : len(times), "p50_ms" : percentile(times, 0.50) * 1000, "p99_ms" : percentile(times, 0.99) * 1000}
+            for op, times in latencies.items() if times
+        },
+        "errors" : sum(result['errors'] for result in results),
+        "conflicts" : sum(result['conflicts'] for result in results),
+        "lost" : check_vault(app_dir, key, args.shards, results),
+        "failures" : failures,
+        "unlock_p50_ms" : percentile(unlocks, 0.50) * 1000 if unlocks else 0.0,
+        "save_max_ms" : max((result['save_s'] or 0.0 for result in results), default=0.0) * 1000,
+        "peak_mb_client" : max(peaks, default=None),
+        "peak_mb_total" : sum(peaks) if peaks else None
+    }
+    shutil.rmtree(app_dir)
+    return summary
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="measure the app under many concurrent scripted sessions")
+    parser.add_argument("--clients", default=DEFAULT_CLIENTS, help="comma separated concurrency levels to run")
+    parser.add_argument("--ops", type=int, default=100, help="operations per client")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"operation weights, by default {DEFAULT_MIX}")
+    parser.add_argument("--records", type=int, default=1000, help="base credentials in the synthetic vault")
+    parser.add_argument("--shards", type=int, default=1, help="shards to split the vault into")
+    parser.add_argument("--compact-after", type=int, default=256, help="journal entries before compacting")
+    parser.add_argument("--json", help="also write every result to this file")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.clients.split(",")]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        template = os.path.join(workdir, "template")
+        key = build_app(template, args.records, args.shards, args.compact_after)
+        print(f"{args.records} credentials, {args.ops} ops per client, mix {args.mix}")
+        print(
+            f"{'clients':>7}{'ops/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+            f"{'errors':>8}{'confl':>7}{'lost':>6}{'unlock ms':>11}{'save ms':>9}{'MB/client':>11}{'MB total':>10}"
+        )
+        summaries = []
+        for clients in levels:
+            row = run_level(template, workdir, key, clients, args, args.mix)
+            summaries.append(row)
+            memory = (
+                f"{row['peak_mb_client']:>11.1f}{row['peak_mb_total']:>10.1f}"
+                if row['peak_mb_client'] is not None else f"{'n/a':>11}{'n/a':>10}"
+            )
+            print(
+                f"{clients:>7}{row['ops_per_s']:>9.1f}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+                f"{row['max_ms']:>9.1f}{row['errors']:>8}{row['conflicts']:>7}{row['lost']:>6}"
+                f"{row['unlock_p50_ms']:>11.1f}{row['save_max_ms']:>9.1f}{memory}"
+            )
+            for failure in row['failures']:
+                print(f"  {failure}", file=sys.stderr)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"args" : vars(args), "levels" : summaries}, file, indent=4)
+        print(f"results written to `{args.json}`")
+    if any(row['errors'] or row['lost'] or row['failures'] for row in summaries):
+        print("FAILED: operations went wrong or updates were lost", file=sys.stderr)
+        return 1
+    print("ok")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
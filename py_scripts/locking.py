@@ -0,0 +1,92 @@
+# shared/exclusive file locks for Password Manager vaults
+#
+# every process touching a vault locks `<vault>.lock`: readers take a shared
+# lock so any number of them can run side by side, writers take an exclusive
+# lock just long enough to sync, append to the journal (or compact) and let go
+
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+class VaultLock:
+    """
+    reentrant reader/writer lock on a lock file
+
+    nested acquisitions inside an exclusive lock are free, windows only has
+    exclusive byte range locks so shared locks are exclusive there
+
+    Parameters
+    ----------
+    filepath : str
+        location of the lock file (created if missing)
+    """
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        self._fd = None
+        self._depth = 0
+        self._exclusive = False
+
+    def _acquire(self, exclusive: bool) -> None:
+        if self._fd is None:
+            self._fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            while True:
+                try:
+                    msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ~10 seconds, keep waiting
+                    continue
+
+    def _release(self) -> None:
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+
+    @contextmanager
+    def hold(self, exclusive: bool = False) -> Iterator[None]:
+        """
+        hold the lock for the duration of a `with` block
+
+        Parameters
+        ----------
+        exclusive : bool, optional
+            writer (exclusive) instead of reader (shared) lock, by default False
+        """
+        if self._depth:
+            # already locked by this process, a shared lock can't be upgraded
+            # in place without letting another writer in first
+            if exclusive and not self._exclusive:
+                raise RuntimeError("can't upgrade a shared vault lock to exclusive")
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+
+        self._acquire(exclusive)
+        self._depth = 1
+        self._exclusive = exclusive
+        try:
+            yield
+        finally:
+            self._depth = 0
+            self._exclusive = False
+            self._release()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
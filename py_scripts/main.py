@@ -1,28 +1,49 @@
 # This is the main code to manage running the Password Manager App
+#
+# one-shot commands (`copy`, `list`, `get`) get run from hotkeys and scripts
+# many times a day, so the heavy imports (cryptography, pwinput, pyperclip)
+# are done inside the functions that need them instead of at module load
+
+from __future__ import annotations
 
 import json
-import re
 import os
 import stat
+import sys
 import time
-from pwinput import pwinput
-from cryptography.fernet import Fernet
-from passmgmt import WELCOME_STR, handle_client, read_json, dump_json
+import timing
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+from agent import request as agent_request
+from passmgmt import read_json, dump_json
+
+if TYPE_CHECKING:
+    from cryptography.fernet import Fernet
+    from vault import Vault
 
 def initialize():
     """
     function for creating root user/using app for first time
     """
+    import re
+    from breach import open_filter
+    from codec import DEFAULT_CODEC
+    from cryptography.fernet import Fernet
+    from pwinput import pwinput
+    from kdf import calibrate, wrap_key
+    from vaultfile import create_vault
+
     # basic config file
     with open("config.json", "r") as file:
         config = json.load(file)
+    breached = open_filter(config.get('BREACH_FILTER'))
     print("\n\ncreating root user\n")
 
-    # dict to be used for passwords
+    # dict to be used for passwords, the master password itself is never
+    # stored, it unlocks the vault key instead (see kdf.py)
     data = {
-        "USER" : {
-            "root" : ""
-        }
+        "USER" : {}
     }
     print("""
         your password must meet all of the following conditions:
@@ -61,18 +82,23 @@ def initialize():
                     please try again
                 """)
                 continue 
+            # the rules above are no help against a password from a leak
+            elif breached is not None and master_pw in breached:
+                print("that password appears in a list of breached passwords, please choose another\n")
+                continue
             else:
                 break
 
         # enter again, set root password if good
         check = pwinput("reenter your master password: ")
         if master_pw == check:
-            data['USER']['root'] = master_pw
             print("root user created\n")
             break 
         else:
             print("your two passwords didn't match, try again")
             continue
+    if breached is not None:
+        breached.close()
 
     # start building process
     print("building password manager based on config settings")
@@ -85,6 +111,11 @@ def initialize():
         key = Fernet.generate_key()
         fernet = Fernet(key)
 
+        # key is stored wrapped under the master password, the derivation cost
+        # is tuned so unlocking takes about a quarter second on this machine
+        print("tuning master password key derivation for this machine")
+        kdf_params = calibrate()
+
         # make key in app dir, notify user to change KEY_LOCATION in meta.json file
         # if desired to move
         os.mkdir("stuff")
@@ -94,33 +125,922 @@ def initialize():
         print("in the meta.json file (within the app directory)**\n")
         time.sleep(5)
         
-        # once good, save key as bytes
+        # once good, save wrapped key as bytes
         with open(key_path, "wb") as file:
-            file.write(key)
+            file.write(wrap_key(key, master_pw, kdf_params))
         # make key file read-only
         os.chmod(key_path, stat.S_IREAD)
     else:
         print(f"unknown encryption method from config file `{method}`")
         return
 
-    # data.json will contain the encrypted password information
-    data_path = os.path.join(config['DATA_LOCATION'], "data.json")
+    # data.vault will contain the encrypted password information, one record per credential
+    data_path = os.path.join(config['DATA_LOCATION'], "data.vault")
 
     # config will get saved as meta.json, useful info to run app
     config['KEY_LOCATION'] = key_path
+    config['KDF'] = kdf_params
     config['DATA_LOCATION'] = data_path 
 
     # write json meta and data files, data is encrypted
     dump_json("meta.json", config, False)
-    dump_json(data_path, data, True, fernet)
+    create_vault(data_path, data, fernet, config.get('CODEC', DEFAULT_CODEC))
     print("initialization complete\n\n")
     return
 
 
+def read_key(meta: dict) -> bytes | None:
+    """
+    read the (wrapped) vault key from the key file
+
+    Parameters
+    ----------
+    meta : dict
+        contents of meta.json
+
+    Returns
+    -------
+    bytes | None
+        key file contents, None if the key file couldn't be read
+    """
+    try:
+        with timing.span("read_key"), open(meta['KEY_LOCATION'], "rb") as file:
+            return file.read()
+    except:
+        print(f"unable to open/find key file `{meta['KEY_LOCATION']}`")
+        print("make sure file path is correct in meta.json")
+        return None
+
+@contextmanager
+def editing_meta(meta: dict) -> Iterator[dict]:
+    """
+    change meta.json under meta.json.lock, so sessions changing it at the same
+    time (a rehash, a key rotation, a migration) don't undo each other
+
+    the block gets meta.json as it is on disk now, it's written back when the
+    block exits if it was changed and `meta` is updated to match either way
+
+    Parameters
+    ----------
+    meta : dict
+        contents of meta.json as this session read them, updated in place
+
+    Returns
+    -------
+    Iterator[dict]
+        current contents of meta.json, to be changed in the block
+    """
+    from locking import VaultLock
+
+    lock = VaultLock("meta.json.lock")
+    try:
+        with lock.hold(exclusive=True):
+            current = read_json("meta.json", False)
+            before = json.dumps(current, sort_keys=True)
+            yield current
+            if json.dumps(current, sort_keys=True) != before:
+                dump_json("meta.json", current, False)
+            meta.clear()
+            meta.update(current)
+    finally:
+        lock.close()
+
+def store_key(
+        meta: dict,
+        key: bytes,
+        password: str,
+        finish_rotation: bool = False
+    ) -> bool:
+    """
+    wrap the vault key under freshly calibrated KDF parameters
+
+    the wrapped key is written to a new file next to the current one and
+    meta.json is swapped to point at it in one atomic write, so a crash at
+    any point leaves either the old or the new key file in use. sessions
+    unlocking at the same time take turns on meta.json.lock, and one that
+    finds the key already rewrapped by another just picks up its meta.json
+
+    Parameters
+    ----------
+    meta : dict
+        contents of meta.json, updated in place
+    key : bytes
+        vault Fernet key
+    password : str
+        master password
+    finish_rotation : bool, optional
+        `key` is the new key of the rotation under way, it's stored whatever
+        another session did to meta.json and ROTATION is cleared in the same
+        write, by default False
+
+    Returns
+    -------
+    bool
+        whether the key was stored, False if another session rewrapped it first
+    """
+    from kdf import TARGET_MS, calibrate, wrap_key
+
+    params = calibrate(meta.get('KDF', {}).get('target_ms', TARGET_MS))
+    with editing_meta(meta) as current:
+        if not finish_rotation and (current['KEY_LOCATION'] != meta['KEY_LOCATION'] or current.get('KDF') != meta.get('KDF')):
+            # another session rewrapped the key since meta.json was read,
+            # `meta` picks up its meta.json on the way out
+            return False
+        old_path = current['KEY_LOCATION']
+        new_path = os.path.join(os.path.dirname(old_path), f"key-{os.urandom(4).hex()}.key")
+        with open(new_path, "wb") as file:
+            file.write(wrap_key(key, password, params))
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(new_path, stat.S_IREAD)
+
+        current['KEY_LOCATION'] = new_path
+        current['KDF'] = params
+        if finish_rotation:
+            current.pop('ROTATION', None)
+    # meta.json now points at the new key file, the old one can go
+    try:
+        os.chmod(old_path, stat.S_IREAD | stat.S_IWRITE)
+        os.remove(old_path)
+    except FileNotFoundError:
+        # already removed by hand or by a session that didn't take the lock
+        pass
+    return True
+
+def start_rotation(
+        meta: dict,
+        fernet: Fernet
+    ) -> dict:
+    """
+    generate the next vault key and record the rotation in meta.json
+
+    the new key is kept encrypted under the current one until the rotation
+    is done, so unlocking with the master password gives both in the meantime
+
+    Parameters
+    ----------
+    meta : dict
+        contents of meta.json, updated in place
+    fernet : Fernet
+        Fernet encryption object for the current key
+
+    Returns
+    -------
+    dict
+        rotation info, location of the pending key and id of the rotation
+    """
+    from cryptography.fernet import Fernet
+
+    pending_path = os.path.join(os.path.dirname(meta['KEY_LOCATION']), f"rotate-{os.urandom(4).hex()}.key")
+    with open(pending_path, "wb") as file:
+        file.write(fernet.encrypt(Fernet.generate_key()))
+        file.flush()
+        os.fsync(file.fileno())
+    os.chmod(pending_path, stat.S_IREAD)
+
+    with editing_meta(meta) as current:
+        current['ROTATION'] = {"KEY_LOCATION" : pending_path, "KEY_ID" : os.urandom(8).hex()}
+    return meta['ROTATION']
+
+def read_pending_key(
+        meta: dict,
+        fernet: Fernet
+    ) -> bytes:
+    """
+    new vault key of the key rotation under way
+
+    Parameters
+    ----------
+    meta : dict
+        contents of meta.json
+    fernet : Fernet
+        Fernet encryption object for the current key
+
+    Returns
+    -------
+    bytes
+        new vault Fernet key
+    """
+    with open(meta['ROTATION']['KEY_LOCATION'], "rb") as file:
+        return fernet.decrypt(file.read())
+
+def open_vault(
+        meta: dict,
+        key: bytes,
+        history: bool = True
+    ) -> Vault:
+    """
+    open the vault described by meta.json
+
+    Parameters
+    ----------
+    meta : dict
+        contents of meta.json
+    key : bytes
+        vault Fernet key
+    history : bool, optional
+        take snapshots of saves (HISTORY_KEEP in meta.json), by default True
+
+    Returns
+    -------
+    Vault
+        opened vault
+    """
+    from codec import DEFAULT_CODEC
+    from cryptography.fernet import Fernet, MultiFernet
+    from history import HISTORY_KEEP
+    from journal import COMPACT_AFTER
+    from shards import is_sharded
+    from vault import Vault
+    from vaultfile import is_vault, migrate_legacy
+
+    # older installs keep everything in a single encrypted data.json, move it
+    # over to the per-record vault format the first time it's opened
+    fernet = Fernet(key)
+    if 'ROTATION' in meta:
+        # part way through a key rotation records may be under either key,
+        # anything written now uses the new one
+        fernet = MultiFernet([Fernet(read_pending_key(meta, fernet)), fernet])
+    codec = meta.get('CODEC', DEFAULT_CODEC)
+    if not (is_vault(meta['DATA_LOCATION']) or is_sharded(meta['DATA_LOCATION'])):
+        print("migrating data file to per-record vault format")
+        data_path = migrate_legacy(meta['DATA_LOCATION'], fernet, codec)
+        with editing_meta(meta) as current:
+            current['DATA_LOCATION'] = data_path
+
+    # nothing but the journal is decrypted here, titles are looked up through the
+    # vault file's blind index and credentials are decrypted as they're used.
+    # any changes left in the journal by an interrupted session are replayed,
+    # a changed SHARDS setting splits/merges the vault files on the way in, a
+    # changed CODEC applies to records as they're rewritten. every save
+    # leaves a snapshot in the vault's history (HISTORY_KEEP of them, 0 for none)
+    with timing.span("open_vault"):
+        return Vault.open(
+            meta['DATA_LOCATION'],
+            fernet,
+            meta.get('JOURNAL_LIMIT', COMPACT_AFTER),
+            meta.get('SHARDS', 1),
+            codec,
+            meta.get('HISTORY_KEEP', HISTORY_KEEP) if history else 0,
+            meta.get('HISTORY_DAYS', 0)
+        )
+
+def unlock_vault(
+        meta: dict,
+        stored_key: bytes,
+        password: str
+    ) -> Vault | None:
+    """
+    derive the key from the master password and open the vault, raising the
+    derivation cost if this machine got fast enough to need it
+
+    Parameters
+    ----------
+    meta : dict
+        contents of meta.json
+    stored_key : bytes
+        key file contents
+    password : str
+        master password
+
+    Returns
+    -------
+    Vault | None
+        opened vault, None if the password is wrong
+    """
+    # installs from before key derivation keep the raw key on disk and the
+    # master password in the vault, check it the old way and then upgrade
+    if 'KDF' not in meta:
+        # no snapshots until the password is out of the vault, the first
+        # checkpoint would hold it
+        vault = open_vault(meta, stored_key, history=False)
+        if password != vault.data['USER'].get('root'):
+            vault.close()
+            return None
+        print("upgrading vault to a master password derived key")
+        store_key(meta, stored_key, password)
+        vault.data['USER'] = {}
+        vault.save()
+        vault.close()
+        scrub_legacy(meta, stored_key)
+        return open_vault(meta, stored_key)
+
+    key = unlock_key(meta, stored_key, password)
+    if key is None:
+        return None
+    return open_vault(meta, key)
+
+def scrub_legacy(
+        meta: dict,
+        key: bytes
+    ) -> None:
+    """
+    remove the master password from what an install from before key
+    derivation leaves outside the vault, the data.json backup kept by the
+    migration (rewritten without it) and snapshots taken before the upgrade
+    (dropped, the next open starts the history again)
+
+    Parameters
+    ----------
+    meta : dict
+        contents of meta.json
+    key : bytes
+        vault Fernet key
+    """
+    import shutil
+    from cryptography.fernet import Fernet
+
+    backup = os.path.splitext(meta['DATA_LOCATION'])[0] + ".json.bak"
+    if os.path.exists(backup):
+        data = read_json(backup, True, Fernet(key))
+        data['USER'] = {}
+        dump_json(backup, data, True, Fernet(key))
+    shutil.rmtree(meta['DATA_LOCATION'] + ".history", ignore_errors=True)
+
+def unlock_key(
+        meta: dict,
+        stored_key: bytes,
+        password: str
+    ) -> bytes | None:
+    """
+    derive the key from the master password and unwrap the vault key,
+    raising the derivation cost if this machine got fast enough to need it
+
+    Parameters
+    ----------
+    meta : dict
+        contents of meta.json, must have KDF parameters
+    stored_key : bytes
+        key file contents
+    password : str
+        master password
+
+    Returns
+    -------
+    bytes | None
+        vault Fernet key, None if the password is wrong
+    """
+    from kdf import needs_rehash, unwrap_key
+
+    start = time.perf_counter()
+    with timing.span("kdf_unwrap"):
+        key = unwrap_key(stored_key, password, meta['KDF'])
+    if key is not None and needs_rehash(meta['KDF'], time.perf_counter() - start):
+        store_key(meta, key, password)
+    return key
+
+def unlock() -> Vault:
+    """
+    open the vault for a non-interactive command, exits on failure
+
+    the master password is read from the PW_MGR_PASSWORD environment
+    variable if set, so scripts can run without a prompt
+
+    Returns
+    -------
+    Vault
+        opened vault
+    """
+    from pwinput import pwinput
+
+    meta = read_json("meta.json", False)
+    stored_key = read_key(meta)
+    if stored_key is None:
+        sys.exit(1)
+    password = os.environ.get("PW_MGR_PASSWORD") or pwinput("password: ")
+    vault = unlock_vault(meta, stored_key, password)
+    if vault is None:
+        print("invalid password", file=sys.stderr)
+        sys.exit(1)
+    return vault
+
+def run_batch(ops_path: str) -> None:
+    """
+    apply a JSON Lines file of operations (`-` for stdin) to the vault with
+    a single persist, one JSON result per operation is printed to stdout
+
+    Parameters
+    ----------
+    ops_path : str
+        location of operations file
+    """
+    from vault import read_ops
+
+    vault = unlock()
+    start = time.perf_counter()
+    count = failed = 0
+    try:
+        with vault.batch():
+            for line_num, op in read_ops(ops_path):
+                # a malformed line fails on its own like any other bad op
+                if op is None:
+                    result = {"ok" : False, "error" : f"line {line_num}: not valid JSON"}
+                else:
+                    result = vault.apply(op)
+                count += 1
+                failed += not result['ok']
+                print(json.dumps(result))
+    finally:
+        vault.close()
+    elapsed = time.perf_counter() - start
+    print(
+        f"applied {count} operations ({failed} failed) in {elapsed:.3f}s "
+        f"({count / elapsed if elapsed else 0:.0f} ops/s)",
+        file=sys.stderr
+    )
+
+def run_import(
+        filepath: str,
+        fmt: str | None = None
+    ) -> None:
+    """
+    stream credentials from a CSV/JSON Lines file into the vault
+
+    Parameters
+    ----------
+    filepath : str
+        location of source file
+    fmt : str | None, optional
+        `csv` or `jsonl`, by default guessed from the extension
+    """
+    from bulkio import import_file
+
+    vault = unlock()
+    stats = import_file(vault, filepath, fmt)
+    vault.close()
+    for problem in stats['problems']:
+        print(f"skipped {problem}", file=sys.stderr)
+    print(
+        f"imported {stats['imported']} records ({stats['skipped']} skipped) "
+        f"in {stats['seconds']:.3f}s ({stats['records_per_s']:.0f} records/s), "
+        f"peak memory {stats['peak_memory_mb'] or 'n/a'} MB",
+        file=sys.stderr
+    )
+
+def run_export(
+        filepath: str,
+        fmt: str | None = None
+    ) -> None:
+    """
+    stream every credential in the vault out to a CSV/JSON Lines file,
+    the file holds plaintext passwords so it's created readable by the owner
+    only, and an existing file is only replaced after asking
+
+    Parameters
+    ----------
+    filepath : str
+        location of output file
+    fmt : str | None, optional
+        `csv` or `jsonl`, by default guessed from the extension
+    """
+    from bulkio import export_file
+
+    overwrite = False
+    if os.path.exists(filepath):
+        # only replaced when someone at the terminal says so, never from a script
+        if not sys.stdin.isatty() or input(f"`{filepath}` already exists, overwrite it? (y/n) ").strip().lower() != "y":
+            print(f"`{filepath}` already exists, nothing exported", file=sys.stderr)
+            sys.exit(1)
+        overwrite = True
+    vault = unlock()
+    try:
+        stats = export_file(vault, filepath, fmt, overwrite=overwrite)
+    except FileExistsError:
+        print(f"`{filepath}` already exists, nothing exported", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        vault.close()
+    print(f"**`{filepath}` contains unencrypted passwords, delete it once you're done with it**", file=sys.stderr)
+    print(
+        f"exported {stats['exported']} records in {stats['seconds']:.3f}s "
+        f"({stats['records_per_s']:.0f} records/s), "
+        f"peak memory {stats['peak_memory_mb'] or 'n/a'} MB",
+        file=sys.stderr
+    )
+
+def run_agent(action: str = "start") -> None:
+    """
+    start a background vault agent (`agent`) or stop the running one
+    (`agent stop`)
+
+    Parameters
+    ----------
+    action : str, optional
+        `start` or `stop`, by default `start`
+    """
+    import socket
+    from agent import IDLE_TIMEOUT, daemonize, listen, serve, socket_path
+
+    if action == "stop":
+        result = agent_request({"op" : "stop"})
+        print("agent stopped" if result else "no agent running")
+        return
+    if not hasattr(socket, "AF_UNIX"):
+        print("the vault agent needs unix domain sockets, not supported on this system", file=sys.stderr)
+        sys.exit(1)
+
+    vault = unlock()
+    meta = read_json("meta.json", False)
+    try:
+        server = listen()
+    except (OSError, RuntimeError) as err:
+        vault.close()
+        print(f"unable to start agent: {err}", file=sys.stderr)
+        sys.exit(1)
+    print(f"agent listening on {socket_path()}")
+    if daemonize():
+        serve(vault, server, meta.get('AGENT_TIMEOUT', IDLE_TIMEOUT))
+    else:
+        server.close()
+        vault.close()
+
+def run_rotate_key() -> None:
+    """
+    replace the vault key with a new one, re-encrypting the vault file by
+    file (shard by shard) in chunks instead of loading it into memory
+
+    until every file is re-encrypted the vault opens with both keys, so it
+    stays usable and running the command again after an interruption picks
+    up where it left off. KEY_LOCATION in meta.json is only switched to the
+    new key, in one atomic write, once the rotation is complete
+    """
+    from cryptography.fernet import Fernet
+    from kdf import unwrap_key
+    from pwinput import pwinput
+
+    meta = read_json("meta.json", False)
+    stored_key = read_key(meta)
+    if stored_key is None:
+        sys.exit(1)
+    password = os.environ.get("PW_MGR_PASSWORD") or pwinput("password: ")
+    # the agent only holds the old key, it can't read rotated files
+    if agent_request({"op" : "stop"}):
+        print("stopped the running vault agent")
+
+    if 'KDF' not in meta:
+        # old install, move to a password wrapped key first
+        vault = unlock_vault(meta, stored_key, password)
+        if vault is not None:
+            vault.close()
+            stored_key = read_key(meta)
+    key = unlock_key(meta, stored_key, password) if 'KDF' in meta else None
+    if key is None:
+        print("invalid password", file=sys.stderr)
+        sys.exit(1)
+
+    fernet = Fernet(key)
+    rotation = meta.get('ROTATION')
+    if rotation is None:
+        print("rotating vault key")
+        rotation = start_rotation(meta, fernet)
+    else:
+        print("resuming interrupted key rotation")
+    start = time.perf_counter()
+    vault = open_vault(meta, key)
+    try:
+        rotated = vault.rotate(rotation['KEY_ID'])
+    except RuntimeError as err:
+        print(f"{err}, run `rotate-key` again to finish the rotation", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        vault.close()
+
+    # every file is under the new key, wrap it under the master password and
+    # point meta.json at it, then the old key (and the pending copy) can go
+    new_key = read_pending_key(meta, fernet)
+    store_key(meta, new_key, password, finish_rotation=True)
+    # the pending copy is the only other one, keep it unless meta.json
+    # really points at the new key now
+    meta = read_json("meta.json", False)
+    stored_key = read_key(meta)
+    if stored_key is None or unwrap_key(stored_key, password, meta['KDF']) != new_key:
+        print(
+            f"`{meta['KEY_LOCATION']}` doesn't hold the new key, its pending copy "
+            f"`{rotation['KEY_LOCATION']}` (encrypted under the old key) was kept",
+            file=sys.stderr
+        )
+        sys.exit(1)
+    os.chmod(rotation['KEY_LOCATION'], stat.S_IREAD | stat.S_IWRITE)
+    os.remove(rotation['KEY_LOCATION'])
+    print(
+        f"re-encrypted {rotated} vault file{'' if rotated == 1 else 's'} in "
+        f"{time.perf_counter() - start:.2f}s, new key saved to `{meta['KEY_LOCATION']}`"
+    )
+
+def run_breach_compile(
+        source: str,
+        filepath: str = "stuff/breached.bloom",
+        expected: str | None = None
+    ) -> None:
+    """
+    compile a leaked password hash list (SHA-1, one per line) into the
+    breach filter checked on add/edit and by `breached`, and point
+    BREACH_FILTER in meta.json at it
+
+    Parameters
+    ----------
+    source : str
+        location of hash list
+    filepath : str, optional
+        location of filter file, by default "stuff/breached.bloom"
+    expected : str | None, optional
+        number of hashes in the list, by default estimated from its size
+    """
+    from breach import compile_filter
+
+    print(f"compiling `{source}` into `{filepath}`, this reads the whole list once")
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    stats = compile_filter(source, filepath, expected=int(expected) if expected else None)
+    print(
+        f"added {stats['hashes']:,} hashes ({stats['skipped']:,} lines skipped) in {stats['seconds']:.1f}s, "
+        f"filter is {stats['bytes'] / 2 ** 20:,.1f} MB"
+    )
+    if os.path.exists("meta.json"):
+        with editing_meta({}) as meta:
+            meta['BREACH_FILTER'] = filepath
+    else:
+        print(f"set BREACH_FILTER to `{filepath}` in config.json to use it")
+
+def run_breached() -> None:
+    """
+    print the title of every credential whose password appears in the
+    breach filter, passwords themselves are never printed
+    """
+    from breach import open_filter
+
+    meta = read_json("meta.json", False)
+    breached = open_filter(meta.get('BREACH_FILTER'))
+    if breached is None:
+        print("no breach filter set up, compile one with `python main.py breach-compile <hash list>`", file=sys.stderr)
+        sys.exit(1)
+    vault = unlock()
+    start = time.perf_counter()
+    checked = found = 0
+    for title, creds in vault.items():
+        checked += 1
+        if creds['password'] in breached:
+            found += 1
+            print(title)
+    vault.close()
+    breached.close()
+    print(
+        f"{found} of {checked} passwords appear in the breached list "
+        f"(checked in {time.perf_counter() - start:.2f}s)",
+        file=sys.stderr
+    )
+
+def run_audit(weak_bits: str | None = None) -> None:
+    """
+    report reused and weak passwords (and leaked ones if a breach filter is
+    set up) by title, passwords themselves are never printed
+
+    Parameters
+    ----------
+    weak_bits : str | None, optional
+        estimated bits below which a password counts as weak, by default WEAK_BITS
+    """
+    from audit import WEAK_BITS, audit_vault
+    from breach import open_filter
+
+    meta = read_json("meta.json", False)
+    breached = open_filter(meta.get('BREACH_FILTER'))
+    weak_bits = float(weak_bits) if weak_bits else WEAK_BITS
+    vault = unlock()
+    report = audit_vault(vault, breached, weak_bits)
+    vault.close()
+    if breached is not None:
+        breached.close()
+
+    reused_count = sum(len(group) for group in report['reused'])
+    print(f"reused passwords: {len(report['reused'])} ({reused_count} credentials)")
+    for group in report['reused']:
+        print(f"  {len(group)} credentials:  {', '.join(group)}")
+    print(f"weak passwords (under {weak_bits:g} bits): {len(report['weak'])}")
+    for title, bits in report['weak']:
+        print(f"  {bits:5.1f} bits  {title}")
+    if breached is not None:
+        print(f"passwords in the breached list: {len(report['breached'])}")
+        for title in report['breached']:
+            print(f"  {title}")
+    print(f"audited {report['checked']} credentials in {report['seconds']:.2f}s", file=sys.stderr)
+
+def _copy_result(result: dict) -> None:
+    # shared output for `get`/`copy`, exits non-zero on a failed lookup
+    if not result['ok']:
+        print(result['error'], file=sys.stderr)
+        sys.exit(1)
+    from pyperclip import copy as to_clipboard
+    to_clipboard(result['password'])
+    print(f"username:  {result['username']}")
+    print("password:  (copied to clipboard)")
+
+def run_get(title: str) -> None:
+    """
+    copy a password to the clipboard through the running vault agent
+
+    Parameters
+    ----------
+    title : str
+        title of the credentials
+    """
+    result = agent_request({"op" : "get", "title" : title})
+    if result is None:
+        print("no vault agent running, start one with `python main.py agent`", file=sys.stderr)
+        sys.exit(1)
+    _copy_result(result)
+
+def run_copy(title: str) -> None:
+    """
+    copy a password to the clipboard without the banner/menu, uses the
+    vault agent when one is running and unlocks the vault directly otherwise
+
+    Parameters
+    ----------
+    title : str
+        title of the credentials
+    """
+    result = agent_request({"op" : "get", "title" : title})
+    if result is None:
+        vault = unlock()
+        result = vault.apply({"op" : "get", "title" : title})
+        vault.close()
+    _copy_result(result)
+
+def run_list() -> None:
+    """
+    print the title of every credential, one per line, without the
+    banner/menu (through the vault agent when one is running)
+    """
+    result = agent_request({"op" : "list"})
+    if result is None:
+        vault = unlock()
+        result = vault.apply({"op" : "list"})
+        vault.close()
+    print("\n".join(result['titles']))
+
+def run_search(
+        query: str,
+        limit: str = "20"
+    ) -> None:
+    """
+    print titles starting with (or close to) `query`, best match first
+
+    Parameters
+    ----------
+    query : str
+        start of, or approximate, title
+    limit : str, optional
+        most titles to print, by default "20"
+    """
+    op = {"op" : "search", "query" : query, "limit" : int(limit)}
+    result = agent_request(op)
+    if result is None:
+        vault = unlock()
+        result = vault.apply(op)
+        vault.close()
+    print("\n".join(result['titles']))
+
+def run_sync(
+        path: str,
+        prefer: str | None = None
+    ) -> None:
+    """
+    merge the vault with another copy of it under the same key (another
+    machine's, on a mounted drive), copying only records that differ
+
+    Parameters
+    ----------
+    path : str
+        the other copy's app directory (with its meta.json) or vault file
+    prefer : str | None, optional
+        `local` or `remote` to settle conflicts, by default they're listed
+        and left alone
+    """
+    from cryptography.fernet import InvalidToken
+    from history import HISTORY_KEEP
+    from shards import is_sharded, read_manifest
+    from vault import Vault, VaultError
+    from vaultfile import is_vault
+
+    remote_path = path
+    if os.path.isdir(path):
+        remote_meta = read_json(os.path.join(path, "meta.json"), False)
+        remote_path = os.path.join(path, remote_meta['DATA_LOCATION'])
+    else:
+        # a bare vault file, keep up its history if it has one
+        remote_meta = {} if os.path.isdir(remote_path + ".history") else {"HISTORY_KEEP" : 0}
+    if not (is_vault(remote_path) or is_sharded(remote_path)):
+        print(f"`{remote_path}` is not a vault file (open it with Password Manager once to convert it)", file=sys.stderr)
+        sys.exit(1)
+
+    vault = unlock()
+    remote = None
+    try:
+        # the other copy keeps its own shard layout
+        shards = read_manifest(remote_path)['shards'] if is_sharded(remote_path) else 1
+        # and its own history, so the merge can be undone there with `restore`
+        remote = Vault.open(
+            remote_path,
+            vault.data.fernet,
+            shards=shards,
+            codec=vault.data.codec,
+            keep_history=remote_meta.get('HISTORY_KEEP', HISTORY_KEEP),
+            history_days=remote_meta.get('HISTORY_DAYS', 0)
+        )
+        report = vault.sync(remote, prefer)
+    except InvalidToken:
+        print(f"`{remote_path}` isn't encrypted with this vault's key", file=sys.stderr)
+        sys.exit(1)
+    except (VaultError, RuntimeError) as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if remote is not None:
+            remote.close()
+        vault.close()
+
+    if report['unchanged']:
+        print("already in sync, neither vault changed since the last sync")
+    else:
+        print(f"{report['compared']} credentials differed")
+        print(f"  here:   {report['to_local']} copied in, {report['removed_local']} removed")
+        print(f"  there:  {report['to_remote']} copied in, {report['removed_remote']} removed")
+    if report['conflicts']:
+        print(f"changed on both sides, left as they are: {len(report['conflicts'])}")
+        for title in report['conflicts']:
+            print(f"  {title}")
+        print("run `sync` again with `local` or `remote` to keep that side's version")
+    else:
+        print(f"vault digest: {report['root']}")
+    print(f"synced in {report['seconds']:.2f}s", file=sys.stderr)
+
+def run_digest() -> None:
+    """
+    print the vault's Merkle digest, copies holding the same records print
+    the same digest
+    """
+    vault = unlock()
+    try:
+        print(vault.digest())
+    finally:
+        vault.close()
+
+def run_history() -> None:
+    """
+    list the snapshots of past saves the vault can be restored to
+    """
+    from vault import VaultError
+
+    vault = unlock()
+    try:
+        snapshots = vault.history()
+    except VaultError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        vault.close()
+
+    if not snapshots:
+        print("no snapshots yet, one is taken every time the vault is saved")
+        return
+    print(f"{'#':>6}  {'saved':<19}  {'kind':<5}  {'changed':>8}  {'removed':>8}")
+    for snapshot in snapshots:
+        saved = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot['time']))
+        print(f"{snapshot['number']:>6}  {saved:<19}  {snapshot['kind']:<5}  {snapshot['changed']:>8}  {snapshot['removed']:>8}")
+    print("run `restore <#>` to bring the vault back to one of these")
+
+def run_restore(snapshot: str) -> None:
+    """
+    bring the vault back to how it was in a snapshot from `history`, the
+    restore is saved as a snapshot of its own so it can be undone
+
+    Parameters
+    ----------
+    snapshot : str
+        snapshot number
+    """
+    from vault import VaultError
+
+    if not snapshot.isdigit():
+        print(f"snapshot should be a number from `history`, not `{snapshot}`", file=sys.stderr)
+        sys.exit(1)
+    vault = unlock()
+    try:
+        result = vault.restore(int(snapshot))
+    except (VaultError, RuntimeError) as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        vault.close()
+    print(f"restored snapshot {snapshot}: {result['restored']} credentials rewritten, {result['removed']} removed")
+
 def main():
     """
     workflow for running app
     """
+    from pwinput import pwinput
+    from passmgmt import WELCOME_STR, handle_client
+
     print(WELCOME_STR)
 
     # run initialize if first run
@@ -132,31 +1052,25 @@ def main():
         # make mgr.json read-only after first run
         os.chmod("mgr.json", stat.S_IREAD)
 
-    # read in meta information
+    # read in meta information and the wrapped key
     meta = read_json("meta.json", False)
-    try:
-        with open(meta['KEY_LOCATION'], "rb") as file:
-            key = file.read()
-    except:
-        print(f"unable to open/find key file `{meta['KEY_LOCATION']}`")
-        print("make sure file path is correct in meta.json")
+    stored_key = read_key(meta)
+    if stored_key is None:
         print('exiting....')
         time.sleep(5)
         return
-
-    # decrypt data file to verify user, permit password management
-    fernet = Fernet(key)
-    data = read_json(meta['DATA_LOCATION'], True, fernet)
     print("Welcome to the password manager, please enter your master password to begin ")
 
-    # verify user
+    # verify user, the master password unlocks the vault key
     password = pwinput("password: ")
+    vault = unlock_vault(meta, stored_key, password)
     tries = 0
-    while password != data['USER']['root'] and tries < 3:
+    while vault is None and tries < 3:
         tries += 1
         print(f"invalid you have {4 - tries} {'tries' if tries < 3 else 'try'} left")
         password = pwinput("enter password: ")
-    if tries == 3 and password != data['USER']['root']:
+        vault = unlock_vault(meta, stored_key, password)
+    if vault is None:
         print("\nmaximum tries reached, terminating program")
         return
 
@@ -165,14 +1079,82 @@ def main():
     ask_mask = input("enter `m` if you wish to mask all passwords for this session:  ")
     mask = True if ask_mask == "m" else False
 
+    # optional offline check of new passwords against leaked ones
+    from breach import open_filter
+    breached = open_filter(meta.get('BREACH_FILTER'))
+
     # function for actually running the app, defined in passmgmt.py
-    data = handle_client(data, mask)
+    vault = handle_client(vault, mask, breached)
+    if breached is not None:
+        breached.close()
 
-    # update data, encrypt, and end program
+    # compact journal into the vault and end program
     print("updating database")
-    dump_json(meta['DATA_LOCATION'], data, True, fernet)
+    with timing.span("save"):
+        vault.save()
+    vault.close()
     print("terminating program")
     return 
 
+# non-interactive commands, `python main.py <command> <args>`
+COMMANDS = {
+    "batch" : run_batch,
+    "import" : run_import,
+    "export" : run_export,
+    "agent" : run_agent,
+    "get" : run_get,
+    "copy" : run_copy,
+    "list" : run_list,
+    "search" : run_search,
+    "rotate-key" : run_rotate_key,
+    "breach-compile" : run_breach_compile,
+    "breached" : run_breached,
+    "audit" : run_audit,
+    "sync" : run_sync,
+    "digest" : run_digest,
+    "history" : run_history,
+    "restore" : run_restore
+}
+
+def command_usage(
+        name: str,
+        count: int
+    ) -> str | None:
+    """
+    usage line for a command given the wrong number of arguments
+
+    Parameters
+    ----------
+    name : str
+        command, a key of COMMANDS
+    count : int
+        number of arguments given
+
+    Returns
+    -------
+    str | None
+        usage line naming the command's arguments, None if `count` is fine
+    """
+    # read off the function itself, importing inspect would slow every command
+    command = COMMANDS[name]
+    params = command.__code__.co_varnames[:command.__code__.co_argcount]
+    required = len(params) - len(command.__defaults__ or ())
+    if required <= count <= len(params):
+        return None
+    words = [f"<{param}>" for param in params[:required]] + [f"[{param}]" for param in params[required:]]
+    return " ".join(["usage: python main.py", name, *words])
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # `--profile[=PATH]` (or PW_MGR_PROFILE) reports where the time went, see timing.py
+    args = timing.start(sys.argv[1:])
+    try:
+        if args and args[0] in COMMANDS:
+            usage = command_usage(args[0], len(args) - 1)
+            if usage is not None:
+                print(usage, file=sys.stderr)
+                sys.exit(1)
+            COMMANDS[args[0]](*args[1:])
+        else:
+            main()
+    finally:
+        timing.finish()
\ No newline at end of file
@@ -0,0 +1,88 @@
+# process pool for CPU heavy vault work in Password Manager
+#
+# Fernet is python glue around small OpenSSL calls, so encrypting thousands
+# of small records holds the GIL the whole time and a thread pool doesn't
+# help. big jobs are split into chunks and fanned out to a pool of worker
+# processes instead, small ones (and single core machines) just run inline
+
+import itertools
+import os
+import threading
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+
+# worker processes used for big jobs, 1 turns the pool off
+WORKERS = os.cpu_count() or 1
+
+# records below which starting the pool costs more than it saves
+PARALLEL_MIN = 2000
+
+# records handed to a worker at a time
+CHUNK_SIZE = 500
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+def _executor():
+    # one pool per process, started on first use and reused after that
+    # (shards are saved from several threads at once)
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is None or _pool_size != WORKERS:
+            from concurrent.futures import ProcessPoolExecutor
+            if _pool is not None:
+                _pool.shutdown()
+            _pool = ProcessPoolExecutor(WORKERS)
+            _pool_size = WORKERS
+        return _pool
+
+def pmap(
+        func: Callable,
+        jobs: Iterable[tuple]
+    ) -> Iterator:
+    """
+    `func(*job)` for every job (one chunk of records each), on the process
+    pool when there are at least PARALLEL_MIN records worth of chunks
+
+    at most two jobs per worker are in flight at once so a lazy stream of
+    jobs is never read far ahead, results come back in job order
+
+    Parameters
+    ----------
+    func : Callable
+        module level (picklable) function
+    jobs : Iterable[tuple]
+        argument tuples, consumed lazily
+
+    Returns
+    -------
+    Iterator
+        one result per job, in order
+    """
+    jobs = iter(jobs)
+    min_jobs = max(2, PARALLEL_MIN // CHUNK_SIZE)
+    first = list(itertools.islice(jobs, min_jobs))
+    if WORKERS < 2 or len(first) < min_jobs:
+        for job in itertools.chain(first, jobs):
+            yield func(*job)
+        return
+    pool = _executor()
+    pending = deque()
+    for job in itertools.chain(first, jobs):
+        pending.append(pool.submit(func, *job))
+        if len(pending) >= 2 * WORKERS:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def chunks(
+        items: Iterable,
+        size: int = CHUNK_SIZE
+    ) -> Iterator[list]:
+    """
+    split a stream into lists of at most `size` items
+    """
+    items = iter(items)
+    while chunk := list(itertools.islice(items, size)):
+        yield chunk
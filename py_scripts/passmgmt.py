@@ -1,9 +1,18 @@
 # utility functions for running Password Manager
 
+from __future__ import annotations
+
 import json
-from pwinput import pwinput 
-from pyperclip import copy as to_clipboard
-from cryptography.fernet import Fernet
+import os
+import timing
+from typing import TYPE_CHECKING
+
+# only needed for type hints, read_json/dump_json are used by the one-shot
+# commands in main.py which shouldn't pay for importing cryptography
+if TYPE_CHECKING:
+    from breach import BreachFilter
+    from cryptography.fernet import Fernet
+    from vault import Vault
 
 WELCOME_STR = r"""
         ________              ________  ________                       ________   ________   _______
@@ -29,7 +38,8 @@ def read_json(
         fernet: Fernet | None = None
     ) -> dict:
     """
-    reading json file into python dictionary
+    reading json file into python dictionary, encrypted files may be
+    compressed with any codec (it's detected from the data)
 
     Parameters
     ----------
@@ -47,20 +57,24 @@ def read_json(
     """
     if is_encrypted:
         assert fernet, "no Fernet object passed to decrypt json"
+        from codec import unpack
         with open(filepath, "rb") as file:
             stuff = file.read()
-        clean = fernet.decrypt(stuff).decode("utf-8")
-        to_json = json.loads(clean)
+        with timing.span("fernet_decrypt"):
+            clean = unpack(fernet.decrypt(stuff)).decode("utf-8")
+        with timing.span("json_loads"):
+            to_json = json.loads(clean)
         return to_json
     else:
-        with open(filepath, "r") as file:
+        with timing.span("read_json"), open(filepath, "r") as file:
             return json.load(file)
 
 def dump_json(
         filepath: str,
         update: dict, 
         encrypt: bool,
-        fernet: Fernet | None = None
+        fernet: Fernet | None = None,
+        codec: str = "none"
     ) -> None:
     """
     dump a python dictionary to json file
@@ -75,43 +89,80 @@ def dump_json(
         whether to encrypt or not
     fernet : Fernet | None, optional
         Fernet encryption object, by default None
+    codec : str, optional
+        compression applied before encrypting, by default none
     
     Returns
     -------
     None
 
     """
-    if encrypt:
-        assert fernet, "no Fernet object passed to encrypt json"
-        as_str = json.dumps(update)
-        as_bytes = as_str.encode("utf-8")
-        encrypted_bytes = fernet.encrypt(as_bytes)
-        with open(filepath, "wb") as file:
-            file.write(encrypted_bytes)
-        return
-    else:
-        with open(filepath, "w") as file:
-            json.dump(update, file, indent=4)
+    with timing.span("dump_json"):
+        # written aside and renamed over so readers never see half a file and
+        # a crash mid-write leaves the old one in place
+        tmp_path = filepath + ".tmp"
+        if encrypt:
+            assert fernet, "no Fernet object passed to encrypt json"
+            from codec import pack
+            as_str = json.dumps(update)
+            as_bytes = as_str.encode("utf-8")
+            encrypted_bytes = fernet.encrypt(pack(as_bytes, codec))
+            with open(tmp_path, "wb") as file:
+                file.write(encrypted_bytes)
+        else:
+            with open(tmp_path, "w") as file:
+                json.dump(update, file, indent=4)
+        os.replace(tmp_path, filepath)
 
 def handle_client(
-        data: dict, 
-        mask: bool = False
-    ) -> dict:
+        vault: Vault, 
+        mask: bool = False,
+        breached: BreachFilter | None = None
+    ) -> Vault:
     """
-    function for using/updating password manager data
+    function for using/updating password manager data, a thin menu over
+    the `Vault` api
 
     Parameters
     ----------
-    data : dict
-        dictionary of user password data
+    vault : Vault
+        vault holding the user password data
     mask : bool, optional
         whether or not to mask passwords as they're typed/displayed
+    breached : BreachFilter | None, optional
+        leaked password filter new passwords are checked against, by default None
 
     Returns
     -------
-    dict
-        updated data dictionary
+    Vault
+        updated vault
     """
+    from pwinput import pwinput
+    from pyperclip import copy as to_clipboard
+    from vault import RESERVED_TITLE, ConflictError, VaultError
+
+    # tab completes titles where readline is available (not on windows)
+    try:
+        import readline
+        readline.set_completer(vault.completer())
+        readline.set_completer_delims("")
+        readline.parse_and_bind("tab: complete")
+    except ImportError:
+        pass
+
+    def warn_breached(password: str) -> None:
+        # offline check against leaked passwords, only warns
+        if breached is not None and password in breached:
+            print("**this password appears in a list of breached passwords, consider `r` to pick another**\n")
+
+    def not_found(title: str) -> None:
+        # point the user at close titles when one isn't found
+        print(f"title `{title}` not found in credentials")
+        suggestions = vault.search(title, 5)
+        if suggestions:
+            print(f"did you mean: {', '.join(suggestions)}")
+        print()
+
     action = input(f"""
         welcome, enter the appropriate option to continue
 
@@ -120,13 +171,14 @@ def handle_client(
         `e`     edit current credentials
         `r`     remove current credentials
         `v`     view titles of all credentials
+        `s`     search titles of credentials
         `x`     to quit
     """)
 
     # run loop until user terminates program
     while True:
-        while action not in {'a','c','e','r','v','x'}:
-            action = input("please enter a valid option (`a`, `c`, `e`, `r`, `v`, `x`):\t")
+        while action not in {'a','c','e','r','v','s','x'}:
+            action = input("please enter a valid option (`a`, `c`, `e`, `r`, `v`, `s`, `x`):\t")
 
         # adding credentials
         if action == 'a':
@@ -137,67 +189,80 @@ def handle_client(
                 if title == 'exit':
                     print("aborting addition of new credentials\n")
                     break
-                # 'USER' is a part of data.json but should not be displayed at any point in program
-                elif title == "USER":
-                    print("`USER` is an invalid title, try again\n")
-                    break
-                elif title in data.keys():
-                    print(f"title `{title}` already in database, enter `e` to edit exsisting credentials")
+                # 'USER' is a part of the vault but should not be displayed at any point in program
+                try:
+                    vault.check_new(title)
+                except VaultError as err:
+                    print(f"{err}, try again\n")
                     break
+                # make new credentials, let user validate, retry if error made
+                local_user = input("enter the username for this credential:  ")
+                if mask:
+                    new_pw = pwinput("enter password for this credential:  ")
                 else:
-                    # make new credentials, let user validate, retry if error made
-                    local_user = input("enter the username for this credential:  ")
-                    if mask:
-                        new_pw = pwinput("enter password for this credential:  ")
-                    else:
-                        new_pw = input("enter password for this credential:  ")
-                    print(f"""
-                            new credentials created:
-                                
-                            title:      {title}
-                            username:   {local_user}
-                            password:   {'`masked`' if mask else new_pw}
-                    """)
-                    try_again = input("enter `r` to retry or any other key to choose another action:  ")
-                    if try_again == 'r':
-                        print("retry adding credentials\n")
-                    else:
-                        # update data dictionary
-                        data[title] = {
-                            "username" : local_user,
-                            "password" : new_pw
-                        }
-                        print("new credentials added\n")
-                        break  
+                    new_pw = input("enter password for this credential:  ")
+                print(f"""
+                        new credentials created:
+                            
+                        title:      {title}
+                        username:   {local_user}
+                        password:   {'`masked`' if mask else new_pw}
+                """)
+                warn_breached(new_pw)
+                try_again = input("enter `r` to retry or any other key to choose another action:  ")
+                if try_again == 'r':
+                    print("retry adding credentials\n")
+                else:
+                    try:
+                        vault.add(title, local_user, new_pw)
+                    except VaultError as err:
+                        # taken by another session in the meantime
+                        print(f"{err}, credentials were not added\n")
+                        break
+                    print("new credentials added\n")
+                    break  
         # main function for using Password Manager, copies password to clipboard
         elif action == 'c':
             title = input("enter the title of the credentials:  ")
-            if title == "USER": # same as in `a`
-                print("cannot view `USER` credentials\n")
             # this version of password is always masked
-            elif title in data.keys():
-                to_clipboard(data[title]['password'])
+            try:
+                creds = vault.get(title)
+                to_clipboard(creds['password'])
                 print(f"""
-                    username:  {data[title]['username']}
+                    username:  {creds['username']}
                     password:  (copied to clipboard)
                 """)
-            else:
-                print(f"title {title} not found in credentials\n")
+            except VaultError as err:
+                if title == RESERVED_TITLE:
+                    print(f"{err}\n")
+                else:
+                    not_found(title)
         # editing credentials (username or password)
         elif action == 'e':
             print("editing current credentials\n")
             title = input("enter the title of the credentials or `exit`:  ")
-            if title == "USER": # same as `a` and `c`
-                print("cannot edit `USER` credentials\n")
-            elif title in data.keys():
-                # similar code to adding credentials, update data dict 
+            if title == 'exit': # leave the loop
+                pass
+            elif title == RESERVED_TITLE: # same as `a` and `c`
+                print(f"cannot edit `{RESERVED_TITLE}` credentials\n")
+            elif title in vault:
+                # similar code to adding credentials, update vault
                 print(f"editing credentials for {title}")
                 while True:
+                    # remember which version was shown, so a change made by
+                    # another session in the meantime isn't overwritten
+                    try:
+                        version = vault.version(title)
+                        creds = vault.get(title)
+                    except VaultError as err:
+                        # removed by another session in the meantime
+                        print(f"{err}\n")
+                        break
                     print(f"""
                         current credentials:
                             
-                        username:  {data[title]['username']}
-                        password:  {'masked' if mask else data[title]['password']}
+                        username:  {creds['username']}
+                        password:  {'masked' if mask else creds['password']}
                     """)
                     local_user = input("enter the username for this credential:  ")
                     if mask:
@@ -211,47 +276,76 @@ def handle_client(
                         username:   {local_user}
                         password:   {'`masked`' if mask else new_pw}
                     """)
+                    warn_breached(new_pw)
                     try_again = input("enter `r` to retry or any other key to choose another action:  ")
                     if try_again == 'r':
                         print("retry adding credentials\n")
                         continue 
                     else:
-                        data[title] = {
-                            "username" : local_user,
-                            "password" : new_pw
-                        }
+                        try:
+                            vault.edit(title, local_user, new_pw, version)
+                        except ConflictError as err:
+                            print(f"{err}, try again\n")
+                            continue
+                        except VaultError as err:
+                            print(f"{err}\n")
+                            break
                         print("new credentials added\n")
                         break 
-            elif title == 'exit': # leave the loop
-                pass
             else:
-                print(f"title `{title}` not found in credentials\n")
+                not_found(title)
         # removing credentials
         elif action == 'r':
             print("removing credentials from database\n")
             title = input("enter the title of the credentials or `exit`:  ")
-            if title == "USER":
-                print("cannot remove `USER` credentials\n") # nice try
-            elif title in data.keys():
-                # add second layer of validation
-                keep_going = input(f"are you sure you want to remove credentials for {title} (y/n):  ")
-                keep_going = True if keep_going.lower() == 'y' else False
-                if keep_going:
-                    del data[title]
-                else:
-                    print("aborting removal of credentials\n")
-            elif title == 'exit': # leave the loop
+            if title == 'exit': # leave the loop
                 pass
+            elif title == RESERVED_TITLE:
+                print(f"cannot remove `{RESERVED_TITLE}` credentials\n") # nice try
             else:
-                print(f"title `{title}` not found in credentials\n")
+                try:
+                    version = vault.version(title)
+                except VaultError:
+                    # not there, or removed by another session in the meantime
+                    version = None
+                if version is None:
+                    not_found(title)
+                else:
+                    # add second layer of validation
+                    keep_going = input(f"are you sure you want to remove credentials for {title} (y/n):  ")
+                    keep_going = True if keep_going.lower() == 'y' else False
+                    if keep_going:
+                        try:
+                            vault.remove(title, version)
+                        except VaultError as err:
+                            # changed or already removed by another session
+                            print(f"{err}, credentials were not removed\n")
+                    else:
+                        print("aborting removal of credentials\n")
         # incase you forget the titles of the credentials you have saved, 
         # view them so you can know what to enter
         elif action == 'v':
             print("\ntitles for credentials:")
-            print([key for key in data.keys() if key != "USER"]) # don't show user stuff
+            page = 0
+            titles = vault.index.page(page) # USER is never listed
+            while titles:
+                print("\n".join(titles))
+                page += 1
+                titles = vault.index.page(page)
+                if titles and input("enter for more titles or `q` to stop:  ") == 'q':
+                    break
             print()
+        # prefix matches first, then close matches for typos
+        elif action == 's':
+            query = input("enter the start of (or roughly) the title:  ")
+            matches = vault.search(query, 20)
+            if matches:
+                print("\nmatching titles:")
+                print("\n".join(matches))
+                print()
+            else:
+                print(f"no titles match `{query}`\n")
         elif action == 'x': # exit app
             break
-        action = input("enter another action (`a`, `c`, `e`, `r`, `v`) or `x` to quit:  ")
-    return data
-    
\ No newline at end of file
+        action = input("enter another action (`a`, `c`, `e`, `r`, `v`, `s`) or `x` to quit:  ")
+    return vault
\ No newline at end of file
@@ -0,0 +1,546 @@
+# sharded vaults for Password Manager
+#
+# with SHARDS > 1 in meta.json the vault is split into that many vault files
+# and every title lives in the shard picked by hashing it. data.vault then
+# only holds a small plaintext manifest:
+#
+#   PMSHARDS {"version": 1, "shards": 4, "layout": 0}\n
+#
+# the shards themselves are data.vault.<layout>-00 ... data.vault.<layout>-03,
+# each a normal vault file (see vaultfile.py) with its own journal, all
+# guarded by the one data.vault.lock. saving only rewrites shards that
+# changed, side by side on a thread pool, with the re-encryption fanned out
+# to the process pool in parallel.py. changing the shard count reshards on
+# the next open by copying record ciphertext into a new layout
+
+import hashlib
+import itertools
+import json
+import os
+import queue
+from collections.abc import Iterable, Iterator, MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from codec import DEFAULT_CODEC, check
+from cryptography.fernet import Fernet
+from history import History
+from journal import COMPACT_AFTER
+from locking import VaultLock
+from vaultfile import LazyVault, is_vault, write_vault
+
+SHARD_MAGIC = b"PMSHARDS "
+SHARD_VERSION = 1
+
+# marks the end of the new records routed to a shard, or that the stream broke
+_DONE = object()
+_ABORT = object()
+
+def is_sharded(filepath: str) -> bool:
+    """
+    check if a file is a sharded vault manifest
+
+    Parameters
+    ----------
+    filepath : str
+        location of data file
+
+    Returns
+    -------
+    bool
+        True if file starts with the manifest header
+    """
+    try:
+        with open(filepath, "rb") as file:
+            return file.read(len(SHARD_MAGIC)) == SHARD_MAGIC
+    except FileNotFoundError:
+        return False
+
+def read_manifest(filepath: str) -> dict:
+    """
+    shard count and layout number of a sharded vault
+
+    Parameters
+    ----------
+    filepath : str
+        location of manifest file
+
+    Returns
+    -------
+    dict
+        manifest contents
+    """
+    with open(filepath, "rb") as file:
+        return json.loads(file.readline()[len(SHARD_MAGIC):])
+
+def _write_manifest(
+        filepath: str,
+        shards: int,
+        layout: int
+    ) -> None:
+    tmp_path = filepath + ".tmp"
+    manifest = {"version": SHARD_VERSION, "shards": shards, "layout": layout}
+    with open(tmp_path, "wb") as file:
+        file.write(SHARD_MAGIC + json.dumps(manifest).encode("utf-8") + b"\n")
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, filepath)
+
+def shard_path(
+        filepath: str,
+        layout: int,
+        number: int
+    ) -> str:
+    """
+    location of one shard file
+    """
+    return f"{filepath}.{layout}-{number:02d}"
+
+def shard_of(
+        title: str,
+        shards: int
+    ) -> int:
+    """
+    shard a title belongs in, stable across runs and machines
+
+    Parameters
+    ----------
+    title : str
+        title of the credential
+    shards : int
+        number of shards
+
+    Returns
+    -------
+    int
+        shard number
+    """
+    digest = hashlib.blake2b(title.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+class ShardedVault(MutableMapping):
+    """
+    dictionary-like view over the shards of a vault, works like LazyVault
+    (journaling, locking, versions) with every title handled by its shard
+
+    Parameters
+    ----------
+    filepath : str
+        location of manifest file
+    fernet : Fernet
+        Fernet encryption object
+    compact_after : int, optional
+        journal entries allowed per shard before compacting it, by default COMPACT_AFTER
+    lock : VaultLock | None, optional
+        already held vault lock, by default the vault's own
+    codec : str, optional
+        compression for records written from now on, by default DEFAULT_CODEC
+    history : History | None, optional
+        snapshot history shared by the shards, by default none
+    """
+    def __init__(
+            self,
+            filepath: str,
+            fernet: Fernet,
+            compact_after: int = COMPACT_AFTER,
+            lock: VaultLock | None = None,
+            codec: str = DEFAULT_CODEC,
+            history: History | None = None
+        ) -> None:
+        self.filepath = filepath
+        self.fernet = fernet
+        self.compact_after = compact_after
+        self.codec = codec
+        self.history = history
+        self._owns_lock = lock is None
+        self.lock = lock or VaultLock(filepath + ".lock")
+        self._journaled = True
+        self._layout_revision = 0
+        self.shards = []
+        with self.lock.hold():
+            self._load()
+
+    def _stamp(self) -> tuple:
+        info = os.stat(self.filepath)
+        return info.st_ino, info.st_size, info.st_mtime_ns
+
+    def _load(self) -> None:
+        # (re)open every shard of the current layout
+        for shard in self.shards:
+            shard.close()
+        manifest = read_manifest(self.filepath)
+        self._manifest_stamp = self._stamp()
+        self.layout = manifest['layout']
+        self.shards = [
+            LazyVault(
+                shard_path(self.filepath, self.layout, number),
+                self.fernet,
+                self.compact_after,
+                self.lock,
+                self.codec,
+                self.history
+            )
+            for number in range(manifest['shards'])
+        ]
+        for shard in self.shards:
+            shard.journaled = self._journaled
+
+    @property
+    def revision(self) -> int:
+        # bumped whenever changes from another process are picked up
+        return self._layout_revision + sum(shard.revision for shard in self.shards)
+
+    @property
+    def journaled(self) -> bool:
+        return self._journaled
+
+    @journaled.setter
+    def journaled(self, journaled: bool) -> None:
+        self._journaled = journaled
+        for shard in self.shards:
+            shard.journaled = journaled
+
+    @property
+    def changed(self) -> bool:
+        return any(shard.changed for shard in self.shards)
+
+    def refresh(self) -> bool:
+        """
+        pick up changes other processes made, must be called with the lock held
+
+        Returns
+        -------
+        bool
+            True if anything changed
+        """
+        if self._stamp() != self._manifest_stamp:
+            # resharded by another process
+            self._load()
+            self._layout_revision += 1
+            return True
+        changed = [shard.refresh() for shard in self.shards]
+        return any(changed)
+
+    @contextmanager
+    def locked(self, exclusive: bool = False) -> Iterator["ShardedVault"]:
+        """
+        hold the vault lock and sync with other processes for a `with` block
+
+        Parameters
+        ----------
+        exclusive : bool, optional
+            take the writer lock, by default False
+        """
+        with self.lock.hold(exclusive):
+            self.refresh()
+            yield self
+
+    def shard(self, title: str) -> LazyVault:
+        """
+        shard holding (or that would hold) a title
+        """
+        return self.shards[shard_of(title, len(self.shards))]
+
+    def version(self, title: str) -> int:
+        return self.shard(title).version(title)
+
+    def __getitem__(self, title: str) -> dict:
+        return self.shard(title)[title]
+
+    def __setitem__(self, title: str, value: dict) -> None:
+        self.shard(title)[title] = value
+
+    def __delitem__(self, title: str) -> None:
+        del self.shard(title)[title]
+
+    def __iter__(self) -> Iterator[str]:
+        return itertools.chain.from_iterable(self.shards)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def __contains__(self, title: object) -> bool:
+        return isinstance(title, str) and title in self.shard(title)
+
+    def peek(self, title: str) -> dict:
+        return self.shard(title).peek(title)
+
+    def walk(self) -> Iterator[tuple[str, dict]]:
+        """
+        decrypt every record, shard by shard, should be called inside `locked()`
+
+        Returns
+        -------
+        Iterator[tuple[str, dict]]
+            (title, credential data) pairs
+        """
+        for shard in self.shards:
+            yield from shard.walk()
+
+    def _records(self) -> Iterator[tuple[str, bytes, int]]:
+        for shard in self.shards:
+            yield from shard._records()
+
+    def raw(self, title: str) -> bytes:
+        return self.shard(title).raw(title)
+
+    def tokens(self) -> Iterator[tuple[str, bytes, int]]:
+        """
+        every record as stored, shard by shard, see `LazyVault.tokens`
+
+        Returns
+        -------
+        Iterator[tuple[str, bytes, int]]
+            (title, encrypted record token, record version) triples
+        """
+        for shard in self.shards:
+            yield from shard.tokens()
+
+    def stamps(self) -> Iterator[tuple[str, int, str]]:
+        """
+        version and token digest of every record, shard by shard, see
+        `LazyVault.stamps`
+
+        Returns
+        -------
+        Iterator[tuple[str, int, str]]
+            (title, record version, hex token digest) triples
+        """
+        for shard in self.shards:
+            yield from shard.stamps()
+
+    def merge(
+            self,
+            records: dict[str, tuple[bytes, int]],
+            removed: Iterable[str] = ()
+        ) -> None:
+        """
+        fold records encrypted elsewhere in, only compacting the shards they
+        land in, see `LazyVault.merge`
+
+        Parameters
+        ----------
+        records : dict[str, tuple[bytes, int]]
+            title -> (encrypted record token, record version)
+        removed : Iterable[str], optional
+            titles to remove, by default none
+        """
+        with self.locked(exclusive=True):
+            groups = {}
+            for title, record in records.items():
+                groups.setdefault(shard_of(title, len(self.shards)), ({}, []))[0][title] = record
+            for title in removed:
+                groups.setdefault(shard_of(title, len(self.shards)), ({}, []))[1].append(title)
+            with self._batch():
+                for number, (shard_records, shard_removed) in groups.items():
+                    self.shards[number].merge(shard_records, shard_removed)
+
+    @contextmanager
+    def _batch(self) -> Iterator[None]:
+        # shards compacted together make one snapshot
+        if self.history is None:
+            yield
+            return
+        with self.history.batch():
+            yield
+
+    def save(self, extra: Iterator[tuple[str, bytes, int]] | None = None) -> None:
+        """
+        compact every shard that changed, in parallel
+
+        Parameters
+        ----------
+        extra : Iterator[tuple[str, bytes, int]] | None, optional
+            already encrypted (title, token, version) records to add, titles
+            must not be in the vault yet, by default None
+        """
+        with self.locked(exclusive=True):
+            if extra is None:
+                routes = {number : None for number, shard in enumerate(self.shards) if shard.changed}
+            else:
+                # new records could land in any shard, so all of them get rewritten
+                routes = {number : queue.SimpleQueue() for number in range(len(self.shards))}
+            if not routes:
+                return
+
+            with self._batch(), ThreadPoolExecutor(len(routes)) as pool:
+                futures = [
+                    pool.submit(self.shards[number]._compact, None if route is None else _drain(route))
+                    for number, route in routes.items()
+                ]
+                if extra is not None:
+                    end = _ABORT
+                    try:
+                        for record in extra:
+                            routes[shard_of(record[0], len(self.shards))].put(record)
+                        end = _DONE
+                    finally:
+                        for route in routes.values():
+                            route.put(end)
+                for future in futures:
+                    future.result()
+
+    def rotate(self, key_id: str) -> int:
+        """
+        re-encrypt the shards under the first key of a MultiFernet one at a
+        time, see `LazyVault.rotate`. the lock is let go between shards so
+        other sessions aren't held up for the whole rotation
+
+        Parameters
+        ----------
+        key_id : str
+            id of the rotation
+
+        Returns
+        -------
+        int
+            number of shards rotated, already rotated ones are skipped
+        """
+        rotated = 0
+        number = 0
+        layout = self.layout
+        while True:
+            with self.locked(exclusive=True):
+                if self.layout != layout:
+                    # resharded by another process in between, the new shard
+                    # files hold copied tokens, so start over (rotated ones are skipped)
+                    layout = self.layout
+                    number = 0
+                if number >= len(self.shards):
+                    return rotated
+                rotated += self.shards[number].rotate(key_id)
+            number += 1
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+        if self._owns_lock:
+            self.lock.close()
+
+def _drain(route: queue.SimpleQueue) -> Iterator[tuple[str, bytes, int]]:
+    # records routed to one shard by `ShardedVault.save`, the shard's new
+    # file is never swapped in if the stream feeding them broke
+    while (record := route.get()) is not _DONE:
+        if record is _ABORT:
+            raise RuntimeError("new records stopped arriving, shard left unchanged")
+        yield record
+
+def reshard(
+        filepath: str,
+        fernet: Fernet,
+        shards: int,
+        lock: VaultLock,
+        codec: str = DEFAULT_CODEC
+    ) -> None:
+    """
+    split a vault into `shards` shard files (or merge it back into a single
+    vault file for 1), copying record ciphertext without decrypting it
+
+    the new layout is written next to the old one and only takes over once
+    the manifest (or single vault file) is replaced, so a crash part way
+    leaves the old layout intact
+
+    Parameters
+    ----------
+    filepath : str
+        location of vault / manifest file
+    fernet : Fernet
+        Fernet encryption object
+    shards : int
+        number of shards wanted
+    lock : VaultLock
+        vault lock, must be held exclusively
+    codec : str, optional
+        codec for the new files' index and header, by default DEFAULT_CODEC
+    """
+    if is_sharded(filepath):
+        source = ShardedVault(filepath, fernet, lock=lock, codec=codec)
+        old_files = [shard.filepath for shard in source.shards]
+        layout = source.layout + 1
+    else:
+        source = LazyVault(filepath, fernet, lock=lock, codec=codec)
+        old_files = []
+        layout = 0
+    # fold journals in first so only raw record tokens need copying
+    source.save()
+
+    if shards == 1:
+        tmp_path = filepath + ".new"
+        write_vault(tmp_path, source._records(), fernet, codec=codec)
+        source.close()
+        os.replace(tmp_path, filepath)
+    else:
+        owner = source.shard if isinstance(source, ShardedVault) else lambda title: source
+        groups = [[] for _ in range(shards)]
+        for title in source:
+            groups[shard_of(title, shards)].append(title)
+        for number, titles in enumerate(groups):
+            records = ((title, owner(title).file.raw(title), owner(title).version(title)) for title in titles)
+            write_vault(shard_path(filepath, layout, number), records, fernet, codec=codec)
+        source.close()
+        _write_manifest(filepath, shards, layout)
+
+    for path in old_files:
+        os.remove(path)
+
+def open_store(
+        filepath: str,
+        fernet: Fernet,
+        compact_after: int = COMPACT_AFTER,
+        shards: int = 1,
+        codec: str = DEFAULT_CODEC,
+        keep_history: int = 0,
+        history_days: float = 0
+    ) -> LazyVault | ShardedVault:
+    """
+    open a vault file or sharded vault, resharding first if it isn't split
+    into `shards` shards yet
+
+    Parameters
+    ----------
+    filepath : str
+        location of vault / manifest file
+    fernet : Fernet
+        Fernet encryption object
+    compact_after : int, optional
+        journal entries allowed before compacting, by default COMPACT_AFTER
+    shards : int, optional
+        number of shards, by default 1 (a single vault file)
+    codec : str, optional
+        compression for records written from now on, by default DEFAULT_CODEC
+    keep_history : int, optional
+        snapshots of past saves to keep in `<filepath>.history`, by default
+        0 (no history, see history.py)
+    history_days : float, optional
+        also keep snapshots younger than this many days, by default 0 (off)
+
+    Returns
+    -------
+    LazyVault | ShardedVault
+        opened vault data
+
+    Raises
+    ------
+    ValueError
+        if the codec is unknown or its package isn't installed
+    """
+    check(codec)
+    shards = max(1, shards)
+    lock = VaultLock(filepath + ".lock")
+    try:
+        with lock.hold(exclusive=True):
+            current = read_manifest(filepath)['shards'] if is_sharded(filepath) else 1
+            if current != shards:
+                reshard(filepath, fernet, shards, lock, codec)
+    finally:
+        lock.close()
+    history = History(filepath + ".history", fernet, keep_history, history_days) if keep_history > 0 else None
+    if is_vault(filepath):
+        store = LazyVault(filepath, fernet, compact_after, codec=codec, history=history)
+    else:
+        store = ShardedVault(filepath, fernet, compact_after, codec=codec, history=history)
+    if history is not None:
+        history.source = store.tokens
+        if len(history) == 0:
+            with store.locked(exclusive=True):
+                history.start()
+    return store
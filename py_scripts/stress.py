@@ -0,0 +1,110 @@
+# multi-process stress test for concurrent access to one Password Manager vault
+#
+# usage (from py_scripts or the app directory):
+#
+#   python stress.py                             8 processes, 50 rounds each
+#   python stress.py --processes 16 --rounds 200 --compact-after 8 --shards 4
+#
+# every process opens the same vault and, each round, adds a credential of
+# its own and bumps a shared counter credential with an optimistic
+# (version checked) edit, retrying on conflict. a small journal limit makes
+# the processes compact the vault out from under each other constantly.
+# afterwards every added title must exist and the counter must equal the
+# total number of rounds, otherwise an update was lost and this exits 1
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+COUNTER_TITLE = "stress-counter"
+
+def worker(
+        vault_path: str,
+        key: bytes,
+        worker_id: int,
+        rounds: int,
+        compact_after: int,
+        shards: int
+    ) -> int:
+    """
+    run one process's share of the load
+
+    Returns
+    -------
+    int
+        number of conflicts that had to be retried
+    """
+    from cryptography.fernet import Fernet
+    from vault import ConflictError, Vault
+
+    vault = Vault.open(vault_path, Fernet(key), compact_after, shards)
+    conflicts = 0
+    try:
+        for i in range(rounds):
+            vault.add(f"stress-{worker_id}-{i}", f"user{worker_id}", f"pw{i}")
+            while True:
+                version = vault.version(COUNTER_TITLE)
+                count = int(vault.get(COUNTER_TITLE)['password'])
+                try:
+                    vault.edit(COUNTER_TITLE, "counter", str(count + 1), version)
+                    break
+                except ConflictError:
+                    conflicts += 1
+    finally:
+        vault.close()
+    return conflicts
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="check concurrent vault access doesn't lose updates")
+    parser.add_argument("--processes", type=int, default=8, help="concurrent processes")
+    parser.add_argument("--rounds", type=int, default=50, help="adds/counter bumps per process")
+    parser.add_argument("--compact-after", type=int, default=16, help="journal entries before compacting")
+    parser.add_argument("--shards", type=int, default=1, help="shards to split the vault into")
+    args = parser.parse_args()
+
+    from cryptography.fernet import Fernet
+    from vault import Vault
+    from vaultfile import create_vault
+
+    key = Fernet.generate_key()
+    with tempfile.TemporaryDirectory() as workdir:
+        vault_path = os.path.join(workdir, "stress.vault")
+        create_vault(vault_path, {
+            "USER" : {"root" : "Stress_pw1"},
+            COUNTER_TITLE : {"username" : "counter", "password" : "0"}
+        }, Fernet(key))
+        # split into shards up front so the workers don't race to do it
+        Vault.open(vault_path, Fernet(key), args.compact_after, args.shards).close()
+
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.processes) as pool:
+            conflicts = pool.starmap(worker, [
+                (vault_path, key, worker_id, args.rounds, args.compact_after, args.shards)
+                for worker_id in range(args.processes)
+            ])
+        elapsed = time.perf_counter() - start
+
+        vault = Vault.open(vault_path, Fernet(key), shards=args.shards)
+        expected = {
+            f"stress-{worker_id}-{i}"
+            for worker_id in range(args.processes)
+            for i in range(args.rounds)
+        }
+        missing = expected - set(vault.list())
+        count = int(vault.get(COUNTER_TITLE)['password'])
+        vault.close()
+
+    total = args.processes * args.rounds
+    print(f"{args.processes} processes x {args.rounds} rounds in {elapsed:.2f}s, {sum(conflicts)} conflicts retried")
+    print(f"titles missing: {len(missing)}, counter: {count} (expected {total})")
+    if missing or count != total:
+        print("FAILED: updates were lost", file=sys.stderr)
+        return 1
+    print("ok")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
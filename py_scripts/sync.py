@@ -0,0 +1,444 @@
+# vault sync for Password Manager
+#
+# two copies of a vault under the same key (one per workstation, the other
+# reachable as a mounted or local directory) are merged record by record.
+# every record is stamped with its version and a digest of its encrypted
+# token, and the stamps are hashed into a two level Merkle tree:
+#
+#   leaf    sha256(title, version, token digest)
+#   bucket  sha256(sorted leaves of the titles hashed into it), BUCKETS of them
+#   root    sha256(every bucket digest, in order)
+#
+# equal roots mean the copies match. otherwise only the titles in buckets
+# whose digests differ are compared, and only records that differ are copied
+# across, as ciphertext (nothing is decrypted but the vault indexes, token
+# digests are kept in the vault files, see vaultfile.py). to tell
+# "changed here" from "changed there" each vault keeps, per peer, the stamps
+# both copies agreed on after their last sync in `<vault>.sync-<peer id>`
+# (its own id and its peers' are in `<vault>.sync`), encrypted with the vault
+# key. a record changed on one side since then is copied to the other
+# (removals included), one changed on both sides is a conflict, left as is
+# on both unless a side is preferred. records the copies never agreed on
+# (first sync) go by version, the higher one wins, and a record only one copy
+# has is copied over rather than removed. when neither vault file was
+# rewritten since a clean sync, nothing is read at all
+
+import hashlib
+import json
+import os
+import time
+import zlib
+from collections.abc import Iterable
+from cryptography.fernet import Fernet, InvalidToken
+from shards import ShardedVault
+from vaultfile import LazyVault
+
+# buckets under the Merkle root, titles are spread over them by CRC-32
+BUCKETS = 256
+
+STATE_SUFFIX = ".sync"
+
+# which copy wins a conflict when one is preferred
+SIDES = ("local", "remote")
+
+def stamps(
+        store: LazyVault | ShardedVault,
+        exclude: Iterable[str] = ()
+    ) -> dict[str, tuple[int, str]]:
+    """
+    version and token digest of every record, read straight from the vault
+    files' indexes and token digests without reading any record. must be
+    called inside `locked()` with nothing left to `save`
+
+    Parameters
+    ----------
+    store : LazyVault | ShardedVault
+        vault data
+    exclude : Iterable[str], optional
+        titles to leave out, by default none
+
+    Returns
+    -------
+    dict[str, tuple[int, str]]
+        title -> (record version, token digest)
+    """
+    exclude = set(exclude)
+    return {
+        title : (version, digest)
+        for title, version, digest in store.stamps()
+        if title not in exclude
+    }
+
+class MerkleTree:
+    """
+    two level Merkle tree over the record stamps of a vault
+
+    Parameters
+    ----------
+    stamps : dict[str, tuple[int, str]]
+        title -> (record version, token digest), kept (and updated) by the tree
+    """
+    def __init__(self, stamps: dict[str, tuple[int, str]]) -> None:
+        self.stamps = stamps
+        self._leaves = [{} for _ in range(BUCKETS)]
+        for title, stamp in stamps.items():
+            encoded = title.encode("utf-8")
+            self._leaves[zlib.crc32(encoded) % BUCKETS][title] = self._leaf(encoded, stamp)
+        self.buckets = [self._bucket_digest(bucket) for bucket in range(BUCKETS)]
+        self.root = hashlib.sha256(b"".join(self.buckets)).hexdigest()
+
+    @staticmethod
+    def _leaf(
+            encoded: bytes,
+            stamp: tuple[int, str]
+        ) -> bytes:
+        return hashlib.sha256(b"%s\0%d\0%s" % (encoded, stamp[0], stamp[1].encode("ascii"))).digest()
+
+    def _bucket_digest(self, bucket: int) -> bytes:
+        # leaves are sorted so the order records were added in doesn't matter
+        return hashlib.sha256(b"".join(sorted(self._leaves[bucket].values()))).digest()
+
+    def update(self, changes: dict[str, tuple[int, str] | None]) -> None:
+        """
+        apply changed stamps, only rehashing the buckets they fall in
+
+        Parameters
+        ----------
+        changes : dict[str, tuple[int, str] | None]
+            title -> new stamp, None for removed titles
+        """
+        touched = set()
+        for title, stamp in changes.items():
+            encoded = title.encode("utf-8")
+            bucket = zlib.crc32(encoded) % BUCKETS
+            touched.add(bucket)
+            if stamp is None:
+                self.stamps.pop(title, None)
+                self._leaves[bucket].pop(title, None)
+            else:
+                self.stamps[title] = stamp
+                self._leaves[bucket][title] = self._leaf(encoded, stamp)
+        for bucket in touched:
+            self.buckets[bucket] = self._bucket_digest(bucket)
+        self.root = hashlib.sha256(b"".join(self.buckets)).hexdigest()
+
+    def diff(self, other: "MerkleTree") -> list[str]:
+        """
+        titles whose stamps differ between two trees, only looking inside
+        buckets whose digests differ
+
+        Parameters
+        ----------
+        other : MerkleTree
+            tree of the other vault
+
+        Returns
+        -------
+        list[str]
+            titles added, removed or changed on either side
+        """
+        if self.root == other.root:
+            return []
+        titles = []
+        for bucket in range(BUCKETS):
+            if self.buckets[bucket] == other.buckets[bucket]:
+                continue
+            for title in self._leaves[bucket].keys() | other._leaves[bucket].keys():
+                if self.stamps.get(title) != other.stamps.get(title):
+                    titles.append(title)
+        return titles
+
+def _files(store: LazyVault | ShardedVault) -> list:
+    # name, generation and size of every vault file, they all change when
+    # a file is rewritten
+    files = store.shards if isinstance(store, ShardedVault) else [store]
+    return [[os.path.basename(file.filepath), file.generation, os.path.getsize(file.filepath)] for file in files]
+
+def _read_encrypted(
+        filepath: str,
+        fernet: Fernet
+    ) -> object | None:
+    try:
+        with open(filepath, "rb") as file:
+            token = file.read()
+    except FileNotFoundError:
+        return None
+    try:
+        return json.loads(fernet.decrypt(token).decode("utf-8"))
+    except InvalidToken:
+        # left under a key that's gone (rotated before state files were
+        # rotated too), same as never having synced
+        return None
+
+def _replace(
+        filepath: str,
+        token: bytes
+    ) -> None:
+    # replaced only once complete, like the vault files
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(token)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, filepath)
+
+def _write_encrypted(
+        filepath: str,
+        data: object,
+        fernet: Fernet
+    ) -> None:
+    _replace(filepath, fernet.encrypt(json.dumps(data).encode("utf-8")))
+
+def _state_files(store: LazyVault | ShardedVault) -> list[str]:
+    # `<vault>.sync` and every `<vault>.sync-<peer>`
+    directory = os.path.dirname(os.path.abspath(store.filepath))
+    name = os.path.basename(store.filepath) + STATE_SUFFIX
+    return [
+        os.path.join(directory, entry)
+        for entry in os.listdir(directory)
+        if entry == name or entry.startswith(name + "-") and not entry.endswith(".tmp")
+    ]
+
+def rotate_state(store: LazyVault | ShardedVault) -> int:
+    """
+    re-encrypt a vault's sync state and bases under the first key of the
+    MultiFernet the vault was opened with (see `LazyVault.rotate`), must be
+    called with the vault lock held
+
+    Parameters
+    ----------
+    store : LazyVault | ShardedVault
+        vault data opened with a MultiFernet
+
+    Returns
+    -------
+    int
+        number of files re-encrypted, ones no key can read are left alone
+        (and read as never synced)
+    """
+    rotated = 0
+    for filepath in _state_files(store):
+        with open(filepath, "rb") as file:
+            token = file.read()
+        try:
+            _replace(filepath, store.fernet.rotate(token))
+        except InvalidToken:
+            continue
+        rotated += 1
+    return rotated
+
+def read_state(store: LazyVault | ShardedVault) -> dict:
+    """
+    sync state of a vault: its id and, per peer, the vault files and digest
+    both copies had after their last sync
+
+    Parameters
+    ----------
+    store : LazyVault | ShardedVault
+        vault data
+
+    Returns
+    -------
+    dict
+        {"id": vault id, "peers": {peer id: {"files", "root"}}}, a new id and
+        no peers if the vault was never synced
+    """
+    state = _read_encrypted(store.filepath + STATE_SUFFIX, store.fernet)
+    return state or {"id" : os.urandom(8).hex(), "peers" : {}}
+
+def read_base(
+        store: LazyVault | ShardedVault,
+        peer: str
+    ) -> dict[str, tuple[int, str]]:
+    """
+    stamps a vault and a peer agreed on after their last sync, kept apart
+    from the state so a sync with nothing to do doesn't read them
+
+    Parameters
+    ----------
+    store : LazyVault | ShardedVault
+        vault data
+    peer : str
+        id of the other vault
+
+    Returns
+    -------
+    dict[str, tuple[int, str]]
+        title -> (record version, token digest), empty if never synced
+    """
+    base = _read_encrypted(f"{store.filepath}{STATE_SUFFIX}-{peer}", store.fernet) or {}
+    return {title : tuple(stamp) for title, stamp in base.items()}
+
+def write_state(
+        store: LazyVault | ShardedVault,
+        state: dict,
+        peer: str,
+        base: dict[str, tuple[int, str]]
+    ) -> None:
+    """
+    encrypt and write the sync state of a vault and its base for one peer,
+    the base first so the state never points at a base that isn't there
+
+    Parameters
+    ----------
+    store : LazyVault | ShardedVault
+        vault data
+    state : dict
+        sync state, see `read_state`
+    peer : str
+        id of the other vault
+    base : dict[str, tuple[int, str]]
+        stamps agreed with the peer, see `read_base`
+    """
+    _write_encrypted(f"{store.filepath}{STATE_SUFFIX}-{peer}", base, store.fernet)
+    _write_encrypted(store.filepath + STATE_SUFFIX, state, store.fernet)
+
+def vault_digest(
+        store: LazyVault | ShardedVault,
+        exclude: Iterable[str] = ()
+    ) -> str:
+    """
+    Merkle root of a vault, two copies holding the same records (same
+    versions, same ciphertext) have the same digest. must be called inside
+    `locked(exclusive=True)`, the journal is folded in first
+
+    Parameters
+    ----------
+    store : LazyVault | ShardedVault
+        vault data
+    exclude : Iterable[str], optional
+        titles to leave out, by default none
+
+    Returns
+    -------
+    str
+        hex digest
+    """
+    if store.changed:
+        store.save()
+    return MerkleTree(stamps(store, exclude)).root
+
+def sync_stores(
+        local: LazyVault | ShardedVault,
+        remote: LazyVault | ShardedVault,
+        prefer: str | None = None,
+        exclude: Iterable[str] = ()
+    ) -> dict:
+    """
+    merge two copies of a vault both ways, both must be held with
+    `locked(exclusive=True)`
+
+    Parameters
+    ----------
+    local : LazyVault | ShardedVault
+        vault data of this copy
+    remote : LazyVault | ShardedVault
+        vault data of the other copy, same key
+    prefer : str | None, optional
+        `local` or `remote`, the side that wins conflicts, by default
+        conflicts are left alone
+    exclude : Iterable[str], optional
+        titles never synced, by default none
+
+    Returns
+    -------
+    dict
+        `compared` titles, records copied `to_local`/`to_remote`, records
+        `removed_local`/`removed_remote`, `conflicts` titles, `root` digest
+        both copies share (None with conflicts left), `unchanged` if the
+        vault files weren't touched since the last sync and `seconds`
+    """
+    start = time.perf_counter()
+    for store in (local, remote):
+        if store.changed:
+            store.save()
+    local_state = read_state(local)
+    remote_state = read_state(remote)
+    if remote_state['id'] == local_state['id']:
+        # copied over wholesale (sync state included), the copy's peers were
+        # this vault's peers, so it starts over under an id of its own
+        remote_state = {"id" : os.urandom(8).hex(), "peers" : {}}
+
+    last = local_state['peers'].get(remote_state['id'], {})
+    report = {
+        "compared" : 0,
+        "to_local" : 0,
+        "to_remote" : 0,
+        "removed_local" : 0,
+        "removed_remote" : 0,
+        "conflicts" : [],
+        "root" : last.get('root'),
+        "unchanged" : False,
+        "seconds" : 0.0
+    }
+    if last.get('files') == [_files(local), _files(remote)]:
+        report['unchanged'] = True
+        report['seconds'] = time.perf_counter() - start
+        return report
+
+    ours = MerkleTree(stamps(local, exclude))
+    theirs = MerkleTree(stamps(remote, exclude))
+    base = read_base(local, remote_state['id']) if last else {}
+    to_local, to_remote = {}, {}
+    removed_local, removed_remote = [], []
+    conflicts = []
+    changed = ours.diff(theirs)
+    for title in changed:
+        mine = ours.stamps.get(title)
+        other = theirs.stamps.get(title)
+        before = base.get(title)
+        if mine != before and other != before:
+            if before is None and mine[0] != other[0]:
+                # never agreed on (first sync), the copy changed more often wins
+                winner = "local" if mine[0] > other[0] else "remote"
+            elif prefer is None:
+                conflicts.append(title)
+                continue
+            else:
+                winner = prefer
+        else:
+            winner = "remote" if mine == before else "local"
+        if winner == "remote" and other is None:
+            removed_local.append(title)
+        elif winner == "remote":
+            to_local[title] = (remote.raw(title), other[0])
+        elif mine is None:
+            removed_remote.append(title)
+        else:
+            to_remote[title] = (local.raw(title), mine[0])
+
+    if to_local or removed_local:
+        local.merge(to_local, removed_local)
+    if to_remote or removed_remote:
+        remote.merge(to_remote, removed_remote)
+
+    # both copies now hold the same stamps except for conflicts, which keep
+    # the ones from before so they stay conflicts until settled
+    ours.update({title : theirs.stamps[title] for title in to_local} | dict.fromkeys(removed_local))
+    agreed = dict(ours.stamps)
+    for title in conflicts:
+        if title in base:
+            agreed[title] = base[title]
+        else:
+            agreed.pop(title, None)
+    root = files = reverse = None
+    if not conflicts:
+        root = ours.root
+        files = [_files(local), _files(remote)]
+        reverse = files[::-1]
+    local_state['peers'][remote_state['id']] = {"files" : files, "root" : root}
+    remote_state['peers'][local_state['id']] = {"files" : reverse, "root" : root}
+    write_state(local, local_state, remote_state['id'], agreed)
+    write_state(remote, remote_state, local_state['id'], agreed)
+
+    report.update({
+        "compared" : len(changed),
+        "to_local" : len(to_local),
+        "to_remote" : len(to_remote),
+        "removed_local" : len(removed_local),
+        "removed_remote" : len(removed_remote),
+        "conflicts" : conflicts,
+        "root" : root,
+        "seconds" : time.perf_counter() - start
+    })
+    return report
@@ -0,0 +1,182 @@
+# lightweight timing spans for the hot paths of Password Manager
+#
+# usage (from the app directory):
+#
+#   python main.py --profile [command ...]                   per-stage report on stderr
+#   python main.py --profile=session.jsonl [command ...]     plus every span as JSON Lines
+#   python main.py --profile=session.prof [command ...]      plus a cProfile dump (pstats)
+#
+# setting PW_MGR_PROFILE (to 1 or an output path) does the same as --profile.
+# spans are off unless one of those is given, `span()` then hands back one
+# shared object whose enter/exit do nothing. code run once per record checks
+# `active` instead, so it doesn't even pay for that. spans only cover this
+# process, work fanned out to the process pool (see parallel.py) shows up as
+# the span around it
+
+import json
+import os
+import sys
+import time
+
+ENV_VAR = "PW_MGR_PROFILE"
+FLAG = "--profile"
+
+class _NoSpan:
+    # stands in for every span while profiling is off
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        # list.append is atomic, spans from the shard save threads are fine
+        _samples.append((self.name, self.start, time.perf_counter() - self.start))
+        return False
+
+_NO_SPAN = _NoSpan()
+
+# True while spans are being collected
+active = False
+
+# (stage, start, seconds) for every finished span, None while profiling is off
+_samples = None
+_origin = 0.0
+_output = None
+_profiler = None
+
+def span(name: str) -> _Span | _NoSpan:
+    """
+    time a `with` block as one sample of the stage `name`
+
+    Parameters
+    ----------
+    name : str
+        stage name, e.g. `fernet_decrypt` or `vault.get`
+
+    Returns
+    -------
+    _Span | _NoSpan
+        context manager, a shared no-op one while profiling is off
+    """
+    if _samples is None:
+        return _NO_SPAN
+    return _Span(name)
+
+def enable(output: str | None = None) -> None:
+    """
+    start collecting spans (and a cProfile run for a `.prof` output)
+
+    Parameters
+    ----------
+    output : str | None, optional
+        `.jsonl` file for every span or `.prof` file for a cProfile dump,
+        by default the report is only printed
+    """
+    global active, _samples, _origin, _output, _profiler
+    active = True
+    _samples = []
+    _origin = time.perf_counter()
+    _output = output
+    if output is not None and output.endswith(".prof"):
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+def start(args: list[str]) -> list[str]:
+    """
+    enable profiling if `--profile[=PATH]` is among the command line
+    arguments or PW_MGR_PROFILE is set
+
+    Parameters
+    ----------
+    args : list[str]
+        command line arguments
+
+    Returns
+    -------
+    list[str]
+        arguments with the profile flag taken out
+    """
+    output = os.environ.get(ENV_VAR) or None
+    wanted = output is not None
+    rest = []
+    for arg in args:
+        if arg == FLAG or arg.startswith(FLAG + "="):
+            wanted = True
+            output = arg.partition("=")[2] or output
+        else:
+            rest.append(arg)
+    if wanted:
+        # PW_MGR_PROFILE=1 just switches the report on
+        enable(None if output in (None, "1") else output)
+    return rest
+
+def percentile(
+        ordered: list[float],
+        fraction: float
+    ) -> float:
+    """
+    nearest rank percentile of samples sorted in ascending order
+    """
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def stats() -> dict:
+    """
+    summary of the spans collected so far
+
+    Returns
+    -------
+    dict
+        {stage: {count, total_s, p50_ms, p99_ms}}, biggest total first
+    """
+    stages = {}
+    for name, _, seconds in _samples or ():
+        stages.setdefault(name, []).append(seconds)
+    summary = {}
+    for name, times in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        times.sort()
+        summary[name] = {
+            "count" : len(times),
+            "total_s" : round(sum(times), 6),
+            "p50_ms" : round(percentile(times, 0.50) * 1000, 3),
+            "p99_ms" : round(percentile(times, 0.99) * 1000, 3)
+        }
+    return summary
+
+def finish() -> None:
+    """
+    print the per-stage report to stderr and write the requested output,
+    does nothing if profiling is off
+    """
+    global active, _samples, _profiler
+    if _samples is None:
+        return
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_output)
+        _profiler = None
+    elif _output is not None:
+        with open(_output, "w") as file:
+            for name, start, seconds in _samples:
+                file.write(json.dumps({"stage" : name, "start_s" : round(start - _origin, 6), "ms" : round(seconds * 1000, 3)}) + "\n")
+
+    print(f"\n{'stage':<24}{'count':>8}{'total s':>11}{'p50 ms':>10}{'p99 ms':>10}", file=sys.stderr)
+    for name, row in stats().items():
+        print(f"{name:<24}{row['count']:>8}{row['total_s']:>11.3f}{row['p50_ms']:>10.3f}{row['p99_ms']:>10.3f}", file=sys.stderr)
+    if _output is not None:
+        print(f"profile written to `{_output}`", file=sys.stderr)
+    active = False
+    _samples = None
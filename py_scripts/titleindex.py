@@ -0,0 +1,193 @@
+# in-memory index over credential titles for Password Manager
+#
+# titles are kept in a sorted array (case-folded) so prefix searches are a
+# bisect plus a short scan, and a trigram -> titles map answers fuzzy
+# searches by counting shared trigrams instead of comparing every title
+
+import heapq
+from bisect import bisect_left, insort
+from collections import Counter
+
+# titles shown per page when listing
+PAGE_SIZE = 25
+
+# trigrams shared by more titles than this are only used for fuzzy search
+# when the query has nothing rarer, keeps lookups fast on huge vaults
+COMMON_TRIGRAM = 5000
+
+def trigrams(text: str) -> set[str]:
+    """
+    overlapping three letter pieces of a case-folded, padded string
+
+    Parameters
+    ----------
+    text : str
+        string to split
+
+    Returns
+    -------
+    set[str]
+        trigrams of the string
+    """
+    padded = f"  {text.casefold()} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TitleIndex:
+    """
+    sorted + trigram index of credential titles
+
+    Parameters
+    ----------
+    titles : list[str]
+        titles to index
+    """
+    def __init__(self, titles: list[str]) -> None:
+        self._sorted = sorted((title.casefold(), title) for title in titles)
+        # trigram map is only built the first time a fuzzy search needs it
+        self._trigrams = None
+
+    def __len__(self) -> int:
+        return len(self._sorted)
+
+    def _build_trigrams(self) -> dict[str, set[str]]:
+        self._trigrams = {}
+        for _, title in self._sorted:
+            for tri in trigrams(title):
+                self._trigrams.setdefault(tri, set()).add(title)
+        return self._trigrams
+
+    def add(self, title: str) -> None:
+        insort(self._sorted, (title.casefold(), title))
+        if self._trigrams is not None:
+            for tri in trigrams(title):
+                self._trigrams.setdefault(tri, set()).add(title)
+
+    def remove(self, title: str) -> None:
+        entry = (title.casefold(), title)
+        pos = bisect_left(self._sorted, entry)
+        if pos < len(self._sorted) and self._sorted[pos] == entry:
+            del self._sorted[pos]
+        if self._trigrams is not None:
+            for tri in trigrams(title):
+                matches = self._trigrams.get(tri)
+                if matches is not None:
+                    matches.discard(title)
+                    if not matches:
+                        del self._trigrams[tri]
+
+    def prefix(
+            self,
+            prefix: str,
+            limit: int | None = None
+        ) -> list[str]:
+        """
+        titles starting with `prefix` (case-insensitive), in sorted order
+
+        Parameters
+        ----------
+        prefix : str
+            start of the title
+        limit : int | None, optional
+            most titles to return, by default all of them
+
+        Returns
+        -------
+        list[str]
+            matching titles
+        """
+        folded = prefix.casefold()
+        matches = []
+        pos = bisect_left(self._sorted, (folded,))
+        while pos < len(self._sorted) and self._sorted[pos][0].startswith(folded):
+            matches.append(self._sorted[pos][1])
+            if limit is not None and len(matches) == limit:
+                break
+            pos += 1
+        return matches
+
+    def fuzzy(
+            self,
+            query: str,
+            limit: int = 10
+        ) -> list[str]:
+        """
+        titles ranked by how many trigrams they share with the query
+
+        Parameters
+        ----------
+        query : str
+            approximate title
+        limit : int, optional
+            most titles to return, by default 10
+
+        Returns
+        -------
+        list[str]
+            best matches first
+        """
+        index = self._trigrams if self._trigrams is not None else self._build_trigrams()
+        query_tris = trigrams(query)
+        postings = sorted(
+            (index[tri] for tri in query_tris if tri in index),
+            key=len
+        )
+        if not postings:
+            return []
+        rare = [matches for matches in postings if len(matches) <= COMMON_TRIGRAM]
+        counts = Counter()
+        for matches in rare or postings[:1]:
+            counts.update(matches)
+
+        # similarity of shared trigrams to the size of both trigram sets
+        def score(title: str) -> float:
+            shared = counts[title]
+            return shared / (len(query_tris) + len(title) + 1 - shared)
+        return heapq.nlargest(limit, counts, key=score)
+
+    def search(
+            self,
+            query: str,
+            limit: int = 10
+        ) -> list[str]:
+        """
+        prefix matches first, topped up with fuzzy matches
+
+        Parameters
+        ----------
+        query : str
+            start of, or approximate, title
+        limit : int, optional
+            most titles to return, by default 10
+
+        Returns
+        -------
+        list[str]
+            matching titles
+        """
+        matches = self.prefix(query, limit)
+        if len(matches) < limit:
+            seen = set(matches)
+            matches += [title for title in self.fuzzy(query, limit) if title not in seen][:limit - len(matches)]
+        return matches
+
+    def page(
+            self,
+            number: int,
+            size: int = PAGE_SIZE
+        ) -> list[str]:
+        """
+        one page of titles in sorted order
+
+        Parameters
+        ----------
+        number : int
+            page number, starting at 0
+        size : int, optional
+            titles per page, by default PAGE_SIZE
+
+        Returns
+        -------
+        list[str]
+            titles on the page (empty past the last page)
+        """
+        return [title for _, title in self._sorted[number * size:(number + 1) * size]]
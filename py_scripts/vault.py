@@ -0,0 +1,671 @@
+# programmatic interface to a Password Manager vault, used by the interactive
+# menu in passmgmt.py and by the batch/scripting commands in main.py
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import timing
+from codec import DEFAULT_CODEC
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager, nullcontext
+from credential import Credential
+from cryptography.fernet import Fernet
+from history import History
+from journal import COMPACT_AFTER
+from shards import ShardedVault, open_store
+from titleindex import TitleIndex
+from vaultfile import LazyVault
+
+# 'USER' holds the root user info and is never exposed as a credential
+RESERVED_TITLE = "USER"
+
+# vault data kept in files (as opposed to a plain in-memory dict)
+FILE_BACKED = (LazyVault, ShardedVault)
+
+class VaultError(Exception):
+    """
+    raised when a vault operation can't be applied (bad/missing/taken title)
+    """
+
+class ConflictError(VaultError):
+    """
+    raised when credentials were changed by another session since they were read
+    """
+
+class Vault:
+    """
+    add/get/edit/remove/list credentials in a vault
+
+    every operation runs under the vault file's lock, so several processes
+    (menu sessions, the agent, batch jobs) can share one vault. `edit` and
+    `remove` take the version the caller last saw and refuse to clobber
+    a change made in between
+
+    Parameters
+    ----------
+    data : LazyVault | ShardedVault | dict
+        vault data, a plain dict works for in-memory use
+    """
+    def __init__(self, data: LazyVault | ShardedVault | dict) -> None:
+        self.data = data
+        self._index = None
+        self._revision = getattr(data, "revision", 0)
+
+    @property
+    def index(self) -> TitleIndex:
+        """
+        title index for prefix/fuzzy search, built on first use and kept up
+        to date by add/remove after that
+        """
+        with self._lock():
+            if self._index is None:
+                self._index = TitleIndex(self.list())
+            return self._index
+
+    def completer(self):
+        """
+        readline completion function over the titles, the title index (and
+        with it every title) is only decrypted on the first tab
+
+        Returns
+        -------
+        Callable[[str, int], str | None]
+            completer for `readline.set_completer`
+        """
+        matches = []
+        def complete(text: str, state: int) -> str | None:
+            nonlocal matches
+            if state == 0:
+                matches = self.index.prefix(text, 100)
+            return matches[state] if state < len(matches) else None
+        return complete
+
+    def _lock(self, exclusive: bool = False):
+        # hold the vault file lock (synced with other processes), plain dicts
+        # aren't shared so there's nothing to lock
+        if not isinstance(self.data, FILE_BACKED):
+            return nullcontext()
+        return self._synced(exclusive)
+
+    @contextmanager
+    def _synced(self, exclusive: bool) -> Iterator[None]:
+        with self.data.locked(exclusive):
+            # another process changed the vault, titles may be stale
+            if self.data.revision != self._revision:
+                self._revision = self.data.revision
+                self._index = None
+            yield
+
+    @classmethod
+    def open(
+            cls,
+            filepath: str,
+            fernet: Fernet,
+            compact_after: int = COMPACT_AFTER,
+            shards: int = 1,
+            codec: str = DEFAULT_CODEC,
+            keep_history: int = 0,
+            history_days: float = 0
+        ) -> "Vault":
+        """
+        open a vault file or sharded vault (replaying its journals)
+
+        Parameters
+        ----------
+        filepath : str
+            location of vault file
+        fernet : Fernet
+            Fernet encryption object
+        compact_after : int, optional
+            journal entries allowed before compacting, by default COMPACT_AFTER
+        shards : int, optional
+            number of shards to split the vault into, by default 1
+        codec : str, optional
+            compression for records written from now on, by default DEFAULT_CODEC
+        keep_history : int, optional
+            snapshots of past saves to keep, by default 0 (no history)
+        history_days : float, optional
+            also keep snapshots younger than this many days, by default 0 (off)
+
+        Returns
+        -------
+        Vault
+            opened vault
+        """
+        return cls(open_store(filepath, fernet, compact_after, shards, codec, keep_history, history_days))
+
+    def _check_title(self, title: str) -> None:
+        if not isinstance(title, str):
+            raise VaultError(f"title must be a string, not {type(title).__name__}")
+        if title == RESERVED_TITLE:
+            raise VaultError(f"`{RESERVED_TITLE}` is an invalid title")
+
+    def _check_fields(
+            self,
+            username: str,
+            password: str
+        ) -> None:
+        # Credential only holds text, anything else from a batch or the agent
+        # is refused here instead of failing halfway through a write
+        for name, value in (("username", username), ("password", password)):
+            if not isinstance(value, str):
+                raise VaultError(f"{name} must be a string, not {type(value).__name__}")
+
+    def _check_exists(self, title: str) -> None:
+        self._check_title(title)
+        if title not in self.data:
+            raise VaultError(f"title `{title}` not found in credentials")
+
+    def check_new(self, title: str) -> None:
+        """
+        make sure a title can be used for new credentials
+
+        Parameters
+        ----------
+        title : str
+            title of the credentials
+
+        Raises
+        ------
+        VaultError
+            if the title is reserved or already taken
+        """
+        self._check_title(title)
+        with self._lock():
+            if title in self.data:
+                raise VaultError(f"title `{title}` already in database")
+
+    # checked under the lock like every other read, so changes made by other
+    # sessions since are seen
+    def __contains__(self, title: str) -> bool:
+        with self._lock():
+            return title != RESERVED_TITLE and title in self.data
+
+    def __len__(self) -> int:
+        with self._lock():
+            return len(self.data) - (RESERVED_TITLE in self.data)
+
+    def add(
+            self,
+            title: str,
+            username: str,
+            password: str
+        ) -> None:
+        """
+        add new credentials
+
+        Parameters
+        ----------
+        title : str
+            title of the credentials
+        username : str
+            username for the credentials
+        password : str
+            password for the credentials
+
+        Raises
+        ------
+        VaultError
+            if the title is invalid or taken, or a field isn't a string
+        """
+        self._check_fields(username, password)
+        with timing.span("vault.add"), self._lock(exclusive=True):
+            self.check_new(title)
+            self.data[title] = Credential(username, password)
+            if self._index is not None:
+                self._index.add(title)
+
+    def get(self, title: str) -> Credential | dict:
+        """
+        look up credentials
+
+        the result is the vault's own copy, it's wiped as soon as the
+        credentials are edited or removed, or the vault is closed
+
+        Parameters
+        ----------
+        title : str
+            title of the credentials
+
+        Returns
+        -------
+        Credential | dict
+            username and password for the credentials
+        """
+        with timing.span("vault.get"), self._lock():
+            self._check_exists(title)
+            return self.data[title]
+
+    def version(self, title: str) -> int:
+        """
+        current version of credentials, goes up by one on every change
+
+        Parameters
+        ----------
+        title : str
+            title of the credentials
+
+        Returns
+        -------
+        int
+            record version, 0 if the vault doesn't track versions
+        """
+        with self._lock():
+            self._check_exists(title)
+            return self.data.version(title) if isinstance(self.data, FILE_BACKED) else 0
+
+    def _check_version(
+            self,
+            title: str,
+            expected_version: int | None
+        ) -> None:
+        if expected_version is not None and isinstance(self.data, FILE_BACKED):
+            if self.data.version(title) != expected_version:
+                raise ConflictError(f"`{title}` was changed by another session")
+
+    def edit(
+            self,
+            title: str,
+            username: str,
+            password: str,
+            expected_version: int | None = None
+        ) -> None:
+        """
+        replace the username and password of existing credentials
+
+        Parameters
+        ----------
+        title : str
+            title of the credentials
+        username : str
+            new username
+        password : str
+            new password
+        expected_version : int | None, optional
+            version the credentials had when read, by default not checked
+
+        Raises
+        ------
+        VaultError
+            if the title isn't found or a field isn't a string
+        ConflictError
+            if the credentials changed since `expected_version`
+        """
+        self._check_fields(username, password)
+        with timing.span("vault.edit"), self._lock(exclusive=True):
+            self._check_exists(title)
+            self._check_version(title, expected_version)
+            self.data[title] = Credential(username, password)
+
+    def remove(
+            self,
+            title: str,
+            expected_version: int | None = None
+        ) -> None:
+        """
+        remove credentials
+
+        Parameters
+        ----------
+        title : str
+            title of the credentials
+        expected_version : int | None, optional
+            version the credentials had when read, by default not checked
+
+        Raises
+        ------
+        ConflictError
+            if the credentials changed since `expected_version`
+        """
+        with timing.span("vault.remove"), self._lock(exclusive=True):
+            self._check_exists(title)
+            self._check_version(title, expected_version)
+            del self.data[title]
+            if self._index is not None:
+                self._index.remove(title)
+
+    def list(self) -> list[str]:
+        """
+        titles of all credentials
+
+        Returns
+        -------
+        list[str]
+            credential titles, in the order they were added (per shard
+            for sharded vaults)
+        """
+        with timing.span("vault.list"), self._lock():
+            return [title for title in self.data if title != RESERVED_TITLE]
+
+    def search(
+            self,
+            query: str,
+            limit: int = 10
+        ) -> list[str]:
+        """
+        titles starting with `query`, topped up with fuzzy matches
+
+        Parameters
+        ----------
+        query : str
+            start of, or approximate, title
+        limit : int, optional
+            most titles to return, by default 10
+
+        Returns
+        -------
+        list[str]
+            matching titles, best first
+
+        Raises
+        ------
+        VaultError
+            if the query isn't a string or the limit isn't a whole number
+        """
+        if not isinstance(query, str):
+            raise VaultError(f"query must be a string, not {type(query).__name__}")
+        if not isinstance(limit, int) or isinstance(limit, bool):
+            raise VaultError(f"limit must be a whole number, not {type(limit).__name__}")
+        with timing.span("vault.search"), self._lock():
+            return self.index.search(query, limit)
+
+    def items(self) -> Iterator[tuple[str, dict]]:
+        """
+        walk every credential, decrypting records in parallel chunks on
+        big vaults (see parallel.py)
+
+        Returns
+        -------
+        Iterator[tuple[str, dict]]
+            (title, credentials) pairs
+        """
+        walk = getattr(self.data, "walk", self.data.items)
+        # one consistent snapshot, writers wait until the walk is done
+        with self._lock():
+            for title, value in walk():
+                if title != RESERVED_TITLE:
+                    yield title, value
+
+    def apply(self, op: dict) -> dict:
+        """
+        apply one operation given as a dictionary, e.g.
+        `{"op": "add", "title": "...", "username": "...", "password": "..."}`,
+        edit/remove take an optional `version` from a previous get
+
+        Parameters
+        ----------
+        op : dict
+            operation with an `op` of add/get/edit/remove/list/search
+
+        Returns
+        -------
+        dict
+            `{"ok": True, ...}` with any result, or `{"ok": False, "error": ...}`
+        """
+        if not isinstance(op, dict):
+            return {"ok": False, "error": f"operation must be an object, not {type(op).__name__}"}
+        try:
+            action = op.get('op')
+            if action == "add":
+                self.add(op['title'], op['username'], op['password'])
+                return {"ok": True}
+            elif action == "get":
+                with self._lock():
+                    return {"ok": True, **self.get(op['title']), "version": self.version(op['title'])}
+            elif action == "edit":
+                self.edit(op['title'], op['username'], op['password'], op.get('version'))
+                return {"ok": True}
+            elif action == "remove":
+                self.remove(op['title'], op.get('version'))
+                return {"ok": True}
+            elif action == "list":
+                return {"ok": True, "titles": self.list()}
+            elif action == "search":
+                return {"ok": True, "titles": self.search(op['query'], op.get('limit', 10))}
+            else:
+                return {"ok": False, "error": f"unknown operation `{action}`"}
+        except VaultError as err:
+            return {"ok": False, "error": str(err)}
+        except KeyError as err:
+            return {"ok": False, "error": f"operation missing field {err}"}
+
+    @contextmanager
+    def batch(self) -> Iterator["Vault"]:
+        """
+        group many operations into a single persist
+
+        changes inside the block skip the per-change journal and are written
+        with one compaction when the block exits, other processes are locked
+        out of the vault until then
+        """
+        if not isinstance(self.data, FILE_BACKED):
+            yield self
+            return
+        with self._lock(exclusive=True):
+            self.data.journaled = False
+            try:
+                yield self
+            finally:
+                self.data.journaled = True
+                self.save()
+
+    def apply_batch(self, ops: Iterable[dict]) -> Iterator[dict]:
+        """
+        apply a stream of operations with a single persist at the end
+
+        Parameters
+        ----------
+        ops : Iterable[dict]
+            operations, see `apply`
+
+        Returns
+        -------
+        Iterator[dict]
+            result for each operation, in order
+        """
+        with self.batch():
+            for op in ops:
+                yield self.apply(op)
+
+    def rotate(self, key_id: str) -> int:
+        """
+        re-encrypt the vault under the first key of its MultiFernet, file by
+        file, files already rotated by `key_id` are skipped so an interrupted
+        rotation can be resumed
+
+        Parameters
+        ----------
+        key_id : str
+            id of the rotation
+
+        Returns
+        -------
+        int
+            number of vault files rotated
+        """
+        if not isinstance(self.data, FILE_BACKED):
+            return 0
+        from sync import rotate_state
+
+        rotated = int(self.data.rotate(key_id))
+        # snapshots and sync state are small next to the vault, they're
+        # re-encrypted in full every time so a resumed rotation can't miss any
+        with self._lock(exclusive=True):
+            if self.data.history is not None:
+                self.data.history.rotate()
+            rotate_state(self.data)
+        return rotated
+
+    def _history(self) -> History:
+        if not isinstance(self.data, FILE_BACKED) or self.data.history is None:
+            raise VaultError("no history is kept for this vault (HISTORY_KEEP in meta.json)")
+        return self.data.history
+
+    def history(self) -> list[dict]:
+        """
+        snapshots of past saves that can be restored, oldest first
+
+        Returns
+        -------
+        list[dict]
+            snapshot headers, see `History.snapshots`
+
+        Raises
+        ------
+        VaultError
+            if the vault keeps no history
+        """
+        history = self._history()
+        with self._lock():
+            return history.snapshots()
+
+    def restore(self, number: int) -> dict:
+        """
+        bring every credential back to how it was in a snapshot
+
+        only records that differ from the snapshot are rewritten (as the
+        snapshot's ciphertext, with a new version so other sessions and
+        synced copies see the change), credentials added since are removed.
+        the restore is saved like any other change, so it can be undone by
+        restoring the snapshot before it
+
+        Parameters
+        ----------
+        number : int
+            snapshot number, see `history`
+
+        Returns
+        -------
+        dict
+            `restored` and `removed` credential counts
+
+        Raises
+        ------
+        VaultError
+            if the vault keeps no history or there is no such snapshot
+        RuntimeError
+            if the vault couldn't be rewritten (windows, vault open elsewhere)
+        """
+        history = self._history()
+        with self._lock(exclusive=True):
+            if self.data.changed:
+                self.data.save()
+            try:
+                state = history.state(number)
+            except KeyError:
+                raise VaultError(f"no snapshot {number}, see `history` for the ones kept") from None
+            state.pop(RESERVED_TITLE, None)
+            current = {title : (token, version) for title, token, version in self.data.tokens()}
+            records = {}
+            fernet = self.data.fernet
+            for title, (token, version) in state.items():
+                now = current.get(title)
+                if now is not None and (now[0] == token or now[1] == version and fernet.decrypt(now[0]) == fernet.decrypt(token)):
+                    # same record, only re-encrypted since (key rotation)
+                    continue
+                records[title] = (token, max(version, now[1] if now else 0) + 1)
+            removed = [title for title in current if title not in state and title != RESERVED_TITLE]
+            if records or removed:
+                self.data.merge(records, removed)
+            self._index = None
+        return {"restored" : len(records), "removed" : len(removed)}
+
+    def digest(self) -> str:
+        """
+        Merkle root of the vault's records (see sync.py), copies holding the
+        same records have the same digest
+
+        Returns
+        -------
+        str
+            hex digest
+        """
+        from sync import vault_digest
+
+        if not isinstance(self.data, FILE_BACKED):
+            raise VaultError("only vault files have a digest")
+        with self._lock(exclusive=True):
+            return vault_digest(self.data, (RESERVED_TITLE,))
+
+    def sync(
+            self,
+            other: Vault,
+            prefer: str | None = None
+        ) -> dict:
+        """
+        merge with another copy of the vault (same key) both ways, copying
+        only records that differ, see sync.py
+
+        Parameters
+        ----------
+        other : Vault
+            the other copy
+        prefer : str | None, optional
+            `local` (this vault) or `remote` (`other`) to settle conflicts,
+            by default they're reported and left alone
+
+        Returns
+        -------
+        dict
+            sync report, see `sync_stores`
+
+        Raises
+        ------
+        VaultError
+            if either vault isn't file backed or both are the same files
+        """
+        from sync import SIDES, sync_stores
+
+        if not (isinstance(self.data, FILE_BACKED) and isinstance(other.data, FILE_BACKED)):
+            raise VaultError("only vault files can be synced")
+        if prefer is not None and prefer not in SIDES:
+            raise VaultError(f"conflicts can only be settled for {' or '.join(SIDES)}")
+        paths = [os.path.realpath(vault.data.filepath) for vault in (self, other)]
+        if paths[0] == paths[1]:
+            raise VaultError("can't sync a vault with itself")
+        # locks are always taken in the same order, so two syncs between the
+        # same vaults can't deadlock
+        first, second = (self, other) if paths[0] < paths[1] else (other, self)
+        with first._lock(exclusive=True), second._lock(exclusive=True):
+            report = sync_stores(self.data, other.data, prefer, (RESERVED_TITLE,))
+            self._index = None
+            other._index = None
+        return report
+
+    def save(self) -> None:
+        if isinstance(self.data, FILE_BACKED):
+            self.data.save()
+
+    def close(self) -> None:
+        if isinstance(self.data, FILE_BACKED):
+            self.data.close()
+
+def read_ops(filepath: str) -> Iterator[tuple[int, dict | None]]:
+    """
+    stream operations from a JSON Lines file (`-` for stdin)
+
+    Parameters
+    ----------
+    filepath : str
+        location of operations file
+
+    Returns
+    -------
+    Iterator[tuple[int, dict | None]]
+        line number and operation of every non-blank line, the operation is
+        None for a line that isn't valid JSON
+    """
+    file = sys.stdin if filepath == "-" else open(filepath, "r")
+    try:
+        for line_num, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_num, json.loads(line)
+            except json.JSONDecodeError:
+                yield line_num, None
+    finally:
+        if file is not sys.stdin:
+            file.close()
@@ -0,0 +1,1189 @@
+# on-disk vault format for Password Manager, one encrypted record per credential
+#
+# layout of a vault file:
+#
+#   PMVAULT {"version": 4, "generation": 0, "codec": "zlib", "blind": "<Fernet token>"}\n   plaintext header
+#   <Fernet token>\n                  one encrypted record per credential
+#   ...
+#   <Fernet token>\n                  encrypted index {title: [offset, length, record version]}
+#   <token digests>                   16 bytes per record, in file order
+#   <blind index>                     hash table of 32 byte entries, see below
+#   <20 digit index offset> <20 digit digests offset> <20 digit blind index offset>\n
+#
+# only the trailer, the header, the token digests and the blind index are
+# plaintext, titles live inside the encrypted index so nothing about the
+# credentials is readable on disk. token digests are SHA-256 of each record
+# token as written, truncated, anyone with the file can work them out from the
+# ciphertext anyway. they let sync stamp every record (see sync.py) without
+# reading each token. `generation` goes up by one every time the vault is
+# compacted and each record carries its own version, bumped on every change
+# to it. records and the index are compressed before encryption, `codec`
+# names the codec used for new records (every record is tagged with its own,
+# see codec.py). `key` is only written by a key rotation, it names the
+# rotation that re-encrypted every token in the file (see `LazyVault.rotate`)
+#
+# the blind index finds one record without decrypting the encrypted index
+# (which holds every title). each entry is
+#
+#   <16 byte tag> <8 byte offset> <4 byte length> <4 byte record version>
+#
+# where the tag is HMAC-SHA256 of the title, truncated, keyed with a random
+# key that is stored encrypted as `blind` in the header. tags reveal nothing
+# about the titles without that key. compactions keep the key and update the
+# previous file's table in place (see `_patch_blind_table`), so only titles
+# new to the file are tagged, changes made in between are in the journal. a
+# key rotation picks a new key and builds the table from scratch. entries sit
+# in a linear probing hash table (empty slots are all zeros, a record is never
+# 0 bytes long) between 1/3 and 3/4 full, 2/3 when built, so a lookup reads
+# one or two entries. the encrypted
+# index is only decrypted when every title is needed (listing, searching,
+# compacting). version 3 files have a 42 byte trailer and no token digests,
+# version 1 and 2 files a 21 byte trailer with just the index offset and no
+# blind index
+
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import struct
+import timing
+from array import array
+from collections.abc import Iterable, Iterator, MutableMapping
+from contextlib import contextmanager
+from codec import DEFAULT_CODEC, pack, unpack
+from credential import Credential, to_json
+from cryptography.fernet import Fernet, MultiFernet
+from journal import COMPACT_AFTER, Journal
+from locking import VaultLock
+from parallel import CHUNK_SIZE, chunks, pmap
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from history import History
+
+MAGIC = b"PMVAULT "
+VERSION = 4
+# trailer length by file version
+TRAILER_LENS = {1 : 21, 2 : 21, 3 : 42, 4 : 63}
+
+# blind index entry: tag, record offset, record length, record version
+BLIND_ENTRY = struct.Struct(">16sQII")
+BLIND_TAG_LEN = 16
+
+# truncated SHA-256 of a record token
+DIGEST_LEN = 16
+
+def is_vault(filepath: str) -> bool:
+    """
+    check if a file is in the per-record vault format
+
+    Parameters
+    ----------
+    filepath : str
+        location of data file
+
+    Returns
+    -------
+    bool
+        True if file starts with the vault header
+    """
+    try:
+        with open(filepath, "rb") as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+def encrypt_record(
+        title: str,
+        value: dict,
+        fernet: Fernet,
+        codec: str = "none"
+    ) -> bytes:
+    """
+    compress and encrypt a single credential into a record token
+
+    Parameters
+    ----------
+    title : str
+        title of the credential
+    value : dict
+        credential data (username/password)
+    fernet : Fernet
+        Fernet encryption object
+    codec : str, optional
+        compression applied before encrypting, by default none
+
+    Returns
+    -------
+    bytes
+        encrypted record token
+    """
+    as_bytes = json.dumps([title, value], default=to_json).encode("utf-8")
+    if timing.active:
+        with timing.span("fernet_encrypt"):
+            return fernet.encrypt(pack(as_bytes, codec))
+    return fernet.encrypt(pack(as_bytes, codec))
+
+def decrypt_record(
+        token: bytes,
+        fernet: Fernet
+    ) -> tuple[str, dict]:
+    """
+    decrypt a record token back into its title and credential data,
+    decompressing with whatever codec it was written with
+
+    Parameters
+    ----------
+    token : bytes
+        encrypted record token
+    fernet : Fernet
+        Fernet encryption object
+
+    Returns
+    -------
+    tuple[str, dict]
+        title and credential data
+    """
+    if timing.active:
+        with timing.span("fernet_decrypt"):
+            plain = unpack(fernet.decrypt(token))
+        with timing.span("json_loads"):
+            title, value = json.loads(plain.decode("utf-8"))
+        return title, value
+    # runs for every record, so the spans are skipped outright when off
+    title, value = json.loads(unpack(fernet.decrypt(token)).decode("utf-8"))
+    return title, value
+
+def _encrypt_chunk(
+        records: list[tuple[str, dict]],
+        fernet: Fernet,
+        codec: str
+    ) -> list[bytes]:
+    return [encrypt_record(title, value, fernet, codec) for title, value in records]
+
+def _decrypt_chunk(
+        tokens: list[bytes],
+        fernet: Fernet
+    ) -> list[tuple[str, dict]]:
+    return [decrypt_record(token, fernet) for token in tokens]
+
+def _rotate_chunk(
+        tokens: list[bytes],
+        fernet: MultiFernet
+    ) -> list[bytes]:
+    return [fernet.rotate(token) for token in tokens]
+
+def encrypt_records(
+        records: Iterable[tuple[str, dict]],
+        fernet: Fernet,
+        codec: str = "none",
+        chunk_size: int = CHUNK_SIZE
+    ) -> Iterator[bytes]:
+    """
+    encrypt a stream of credentials, on the process pool when there are
+    enough of them (see parallel.py)
+
+    Parameters
+    ----------
+    records : Iterable[tuple[str, dict]]
+        (title, credential data) pairs
+    fernet : Fernet
+        Fernet encryption object
+    codec : str, optional
+        compression applied before encrypting, by default none
+    chunk_size : int, optional
+        records per job handed to a worker, by default CHUNK_SIZE
+
+    Returns
+    -------
+    Iterator[bytes]
+        record tokens, in order
+    """
+    jobs = ((chunk, fernet, codec) for chunk in chunks(records, chunk_size))
+    for tokens in pmap(_encrypt_chunk, jobs):
+        yield from tokens
+
+def decrypt_records(
+        tokens: Iterable[bytes],
+        fernet: Fernet
+    ) -> Iterator[tuple[str, dict]]:
+    """
+    decrypt a stream of record tokens, on the process pool when there are
+    enough of them (see parallel.py)
+
+    Parameters
+    ----------
+    tokens : Iterable[bytes]
+        encrypted record tokens
+    fernet : Fernet
+        Fernet encryption object
+
+    Returns
+    -------
+    Iterator[tuple[str, dict]]
+        (title, credential data) pairs, in order
+    """
+    jobs = ((chunk, fernet) for chunk in chunks(tokens))
+    for records in pmap(_decrypt_chunk, jobs):
+        yield from records
+
+def rotate_records(
+        tokens: Iterable[bytes],
+        fernet: MultiFernet
+    ) -> Iterator[bytes]:
+    """
+    re-encrypt a stream of tokens under the first key of a MultiFernet, on
+    the process pool when there are enough of them (see parallel.py)
+
+    Parameters
+    ----------
+    tokens : Iterable[bytes]
+        tokens encrypted under any of the MultiFernet's keys
+    fernet : MultiFernet
+        new key first, followed by the old one(s)
+
+    Returns
+    -------
+    Iterator[bytes]
+        re-encrypted tokens, in order
+    """
+    jobs = ((chunk, fernet) for chunk in chunks(tokens))
+    for rotated in pmap(_rotate_chunk, jobs):
+        yield from rotated
+
+def token_digest(token: bytes) -> bytes:
+    """
+    digest of an encrypted record token, a new one for every write of the record
+    """
+    return hashlib.sha256(token).digest()[:DIGEST_LEN]
+
+def blind_tag(
+        key: bytes,
+        title: str
+    ) -> bytes:
+    """
+    blind index tag of a title, a truncated HMAC-SHA256 under the file's key
+
+    Parameters
+    ----------
+    key : bytes
+        blind index key of the vault file
+    title : str
+        title of the credential
+
+    Returns
+    -------
+    bytes
+        BLIND_TAG_LEN byte tag
+    """
+    return hmac.digest(key, title.encode("utf-8"), hashlib.sha256)[:BLIND_TAG_LEN]
+
+def _blind_slot(
+        tag: bytes,
+        slots: int
+    ) -> int:
+    # tags are uniformly distributed already
+    return int.from_bytes(tag[:8], "big") % slots
+
+def _blind_table(
+        index: dict,
+        key: bytes
+    ) -> bytes:
+    # one slot in three is left empty so probe runs stay short, and records
+    # can be added for a while before the table has to grow
+    slots = len(index) * 3 // 2 + 1
+    table = bytearray(slots * BLIND_ENTRY.size)
+    taken = bytearray(slots)
+    for title, (offset, length, version) in index.items():
+        tag = blind_tag(key, title)
+        slot = _blind_slot(tag, slots)
+        while taken[slot]:
+            slot = (slot + 1) % slots
+        taken[slot] = 1
+        BLIND_ENTRY.pack_into(table, slot * BLIND_ENTRY.size, tag, offset, length, version)
+    return bytes(table)
+
+def _blind_find(
+        table: bytearray,
+        slots: int,
+        tag: bytes
+    ) -> int:
+    # slot an entry's tag sits in, for an entry known to be in the table
+    slot = _blind_slot(tag, slots)
+    while table[slot * BLIND_ENTRY.size:slot * BLIND_ENTRY.size + BLIND_TAG_LEN] != tag:
+        slot = (slot + 1) % slots
+    return slot
+
+def _blind_delete(
+        table: bytearray,
+        slots: int,
+        slot: int
+    ) -> None:
+    # empties a slot, moving later entries of the probe run back into the hole
+    # when their own slot allows it, so lookups never stop at a gap too early
+    size = BLIND_ENTRY.size
+    hole = slot
+    after = (slot + 1) % slots
+    while True:
+        tag, _, length, _ = BLIND_ENTRY.unpack_from(table, after * size)
+        if not length:
+            break
+        home = _blind_slot(tag, slots)
+        if (after - home) % slots >= (after - hole) % slots:
+            table[hole * size:(hole + 1) * size] = table[after * size:(after + 1) * size]
+            hole = after
+        after = (after + 1) % slots
+    table[hole * size:(hole + 1) * size] = bytes(size)
+
+def _patch_blind_table(
+        previous: "VaultFile",
+        index: dict,
+        key: bytes
+    ) -> bytes | None:
+    # the previous file's table (same key) updated in place: every entry is
+    # pointed at where its record now is, entries of removed titles are taken
+    # out and only titles new to the file are tagged and put in. None when
+    # the table would end up over 3/4 or under 1/3 full, it's rebuilt then
+    slots = previous._blind_slots
+    if not len(index) * 4 // 3 + 1 <= slots <= len(index) * 3 + 1:
+        return None
+    previous.titles()
+    # entries are matched to titles by their offset in the previous file
+    titles = {previous._offsets[slot] : title for title, slot in previous._slots.items()}
+    previous._file.seek(previous._blind_offset)
+    old = previous._file.read(slots * BLIND_ENTRY.size)
+    table = bytearray(old)
+    gone = []
+    for slot, (tag, offset, length, _) in enumerate(BLIND_ENTRY.iter_unpack(old)):
+        if not length:
+            continue
+        entry = index.get(titles[offset])
+        if entry is None:
+            gone.append(tag)
+        else:
+            BLIND_ENTRY.pack_into(table, slot * BLIND_ENTRY.size, tag, *entry)
+    for tag in gone:
+        _blind_delete(table, slots, _blind_find(table, slots, tag))
+    for title, entry in index.items():
+        if title in previous._slots:
+            continue
+        tag = blind_tag(key, title)
+        slot = _blind_slot(tag, slots)
+        while BLIND_ENTRY.unpack_from(table, slot * BLIND_ENTRY.size)[2]:
+            slot = (slot + 1) % slots
+        BLIND_ENTRY.pack_into(table, slot * BLIND_ENTRY.size, tag, *entry)
+    return bytes(table)
+
+def write_vault(
+        filepath: str,
+        records: Iterator[tuple[str, bytes, int]],
+        fernet: Fernet,
+        generation: int = 0,
+        codec: str = "none",
+        key_id: str | None = None,
+        previous: "VaultFile | None" = None
+    ) -> None:
+    """
+    write encrypted records to a new vault file
+
+    the file is written next to `filepath` and renamed over it once complete
+    so an interrupted write never leaves a truncated vault behind
+
+    Parameters
+    ----------
+    filepath : str
+        location of vault file
+    records : Iterator[tuple[str, bytes, int]]
+        (title, encrypted record token, record version) triples
+    fernet : Fernet
+        Fernet encryption object, used for the index and blind index key
+    generation : int, optional
+        compaction counter stored in the header, by default 0
+    codec : str, optional
+        codec recorded in the header and used for the index, by default none
+    key_id : str | None, optional
+        key rotation every record was re-encrypted by, by default None
+    previous : VaultFile | None, optional
+        file being replaced (same Fernet key), its blind index key is kept
+        and its table updated rather than rebuilt, by default None
+    """
+    tmp_path = filepath + ".tmp"
+    index = {}
+    digests = bytearray()
+    if previous is not None and previous._blind_offset is None:
+        # older format, nothing to carry over
+        previous = None
+    blind_key = os.urandom(32) if previous is None else previous.blind_key()
+    with open(tmp_path, "wb") as file:
+        header_info = {"version": VERSION, "generation": generation, "codec": codec}
+        if key_id is not None:
+            header_info['key'] = key_id
+        if previous is None:
+            header_info['blind'] = fernet.encrypt(blind_key).decode("ascii")
+        else:
+            header_info['blind'] = previous.header['blind']
+        header = MAGIC + json.dumps(header_info).encode("utf-8") + b"\n"
+        file.write(header)
+        offset = len(header)
+        for title, token, version in records:
+            file.write(token + b"\n")
+            index[title] = [offset, len(token), version]
+            digests += token_digest(token)
+            offset += len(token) + 1
+        index_token = fernet.encrypt(pack(json.dumps(index).encode("utf-8"), codec))
+        file.write(index_token + b"\n")
+        digests_offset = offset + len(index_token) + 1
+        file.write(digests)
+        blind_offset = digests_offset + len(digests)
+        table = None if previous is None else _patch_blind_table(previous, index, blind_key)
+        file.write(table or _blind_table(index, blind_key))
+        file.write(b"%020d %020d %020d\n" % (offset, digests_offset, blind_offset))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, filepath)
+
+class VaultFile:
+    """
+    read-only view of a vault file, records are decrypted on request
+
+    single records are found through the blind index, the encrypted index
+    (every title) is only decrypted once something needs all the titles
+
+    Parameters
+    ----------
+    filepath : str
+        location of vault file
+    fernet : Fernet
+        Fernet encryption object (to decrypt)
+    """
+    def __init__(
+            self,
+            filepath: str,
+            fernet: Fernet
+        ) -> None:
+        self.filepath = filepath
+        self.fernet = fernet
+        self._file = open(filepath, "rb")
+        header = self._file.readline()
+        assert header.startswith(MAGIC), f"`{filepath}` is not a vault file"
+        self.header = json.loads(header[len(MAGIC):])
+        assert self.header['version'] <= VERSION, f"`{filepath}` was written by a newer version of Password Manager"
+        self.generation = self.header.get('generation', 0)
+        self.codec = self.header.get('codec', "none")
+        self.key_id = self.header.get('key')
+
+        # trailer holds the offsets of the encrypted index, the token digests
+        # and the blind index
+        trailer_len = TRAILER_LENS[self.header['version']]
+        end = self._file.seek(-trailer_len, os.SEEK_END)
+        offsets = [int(offset) for offset in self._file.read(trailer_len).split()]
+        self._index_offset = offsets[0]
+        self._digests_offset = offsets[1] if len(offsets) > 2 else None
+        self._blind_offset = offsets[-1] if len(offsets) > 1 else None
+        self._blind_slots = 0 if self._blind_offset is None else (end - self._blind_offset) // BLIND_ENTRY.size
+        self._blind_key = None
+        self._slots = None
+
+    def _load_index(self) -> None:
+        # the index is kept as title -> slot plus flat arrays rather than a list
+        # per record, records are written back to back so each one ends where
+        # the next starts (the last one where the index starts)
+        self._file.seek(self._index_offset)
+        index_token = self._file.readline().rstrip(b"\n")
+        with timing.span("index_decrypt"):
+            index = json.loads(unpack(self.fernet.decrypt(index_token)).decode("utf-8"))
+        self._slots = {}
+        self._offsets = array("Q")
+        self._versions = array("I")
+        for slot, (title, entry) in enumerate(index.items()):
+            self._slots[title] = slot
+            self._offsets.append(entry[0])
+            # vaults written before record versions only store offset and length
+            self._versions.append(entry[2] if len(entry) > 2 else 1)
+        self._offsets.append(self._index_offset)
+
+    def blind_key(self) -> bytes:
+        """
+        key of the blind index, decrypted the first time it's needed
+        """
+        if self._blind_key is None:
+            self._blind_key = self.fernet.decrypt(self.header['blind'].encode("ascii"))
+        return self._blind_key
+
+    def _probe(self, title: str) -> tuple[int, int, int] | None:
+        # blind index lookup, linear probing from the tag's slot until the
+        # tag or an empty slot turns up
+        tag = blind_tag(self.blind_key(), title)
+        slot = _blind_slot(tag, self._blind_slots)
+        while True:
+            self._file.seek(self._blind_offset + slot * BLIND_ENTRY.size)
+            found, offset, length, version = BLIND_ENTRY.unpack(self._file.read(BLIND_ENTRY.size))
+            if found == tag:
+                return offset, length, version
+            if not length:
+                return None
+            slot = (slot + 1) % self._blind_slots
+
+    def locate(self, title: str) -> tuple[int, int, int] | None:
+        """
+        where a record is in the file, without decrypting anything but the
+        blind index key
+
+        Parameters
+        ----------
+        title : str
+            title of the credential
+
+        Returns
+        -------
+        tuple[int, int, int] | None
+            offset, length and version of the record, None if not in the file
+        """
+        if self._slots is None:
+            if self._blind_offset is not None:
+                with timing.span("blind_lookup"):
+                    return self._probe(title)
+            self._load_index()
+        slot = self._slots.get(title)
+        if slot is None:
+            return None
+        offset = self._offsets[slot]
+        return offset, self._offsets[slot + 1] - offset - 1, self._versions[slot]
+
+    def __contains__(self, title: str) -> bool:
+        return self.locate(title) is not None
+
+    def __len__(self) -> int:
+        return len(self.titles())
+
+    def titles(self) -> list[str]:
+        if self._slots is None:
+            self._load_index()
+        return list(self._slots)
+
+    def version(self, title: str) -> int:
+        entry = self.locate(title)
+        if entry is None:
+            raise KeyError(title)
+        return entry[2]
+
+    def raw(self, title: str) -> bytes:
+        """
+        encrypted token for a record, without decrypting it
+
+        Parameters
+        ----------
+        title : str
+            title of the credential
+
+        Returns
+        -------
+        bytes
+            encrypted record token
+        """
+        entry = self.locate(title)
+        if entry is None:
+            raise KeyError(title)
+        offset, length, _ = entry
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def records(self) -> Iterator[tuple[str, bytes, int]]:
+        """
+        every record as stored, in file order, without decrypting any
+
+        Returns
+        -------
+        Iterator[tuple[str, bytes, int]]
+            (title, encrypted record token, record version) triples
+        """
+        if self._slots is None:
+            self._load_index()
+        for title, slot in self._slots.items():
+            offset = self._offsets[slot]
+            self._file.seek(offset)
+            yield title, self._file.read(self._offsets[slot + 1] - offset - 1), self._versions[slot]
+
+    def stamps(self) -> Iterator[tuple[str, int, str]]:
+        """
+        version and token digest of every record, in file order, read from
+        the token digests without reading any record (older files without
+        them hash every token)
+
+        Returns
+        -------
+        Iterator[tuple[str, int, str]]
+            (title, record version, hex token digest) triples
+        """
+        if self._slots is None:
+            self._load_index()
+        if self._digests_offset is None:
+            for title, token, version in self.records():
+                yield title, version, token_digest(token).hex()
+            return
+        self._file.seek(self._digests_offset)
+        digests = self._file.read(len(self._slots) * DIGEST_LEN).hex()
+        width = DIGEST_LEN * 2
+        for title, slot in self._slots.items():
+            yield title, self._versions[slot], digests[slot * width:(slot + 1) * width]
+
+    def get(self, title: str) -> dict:
+        """
+        decrypt a single record
+
+        Parameters
+        ----------
+        title : str
+            title of the credential
+
+        Returns
+        -------
+        dict
+            credential data
+        """
+        _, value = decrypt_record(self.raw(title), self.fernet)
+        return value
+
+    def close(self) -> None:
+        self._file.close()
+
+def _noted(
+        records: Iterable[tuple[str, bytes, int]],
+        seen: list
+    ) -> Iterator[tuple[str, bytes, int]]:
+    # passes records through, keeping a copy of each
+    for record in records:
+        seen.append(record)
+        yield record
+
+class LazyVault(MutableMapping):
+    """
+    dictionary-like view of a vault that only decrypts the records touched
+
+    every change is appended to the vault's journal as it happens and the
+    journal is folded back into the vault file once it grows past
+    `compact_after` entries (or `save` is called), records that were never
+    changed are copied over as ciphertext without being decrypted
+
+    several processes can have the same vault open, writes happen under the
+    vault's exclusive lock after syncing with whatever the other processes
+    journaled or compacted, so nobody's changes get clobbered. reads should
+    be done inside `locked()` to see other processes' changes
+
+    Parameters
+    ----------
+    filepath : str
+        location of vault file
+    fernet : Fernet
+        Fernet encryption object
+    compact_after : int, optional
+        journal entries allowed before compacting, by default COMPACT_AFTER
+    lock : VaultLock | None, optional
+        lock shared with other vault files (shards), by default the vault's own
+    codec : str, optional
+        compression for records written from now on, by default DEFAULT_CODEC
+    history : History | None, optional
+        snapshot history every compaction is recorded in, by default none
+    """
+    def __init__(
+            self,
+            filepath: str,
+            fernet: Fernet,
+            compact_after: int = COMPACT_AFTER,
+            lock: VaultLock | None = None,
+            codec: str = DEFAULT_CODEC,
+            history: "History | None" = None
+        ) -> None:
+        self.filepath = filepath
+        self.fernet = fernet
+        self.compact_after = compact_after
+        self.codec = codec
+        self.history = history
+        self.journaled = True
+        self._owns_lock = lock is None
+        self.lock = lock or VaultLock(filepath + ".lock")
+        self.journal = Journal(filepath + ".journal", fernet)
+        # bumped whenever changes from another process are picked up
+        self.revision = 0
+        self.file = None
+        with self.lock.hold():
+            self._load()
+
+    def _stamp(self) -> tuple:
+        # compaction swaps in a new file, which changes these
+        info = os.stat(self.filepath)
+        return info.st_ino, info.st_size, info.st_mtime_ns
+
+    def _load(self) -> None:
+        # (re)build the in-memory view from the vault file plus its journal
+        if self.file is not None:
+            self.file.close()
+            self._wipe_cache()
+        self.file = VaultFile(self.filepath, self.fernet)
+        self._file_stamp = self._stamp()
+        self.generation = self.file.generation
+        # title -> record version in file order, only built once every title is
+        # needed, single titles are looked up in the file's blind index plus
+        # the changes since (title -> version of records set, titles removed)
+        self._titles = None
+        self._cache = {}
+        self._dirty = {}
+        self._removed = set()
+
+        # recover changes from sessions that haven't compacted (yet)
+        self.journal.reset()
+        with timing.span("journal_replay"):
+            for entry in self.journal.replay():
+                self._apply(*entry)
+
+    def refresh(self) -> bool:
+        """
+        pick up changes other processes made, must be called with the lock held
+
+        Returns
+        -------
+        bool
+            True if anything changed
+        """
+        if self._stamp() != self._file_stamp:
+            self._load()
+            self.revision += 1
+            return True
+        changed = False
+        for entry in self.journal.replay():
+            self._apply(*entry)
+            changed = True
+        if changed:
+            self.revision += 1
+        return changed
+
+    @contextmanager
+    def locked(self, exclusive: bool = False) -> Iterator["LazyVault"]:
+        """
+        hold the vault lock and sync with other processes for a `with` block
+
+        Parameters
+        ----------
+        exclusive : bool, optional
+            take the writer lock, by default False
+        """
+        with self.lock.hold(exclusive):
+            self.refresh()
+            yield self
+
+    def version(self, title: str) -> int:
+        """
+        current version of a record, 0 if it doesn't exist
+        """
+        if self._titles is not None:
+            return self._titles.get(title, 0)
+        if title in self._dirty:
+            return self._dirty[title]
+        if title in self._removed:
+            return 0
+        entry = self.file.locate(title)
+        return entry[2] if entry is not None else 0
+
+    def _index(self) -> dict:
+        # every title -> version, decrypting the file's index the first time
+        if self._titles is None:
+            titles = {}
+            for title in self.file.titles():
+                if title not in self._removed:
+                    titles[title] = self.file.version(title)
+            # new titles (and ones removed then added back) go at the end
+            titles.update(self._dirty)
+            self._titles = titles
+        return self._titles
+
+    def __getitem__(self, title: str) -> Credential | dict:
+        if title not in self._cache:
+            if title not in self:
+                raise KeyError(title)
+            self._cache[title] = Credential.wrap(self.file.get(title))
+        return self._cache[title]
+
+    def __setitem__(self, title: str, value: Credential | dict) -> None:
+        with self.locked(exclusive=True):
+            self._write("set", title, value)
+
+    def __delitem__(self, title: str) -> None:
+        with self.locked(exclusive=True):
+            if title not in self:
+                raise KeyError(title)
+            self._write("del", title)
+
+    def _write(
+            self,
+            op: str,
+            title: str,
+            value: Credential | dict | None = None
+        ) -> None:
+        version = self.version(title) + 1
+        self._apply(op, title, value, version)
+        if self.journaled:
+            self.journal.append(op, title, value, version)
+            self._maybe_compact()
+
+    def _apply(
+            self,
+            op: str,
+            title: str,
+            value: Credential | dict | None,
+            version: int
+        ) -> None:
+        # secrets being replaced or removed are zeroed straight away
+        old = self._cache.pop(title, None)
+        if old is not value and isinstance(old, Credential):
+            old.wipe()
+        if op == "set":
+            # a title removed and added back stays in `_removed`, its old
+            # record is gone and the new one goes at the end
+            self._cache[title] = Credential.wrap(value)
+            self._dirty[title] = version
+            if self._titles is not None:
+                self._titles[title] = version
+        elif title in self:
+            self._dirty.pop(title, None)
+            self._removed.add(title)
+            if self._titles is not None:
+                del self._titles[title]
+
+    def _wipe_cache(self) -> None:
+        for value in self._cache.values():
+            if isinstance(value, Credential):
+                value.wipe()
+        self._cache = {}
+
+    @property
+    def changed(self) -> bool:
+        """
+        whether there is anything for `save` to fold into the vault file
+        """
+        return bool(self._dirty or self._removed or self.journal.count)
+
+    def _maybe_compact(self) -> None:
+        if self.journal.count >= self.compact_after:
+            self.save()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index())
+
+    def __len__(self) -> int:
+        return len(self._index())
+
+    def __contains__(self, title: object) -> bool:
+        return isinstance(title, str) and self.version(title) > 0
+
+    def peek(self, title: str) -> dict:
+        """
+        read a record without keeping the decrypted copy around, used when
+        walking the whole vault
+
+        Parameters
+        ----------
+        title : str
+            title of the credential
+
+        Returns
+        -------
+        dict
+            credential data
+        """
+        if title in self._cache:
+            return self._cache[title]
+        if title not in self:
+            raise KeyError(title)
+        return self.file.get(title)
+
+    def walk(self) -> Iterator[tuple[str, dict]]:
+        """
+        decrypt every record in order, fanned out to the process pool on big
+        vaults (see parallel.py), should be called inside `locked()`
+
+        Returns
+        -------
+        Iterator[tuple[str, dict]]
+            (title, credential data) pairs
+        """
+        titles = self._index()
+        tokens = (self.file.raw(title) for title in titles if title not in self._cache)
+        decrypted = decrypt_records(tokens, self.fernet)
+        for title in titles:
+            if title in self._cache:
+                yield title, self._cache[title]
+            else:
+                yield next(decrypted)
+
+    def _records(
+            self,
+            rotate: bool = False,
+            replace: dict[str, tuple[bytes, int]] | None = None
+        ) -> Iterator[tuple[str, bytes, int]]:
+        # changed records are encrypted up front, in parallel when there are many,
+        # untouched ones are copied as is or re-encrypted under the new key,
+        # replaced ones are written as given
+        titles = self._index()
+        replace = replace or {}
+        dirty = [title for title in titles if title in self._dirty and title not in replace]
+        records = ((title, self._cache[title]) for title in dirty)
+        tokens = dict(zip(dirty, encrypt_records(records, self.fernet, self.codec)))
+        clean = (self.file.raw(title) for title in titles if title not in tokens and title not in replace)
+        if rotate:
+            clean = rotate_records(clean, self.fernet)
+        for title in titles:
+            if title in replace:
+                token, version = replace[title]
+                yield title, token, version
+            else:
+                token = tokens[title] if title in tokens else next(clean)
+                yield title, token, titles[title]
+
+    def raw(self, title: str) -> bytes:
+        """
+        encrypted token of a record as stored, must be called inside
+        `locked()` with nothing left to `save`
+
+        Parameters
+        ----------
+        title : str
+            title of the credential
+
+        Returns
+        -------
+        bytes
+            encrypted record token
+        """
+        return self.file.raw(title)
+
+    def tokens(self) -> Iterator[tuple[str, bytes, int]]:
+        """
+        every record as stored, without decrypting any, must be called inside
+        `locked()` with nothing left to `save`
+
+        Returns
+        -------
+        Iterator[tuple[str, bytes, int]]
+            (title, encrypted record token, record version) triples, in order
+        """
+        return self.file.records()
+
+    def stamps(self) -> Iterator[tuple[str, int, str]]:
+        """
+        version and token digest of every record as stored, without reading
+        any record, must be called inside `locked()` with nothing left to `save`
+
+        Returns
+        -------
+        Iterator[tuple[str, int, str]]
+            (title, record version, hex token digest) triples, in order
+        """
+        return self.file.stamps()
+
+    def merge(
+            self,
+            records: dict[str, tuple[bytes, int]],
+            removed: Iterable[str] = ()
+        ) -> None:
+        """
+        fold records encrypted elsewhere (another copy of the vault, same key)
+        in with one compaction, keeping their versions
+
+        Parameters
+        ----------
+        records : dict[str, tuple[bytes, int]]
+            title -> (encrypted record token, record version), replacing or
+            adding records
+        removed : Iterable[str], optional
+            titles to remove, by default none
+
+        Raises
+        ------
+        RuntimeError
+            if the new file couldn't be swapped in (windows, vault open elsewhere)
+        """
+        with self.locked(exclusive=True):
+            for title in removed:
+                if title in self:
+                    self._apply("del", title, None, 0)
+            replace = {title : record for title, record in records.items() if title in self}
+            extra = [(title, token, version) for title, (token, version) in records.items() if title not in replace]
+            generation = self.generation
+            self._compact(extra or None, replace=replace)
+            if self.generation == generation:
+                # nothing was written, forget the removals made in memory
+                self._load()
+                raise RuntimeError(f"`{self.filepath}` is open in another process, close it and try again")
+            for title, (_, version) in replace.items():
+                old = self._cache.pop(title, None)
+                if isinstance(old, Credential):
+                    old.wipe()
+                if self._titles is not None:
+                    self._titles[title] = version
+
+    def save(self, extra: Iterator[tuple[str, bytes, int]] | None = None) -> None:
+        """
+        compact the vault and its journal back into a single file, only
+        re-encrypting changed records
+
+        Parameters
+        ----------
+        extra : Iterator[tuple[str, bytes, int]] | None, optional
+            already encrypted (title, token, version) records to append,
+            titles must not be in the vault yet, by default None
+        """
+        with self.locked(exclusive=True):
+            self._compact(extra)
+
+    def rotate(self, key_id: str) -> bool:
+        """
+        compact the vault re-encrypting every record, the journal and the
+        index under the first key of a MultiFernet
+
+        records are streamed through in chunks and the new file only replaces
+        the old one once complete, so an interrupted rotation leaves a
+        readable vault and is picked up again by calling this with the same
+        `key_id`
+
+        Parameters
+        ----------
+        key_id : str
+            id of the rotation, recorded in the file header once done
+
+        Returns
+        -------
+        bool
+            False if the vault was already rotated by `key_id`
+
+        Raises
+        ------
+        RuntimeError
+            if the new file couldn't be swapped in (windows, vault open elsewhere)
+        """
+        with self.locked(exclusive=True):
+            if self.file.key_id == key_id and not self.changed:
+                return False
+            self._compact(key_id=key_id)
+            if self.file.key_id != key_id:
+                raise RuntimeError(f"`{self.filepath}` is open in another process, close it and try again")
+            return True
+
+    def _compact(
+            self,
+            extra: Iterator[tuple[str, bytes, int]] | None = None,
+            key_id: str | None = None,
+            replace: dict[str, tuple[bytes, int]] | None = None
+        ) -> None:
+        # caller holds the exclusive lock and has refreshed
+        # old file stays open while its untouched records are copied, so only
+        # swap the new file in once it's closed (windows won't replace open files)
+        tmp_path = self.filepath + ".new"
+        added = []
+        if extra is not None and self.history is not None:
+            extra = _noted(extra, added)
+        with timing.span("compact"):
+            write_vault(
+                tmp_path,
+                itertools.chain(self._records(key_id is not None, replace), extra or ()),
+                self.fernet,
+                self.generation + 1,
+                self.codec,
+                key_id,
+                # a rotation gets a new blind index key as well
+                self.file if key_id is None else None
+            )
+        self.file.close()
+        try:
+            os.replace(tmp_path, self.filepath)
+        except PermissionError:
+            # windows: another process still has the vault open, keep the
+            # journal (plus anything that only lived in memory) for later
+            os.remove(tmp_path)
+            self.file = VaultFile(self.filepath, self.fernet)
+            if not self.journaled:
+                # removals first, a title removed and added back is in both
+                for title in self._removed:
+                    self.journal.append("del", title, None, 0)
+                for title, version in self._dirty.items():
+                    self.journal.append("set", title, self._cache[title], version)
+            return
+        self.file = VaultFile(self.filepath, self.fernet)
+        self._file_stamp = self._stamp()
+        self.generation = self.file.generation
+        if self.history is not None:
+            with timing.span("history"):
+                changed = [(title, self.file.raw(title), version) for title, version in self._dirty.items()]
+                changed += [(title, token, version) for title, (token, version) in (replace or {}).items()]
+                self.history.record(changed + added, self._removed)
+        self._dirty.clear()
+        self._removed.clear()
+        if extra is not None:
+            # read back from the new file's index when next needed
+            self._titles = None
+
+        # journal is only dropped once the vault holding its changes is in place,
+        # a crash in between just replays changes that are already applied
+        self.journal.clear()
+
+    def close(self) -> None:
+        self._wipe_cache()
+        self.file.close()
+        self.journal.close()
+        if self._owns_lock:
+            self.lock.close()
+
+def create_vault(
+        filepath: str,
+        data: dict,
+        fernet: Fernet,
+        codec: str = DEFAULT_CODEC
+    ) -> None:
+    """
+    write a full dictionary of credentials as a new vault file
+
+    Parameters
+    ----------
+    filepath : str
+        location of vault file
+    data : dict
+        dictionary of user password data
+    fernet : Fernet
+        Fernet encryption object
+    codec : str, optional
+        compression applied before encrypting, by default DEFAULT_CODEC
+    """
+    tokens = encrypt_records(data.items(), fernet, codec)
+    records = ((title, token, 1) for title, token in zip(data, tokens))
+    write_vault(filepath, records, fernet, codec=codec)
+
+def migrate_legacy(
+        data_path: str,
+        fernet: Fernet,
+        codec: str = DEFAULT_CODEC
+    ) -> str:
+    """
+    convert a single-token `data.json` into the per-record vault format
+
+    the old file is kept with a `.bak` suffix once the vault is written
+
+    Parameters
+    ----------
+    data_path : str
+        location of the legacy encrypted json file
+    fernet : Fernet
+        Fernet encryption object
+    codec : str, optional
+        compression for the new vault, by default DEFAULT_CODEC
+
+    Returns
+    -------
+    str
+        location of the new vault file
+    """
+    with open(data_path, "rb") as file:
+        data = json.loads(unpack(fernet.decrypt(file.read())).decode("utf-8"))
+    vault_path = os.path.splitext(data_path)[0] + ".vault"
+    create_vault(vault_path, data, fernet, codec)
+    os.replace(data_path, data_path + ".bak")
+    return vault_path